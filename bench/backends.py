@@ -0,0 +1,102 @@
+'''
+Compare dice timings between backends on a synthetic dataset shaped
+like the population example of the README:
+
+    python bench/backends.py [nb_points]
+'''
+import os
+import random
+import sys
+from time import perf_counter
+
+from menger import connect, dimension, measure, Space
+from menger.event import trigger
+
+URIS = [
+    ('sqlite', '/tmp/bench.db', ['/tmp/bench.db', '/tmp/bench.db-wal']),
+    ('duckdb', 'duckdb:////tmp/bench.duckdb',
+     ['/tmp/bench.duckdb', '/tmp/bench.duckdb.wal']),
+]
+
+
+class Population(Space):
+    geography = dimension.Tree(
+        'Geography', ['Region', 'Province', 'Commune'], str)
+    sex = dimension.Tree('Sex', ['Sex'], str)
+    age = dimension.Tree('Age', ['Age'], int)
+    year = dimension.Tree('Year', ['Year'], int)
+    population = measure.Sum('Population')
+
+
+def points(nb_points, seed=0):
+    rnd = random.Random(seed)
+    seen = set()
+    while len(seen) < nb_points:
+        key = (
+            rnd.randrange(3), rnd.randrange(10), rnd.randrange(60),
+            rnd.choice('FM'), rnd.randrange(100), 2010 + rnd.randrange(6),
+        )
+        if key in seen:
+            continue
+        seen.add(key)
+        region, province, commune, sex, age, year = key
+        yield {
+            'geography': ['R%s' % region, 'P%s-%s' % (region, province),
+                          'C%s-%s-%s' % (region, province, commune)],
+            'sex': [sex],
+            'age': [age],
+            'year': [year],
+            'population': rnd.randrange(1, 500),
+        }
+
+
+QUERIES = [
+    ('dice year population',
+     lambda: Population.dice([Population.year, Population.population])),
+    ('dice year=2015 geography[Commune] population',
+     lambda: Population.dice(
+         [Population.geography['Commune'], Population.population],
+         filters=[Population.year.match((2015,))])),
+    ('dice year geography sex age population',
+     lambda: Population.dice([
+         Population.year, Population.geography['Commune'],
+         Population.sex, Population.age, Population.population])),
+]
+
+
+def timeit(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        list(fn())
+        duration = perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main(nb_points):
+    data = list(points(nb_points))
+    timings = {}
+    for name, uri, paths in URIS:
+        for path in paths:
+            if os.path.exists(path):
+                os.unlink(path)
+        # Dimension caches are not bound to a database
+        trigger('clear_cache')
+        with connect(uri, init=True):
+            start = perf_counter()
+            Population.load(data)
+            timings[name, 'load'] = perf_counter() - start
+        with connect(uri):
+            for label, fn in QUERIES:
+                timings[name, label] = timeit(fn)
+
+    print('%-46s %9s %9s %8s' % ('', 'sqlite', 'duckdb', 'speedup'))
+    for label in ['load'] + [label for label, _ in QUERIES]:
+        sqlite, duck = timings['sqlite', label], timings['duckdb', label]
+        print('%-46s %8.3fs %8.3fs %7.1fx' % (
+            label, sqlite, duck, sqlite / duck))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,77 @@
+'''
+Measure the Python-side cost per row of dice results (formatting of
+keys, finalization and computed measures), the database is not part
+of the timings:
+
+    python bench/dice_rows.py [nb_rows]
+'''
+import random
+import sys
+from time import perf_counter
+
+from menger import connect, dimension, measure, Space
+
+
+class Sales(Space):
+    date = dimension.Tree('Date', ['Year', 'Month', 'Day'], int)
+    place = dimension.Tree('Place', ['Region', 'Country', 'City'], str)
+    total = measure.Sum('Total')
+    count = measure.Sum('Count')
+    average = measure.Average('Average', 'total', 'count')
+
+
+def points():
+    for day in range(1, 29):
+        for city in range(50):
+            yield {
+                'date': [2020, 1 + day % 12, day],
+                'place': ['R%s' % (city % 5), 'C%s' % (city % 10),
+                          'T%s' % city],
+                'total': day + city,
+                'count': 1,
+            }
+
+
+CASES = [
+    ('keys only', [Sales.date['Day'], Sales.place['City'], Sales.total],
+     True, 'key'),
+    ('name tuples', [Sales.date['Day'], Sales.place['City'], Sales.total],
+     True, None),
+    ('leaf names', [Sales.date['Day'], Sales.place['City'], Sales.total],
+     True, 'leaf'),
+    ('computed in python', [Sales.date['Day'], Sales.place['City'],
+                            Sales.average, Sales.total], False, None),
+]
+
+
+def timeit(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        duration = perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main(nb_rows):
+    rnd = random.Random(0)
+    with connect(':memory:', init=True):
+        Sales.load(points())
+        days = [k for k, in Sales.dice([Sales.date['Day']], dim_fmt='key')]
+        cities = [k for k, in Sales.dice([Sales.place['City']],
+                                         dim_fmt='key')]
+        for label, select, in_db, dim_fmt in CASES:
+            plan = Sales.plan(select, in_db=in_db)
+            # Fake backend rows: keys followed by the measures
+            rows = [(rnd.choice(days), rnd.choice(cities))
+                    + tuple(rnd.random() * 100 for _ in plan[0][2:])
+                    for _ in range(nb_rows)]
+            duration = timeit(
+                lambda: list(Sales.compute(rows, plan, dim_fmt=dim_fmt)))
+            print('%-20s %8.3fs %8.0fns/row' % (
+                label, duration, duration * 1e9 / nb_rows))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
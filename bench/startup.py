@@ -0,0 +1,61 @@
+'''
+Measure the cold start of short invocations: importing menger and
+running a CLI dice on one space out of many, each in a new process.
+
+    python bench/startup.py [nb_spaces]
+'''
+import os
+import subprocess
+import sys
+from time import perf_counter
+
+PATH = '/tmp/bench_startup.db'
+CHILD = '''
+import sys
+from menger import connect, dimension, measure, Cli, Space
+
+for pos in range(%(nb_spaces)s):
+    type('Space%%s' %% pos, (Space,), {
+        'date': dimension.Tree('Date', ['Year', 'Month'], int),
+        'place': dimension.Tree('Place', ['Region', 'City'], str),
+        'total': measure.Sum('Total'),
+    })
+
+if sys.argv[1] == 'setup':
+    with connect(%(path)r, init=True):
+        pass
+elif sys.argv[1] == 'cli':
+    sys.argv[1:] = ['dice', 'date', 'total', '-s', 'Space0']
+    with connect(%(path)r):
+        Cli.run()
+'''
+
+
+def timeit(args, repeat=10):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        subprocess.run([sys.executable] + args, check=True,
+                       stdout=subprocess.DEVNULL)
+        duration = perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main(nb_spaces):
+    child = CHILD % {'nb_spaces': nb_spaces, 'path': PATH}
+    for path in (PATH, PATH + '-wal'):
+        if os.path.exists(path):
+            os.unlink(path)
+    subprocess.run([sys.executable, '-c', child, 'setup'], check=True)
+
+    cases = [
+        ('import menger', ['-c', 'import menger']),
+        ('cli dice (%s spaces)' % nb_spaces, ['-c', child, 'cli']),
+    ]
+    for label, args in cases:
+        print('%-24s %8.3fs' % (label, timeit(args)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -1,34 +1,45 @@
 from contextlib import contextmanager
+from importlib import import_module
 import threading
 
 ctx = threading.local()
 
 from .backend import LoadType, get_backend
 from .utils import Cli
-from .dimension import Coordinate, Dimension, Level
+from .dimension import Coordinate, Dimension, LazyCoordinate, Level
 from .event import register, trigger
 from .measure import Measure
 from .space import Space, build_space, get_space, iter_spaces
 
-try:
-    import pandas
-except ImportError:
-    pass
-else:
-    from . import gasket
-
 
 class UserError(Exception):
     pass
 
 
+def __getattr__(name):
+    # gasket needs pandas, it is imported on first use
+    if name == 'gasket':
+        return import_module('.gasket', __name__)
+    raise AttributeError("module 'menger' has no attribute '%s'" % name)
+
+
 @contextmanager
-def connect(uri, rollback_on_close=False, init=False):
-    db = get_backend(uri)
+def connect(uri, rollback_on_close=False, init=False, readonly=False,
+            **options):
+    '''
+    Connect to the database at uri and register the spaces. options
+    are passed to the backend (e.g. sqlite pragmas like mmap_size).
+    '''
+    if readonly and init:
+        raise ValueError('Unable to init a read-only database')
+    db = get_backend(uri, readonly=readonly, **options)
     ctx.db = db
     ctx.uri = uri
-    for cls in iter_spaces():
-        cls.register(init=init)
+    if init:
+        # Spaces register themselves on first use (see Space.register)
+        # but tables are created upfront for dimension queries
+        for cls in iter_spaces():
+            db.init_tables(cls)
     try:
         yield db
     except:
@@ -0,0 +1,321 @@
+from itertools import chain, count, islice
+import re
+
+import duckdb
+
+from .sql import SqlBackend, LoadType
+
+# Named placeholders used by the generic queries
+PARAM_RE = re.compile(r'(?<![:\w]):(\w+)')
+SQL_TYPES = {
+    'blob': 'blob',
+    'float': 'double',
+}
+
+
+class Cursor:
+
+    'Give the DB-API cursor interface expected by SqlBackend'
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query, args=None):
+        if args is None:
+            self.connection.execute(query)
+        else:
+            self.connection.execute(query, args)
+        return self
+
+    def executemany(self, query, seq):
+        self.connection.executemany(query, seq)
+        return self
+
+    def fetchone(self):
+        return self.connection.fetchone()
+
+    def fetchall(self):
+        return self.connection.fetchall()
+
+    def arrow(self):
+        fetch = getattr(self.connection, 'to_arrow_table', None)
+        if fetch is None:
+            # Older versions
+            fetch = self.connection.fetch_arrow_table
+        return fetch()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.connection.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+
+class DuckDBBackend(SqlBackend):
+
+    '''
+    In-process columnar backend: dice queries run on the parallel hash
+    aggregation of DuckDB. DuckDB does not cascade deletes, so
+    dimension tables are not referenced by constraints and the
+    deletions are propagated explicitly.
+    '''
+
+    # Number of points loaded at once
+    batch_size = 100000
+    # Scans are columnar, ART indexes only slow down the loads
+    covering_indexes = False
+
+    def __init__(self, path):
+        self.connection = duckdb.connect(path)
+        self.cursor = Cursor(self.connection)
+        self.nb_tmp = 0
+        self.execute('BEGIN TRANSACTION')
+        super(DuckDBBackend, self).__init__()
+
+    def execute(self, query, args=None):
+        if isinstance(args, dict):
+            # Names may start with a digit, they are prefixed
+            query = PARAM_RE.sub(r'$p_\1', query)
+            args = {'p_' + k: v for k, v in args.items()}
+        return self.cursor.execute(query, args)
+
+    def executemany(self, query, seq):
+        seq = list(seq)
+        if seq:
+            self.cursor.executemany(query, seq)
+        return self.cursor
+
+    def execute_count(self, query, args=None):
+        cnt, = self.execute(query, args).fetchone()
+        return cnt
+
+    def commit(self):
+        self.connection.commit()
+        self.execute('BEGIN TRANSACTION')
+
+    def rollback(self):
+        self.connection.rollback()
+        self.execute('BEGIN TRANSACTION')
+
+    def references(self, table):
+        return ''
+
+    def serial(self, table):
+        self.execute('CREATE SEQUENCE IF NOT EXISTS "%s_seq"' % table)
+        return "INTEGER PRIMARY KEY DEFAULT nextval('%s_seq')" % table
+
+    def sql_type(self, sql_type):
+        return SQL_TYPES.get(sql_type, sql_type)
+
+    def load(self, space, keys_vals, load_type=None):
+        '''
+        Load points by batches, each batch is handed to DuckDB as an
+        Arrow table and upserted with one statement.
+        '''
+        import pyarrow
+
+        names = [d.name for d in space._dimensions] + [
+            m.name for m in space._db_measures] + ['_seq']
+        nb_insert = nb_update = 0
+        rows = iter(keys_vals)
+        # The position of the points lets the last one win
+        seq = count()
+        while True:
+            batch = [tuple(chain(k, v, (next(seq),)))
+                     for k, v in islice(rows, self.batch_size)]
+            if not batch:
+                break
+            table = pyarrow.table(dict(zip(names, zip(*batch))))
+            ins, upd = self.load_table(space, table, load_type)
+            nb_insert += ins
+            nb_update += upd
+        return nb_insert, nb_update
+
+    def load_table(self, space, table, load_type=None):
+        '''
+        Upsert table (an Arrow table or a pandas DataFrame, with one
+        column per dimension key and per measure) in space. An
+        optional _seq column gives the order of the points.
+        '''
+        dims = ['"%s"' % d.name for d in space._dimensions]
+        msrs = ['"%s"' % m.name for m in space._db_measures]
+        fmt = {
+            'spc': space._table,
+            'dims': ', '.join(dims),
+            'fields': ', '.join(dims + msrs),
+            'on': ' AND '.join('b.%s = s.%s' % (d, d) for d in dims),
+        }
+        self.connection.register('menger_batch', table)
+        try:
+            # A row can not be upserted twice by the same statement,
+            # duplicate keys are merged first
+            if load_type == LoadType.increment:
+                select = 'SELECT %(dims)s, %(aggs)s FROM menger_batch ' \
+                         'GROUP BY %(dims)s'
+                fmt['aggs'] = ', '.join(
+                    '%s AS %s' % (m.sql_agg(col), col)
+                    for m, col in zip(space._db_measures, msrs))
+            else:
+                columns = getattr(table, 'column_names', None)
+                if columns is None:
+                    columns = list(table.columns)
+                if '_seq' in columns:
+                    batch = 'menger_batch'
+                else:
+                    batch = '(SELECT *, row_number() OVER () AS _seq ' \
+                            'FROM menger_batch)'
+                select = 'SELECT DISTINCT ON (%(dims)s) %(fields)s ' \
+                         'FROM ' + batch + ' ORDER BY %(dims)s, _seq %(order)s'
+                fmt['order'] = 'ASC' if load_type == LoadType.create_only \
+                               else 'DESC'
+            self.execute('CREATE TEMPORARY TABLE menger_staging AS ' +
+                         select % fmt)
+        finally:
+            self.connection.unregister('menger_batch')
+
+        stm = 'SELECT count(*) FROM menger_staging AS b ' \
+              'JOIN "%(spc)s" AS s ON (%(on)s)'
+        nb_found = self.execute_count(stm % fmt)
+        nb_rows = self.execute_count('SELECT count(*) FROM menger_staging')
+
+        if load_type == LoadType.increment:
+            upsert = self.upsert(space)
+            nb_update = nb_found
+        elif load_type == LoadType.create_only or not msrs:
+            upsert = 'DO NOTHING'
+            nb_update = 0
+        else:
+            # Rows whose values are unchanged are not updated
+            changed = '(%s) IS DISTINCT FROM (%s)' % (
+                ', '.join('s.%s' % m for m in msrs),
+                ', '.join('b.%s' % m for m in msrs))
+            nb_update = self.execute_count(stm % fmt + ' WHERE ' + changed)
+            upsert = 'DO UPDATE SET %s WHERE (%s) IS DISTINCT FROM (%s)' % (
+                ', '.join('%s = excluded.%s' % (m, m) for m in msrs),
+                ', '.join('"%s".%s' % (space._table, m) for m in msrs),
+                ', '.join('excluded.%s' % m for m in msrs))
+        self.execute(
+            'INSERT INTO "%(spc)s" (%(fields)s) '
+            'SELECT %(fields)s FROM menger_staging '
+            'ON CONFLICT (%(dims)s) %(upsert)s' % dict(fmt, upsert=upsert))
+
+        # Remove rows whose values are all zero
+        nonzero = self.nonzero_cond(space._db_measures)
+        if nonzero:
+            self.execute(
+                'DELETE FROM "%(spc)s" WHERE (%(dims)s) IN ('
+                'SELECT (%(dims)s) FROM menger_staging) '
+                'AND NOT (%(nonzero)s)' % dict(fmt, nonzero=nonzero))
+        self.execute('DROP TABLE menger_staging')
+        return nb_rows - nb_found, nb_update
+
+    def create_coordinate(self, dim, name, parent_id=None):
+        # Fill dimension table
+        last_id, = self.execute(
+            'INSERT INTO "%s" (name) VALUES (?) RETURNING id' % dim.table,
+            (name,)).fetchone()
+
+        # New coordinate share same parents than parent_id but at one
+        # more depth, plus a self reference (statements are costly,
+        # both are inserted at once)
+        stm = 'INSERT INTO "%(cls)s" (parent, child, depth) '\
+              'SELECT parent, ? as child, depth+1 FROM "%(cls)s" ' \
+              'WHERE child = ? UNION ALL SELECT ?, ?, 0' % {
+                  'cls': dim.closure_table}
+        self.execute(stm, (last_id, parent_id, last_id, last_id))
+        return last_id
+
+    def delete_coordinate(self, dim, coord_id):
+        from menger.space import iter_spaces
+
+        fmt = {
+            'dim': dim.table,
+            'cls': dim.closure_table,
+        }
+        subtree = 'SELECT child FROM "%(cls)s" WHERE parent = %(id)s' % dict(
+            fmt, id=int(coord_id))
+        for space in iter_spaces():
+            sdim = getattr(space, dim.name, None)
+            if sdim is None or getattr(sdim, 'table', None) != dim.table:
+                continue
+            parts = space.partitions() if space._partition_by else []
+            for spc in [space] + parts:
+                self.execute('DELETE FROM "%s" WHERE "%s" IN (%s)' % (
+                    spc._table, dim.name, subtree))
+        ids = [i for i, in self.execute(subtree).fetchall()]
+        self.delete_ids(dim, ids)
+
+    def prune(self, dim, parent_id):
+        self.execute(
+            'SELECT count(*) FROM %(cls)s '
+            'WHERE parent = ? and depth = 1' % {'cls': dim.closure_table},
+            (parent_id,)
+        )
+        cnt, = self.cursor.fetchone()
+        if cnt == 0:
+            self.delete_ids(dim, [parent_id])
+
+    def delete_ids(self, dim, ids):
+        'Delete the coordinates ids and their closure rows'
+        if not ids:
+            return
+        ids = ','.join(str(int(i)) for i in ids)
+        self.execute('DELETE FROM "%s" WHERE child IN (%s) OR parent IN (%s)'
+                     % (dim.closure_table, ids, ids))
+        self.execute('DELETE FROM "%s" WHERE id IN (%s)' % (dim.table, ids))
+
+    def stream(self, stm, params):
+        # Temporary tables are not visible from other cursors, rows are
+        # fetched at once
+        yield from self.execute(stm, params).fetchall()
+
+    def dice_join_arrow(self, queries, nb_dims, filters=None):
+        'Like dice_join but return the result as an Arrow table'
+        import pyarrow
+
+        stm, params = self.dice_join_query(queries, nb_dims, filters)
+        table = self.execute(stm, params).arrow()
+        # Sums of integers are 128 bits integers, seen as decimals
+        for pos, field in enumerate(table.schema):
+            if pyarrow.types.is_decimal(field.type) and field.type.scale == 0:
+                table = table.set_column(
+                    pos, field.name, table.column(pos).cast(pyarrow.int64()))
+        return table
+
+    def partition_ids(self, space):
+        prefix = space._table + '_p'
+        self.execute(
+            'SELECT table_name FROM information_schema.tables '
+            'WHERE starts_with(table_name, ?)', (prefix,))
+        names = (name for name, in self.cursor.fetchall())
+        return [int(name[len(prefix):]) for name in names
+                if name[len(prefix):].isdigit()]
+
+    def close(self, rollback=False):
+        # Temporary tables are dropped with the connection
+        self.nb_tmp = 0
+        if rollback:
+            self.connection.rollback()
+        else:
+            self.connection.commit()
+
+        self.connection.close()
+
+    def get_columns_info(self, name):
+        stm = 'SELECT column_name, lower(data_type) ' \
+              'FROM information_schema.columns WHERE table_name = ? ' \
+              'ORDER BY ordinal_position'
+        tables = set(t for t, in self.execute(
+            'SELECT table_name FROM information_schema.tables').fetchall())
+        for col_name, col_type in self.execute(
+                stm, (name + '_spc',)).fetchall():
+            col_type = {'double': 'float'}.get(col_type, col_type)
+            if col_name + '_dim' not in tables:
+                yield col_name, 'measure', col_type, None
+                continue
+            depth, = self.execute('SELECT max(depth) FROM "%s"' % (
+                col_name + '_cls')).fetchone()
+            yield col_name, 'dimension', 'integer', depth
@@ -1,204 +1,245 @@
 from io import StringIO
-from itertools import chain
-from .sql import SqlBackend
+from itertools import chain, count, islice
+import re
+
 import psycopg2
 
+from .sql import SqlBackend, LoadType
+
+# Placeholders used by the generic queries
+PARAM_RE = re.compile(r'\?|(?<![:\w]):(\w+)')
+SQL_TYPES = {
+    'blob': 'bytea',
+    'float': 'double precision',
+}
+# Types reported by information_schema
+GENERIC_TYPES = {
+    'bytea': 'blob',
+    'double precision': 'float',
+    'character varying': 'varchar',
+}
+CURSOR_IDS = count()
+
+
+def translate(query, args):
+    '''
+    Convert the qmark and named placeholders of query to the pyformat
+    style used by psycopg2.
+    '''
+    if args is None:
+        return query
+    query = query.replace('%', '%%')
+    return PARAM_RE.sub(
+        lambda m: '%s' if m.group(1) is None else '%%(%s)s' % m.group(1),
+        query)
+
+
+def copy_value(value):
+    'Format value for the text format of COPY'
+    if value is None:
+        return r'\N'
+    if isinstance(value, bytes):
+        return '\\\\x' + value.hex()
+    return str(value)
+
 
 class PGBackend(SqlBackend):
 
+    serial_type = 'SERIAL PRIMARY KEY'
+    row_id = 'ctid'
+    # Number of rows fetched at once by server-side cursors
+    itersize = 10000
+    # Number of points copied at once
+    batch_size = 100000
+
     def __init__(self, connection_string):
         self.connection = psycopg2.connect(connection_string)
         self.cursor = self.connection.cursor()
+        self.nb_tmp = 0
         super(PGBackend, self).__init__()
 
-    def register(self, space):
-        create_idx = 'CREATE UNIQUE INDEX %s_parent_child_index'\
-            ' on %s (parent, child)'
-
-        for dim in space._dimensions:
-            # Dimension table
-            self.cursor.execute(
-                'CREATE TABLE IF NOT EXISTS %s (id SERIAL PRIMARY KEY,'
-                'name %s)' % (dim.table, dim.sql_type))
-
-            # Closure table for the dimension
-            self.cursor.execute(
-                'CREATE TABLE IF NOT EXISTS %s ('
-                'parent INTEGER references %s (id), '
-                'child INTEGER references %s (id), '
-                'depth INTEGER)' % (dim.closure_table, dim.table,
-                                    dim.table))
-
-            self.cursor.execute(
-                "SELECT 1 FROM pg_indexes "
-                "WHERE tablename = %s AND indexname = %s",
-                (dim.closure_table, dim.closure_table + '_parent_child_index',))
-
-            if not self.cursor.fetchall():
-                self.cursor.execute(create_idx % (
-                    dim.closure_table, dim.closure_table))
-
-        # Space (main) table
-        cols = ','.join(chain(
-            ('"%s" INTEGER NOT NULL references %s (id)' % (
-                d.name, d.table
-            ) for d in space._dimensions),
-            ('"%s" %s NOT NULL' % (m.name, m.sql_type) for m in space._measures)
-        ))
-
-        query = 'CREATE TABLE IF NOT EXISTS %s (%s)' % (space._table, cols)
-        self.cursor.execute(query)
-
-        # Read existing indexes
-        self.cursor.execute(
-            "SELECT indexname FROM pg_indexes WHERE tablename = %s",
-            (space._table,))
-        all_idx = [x[0] for x in self.cursor.fetchall()]
-
-        # Create index covering all dimensions
-        idx_name = '%s_dim_index' % space._table
-        if idx_name not in all_idx:
-            self.cursor.execute(
-            'CREATE UNIQUE INDEX %s on %s (%s)' % (
-                idx_name,
-                space._table,
-                ' ,'.join(d.name for d in space._dimensions)
-                )
-            )
-
-        # Create one index per dimension
-        for d in space._dimensions:
-            idx_name = '%s_%s_index' % (space._table, d.name)
-            if idx_name not in all_idx:
-                self.cursor.execute(
-                    'CREATE INDEX %s on %s ("%s")' % (
-                        idx_name, space._table, d.name)
-                    )
-
-        measures = [m.name for m in space._measures]
-        dimensions = [d.name for d in space._dimensions]
-
-        # get_stm
-        select = ', '.join(measures)
-        dim_where = 'WHERE ' \
-            + ' AND '.join('"%s" = %%s' % d for d in dimensions)
-        self.get_stm[space._name] = 'SELECT %s FROM %s %s' % (
-            select, space._table, dim_where)
-
-        # update_stm
-        set_stm = ','.join('"%s" = %%s' % m for m in measures)
-        clause = ' and '.join('"%s" = %%s' % d for d in dimensions)
-        self.update_stm[space._name] = 'UPDATE %s SET %s WHERE %s' % (
-            space._table, set_stm, clause)
-
-        #insert_stm
-        fields = tuple(chain(dimensions, measures))
-        field_stm = ','.join('"%s"' % f for f in fields)
-        val_stm = ','.join('%s' for f in fields)
-        self.insert_stm[space._name] = 'INSERT INTO %s (%s) VALUES (%s)' % (
-            space._table, field_stm, val_stm)
-
-    def create_coordinate(self, dim, name, parent_id):
+    def execute(self, query, args=None):
+        self.cursor.execute(translate(query, args), args)
+        return self.cursor
+
+    def executemany(self, query, seq):
+        seq = list(seq)
+        if seq:
+            self.cursor.executemany(translate(query, seq[0]), seq)
+        return self.cursor
+
+    def sql_type(self, sql_type):
+        return SQL_TYPES.get(sql_type, sql_type)
+
+    def load(self, space, keys_vals, load_type=None):
+        '''
+        Copy keys_vals in a staging table (by batches of batch_size
+        points) and upsert it in the space table with one statement.
+        '''
+        dims = ['"%s"' % d.name for d in space._dimensions]
+        msrs = ['"%s"' % m.name for m in space._db_measures]
+        fields = dims + msrs
+        staging = 'tmp_%s' % self.nb_tmp
+        self.nb_tmp += 1
+        cols = chain(
+            ('"%s" %s' % (d.name, 'INTEGER' if d.table
+                          else self.sql_type(d.sql_type))
+             for d in space._dimensions),
+            ('"%s" %s' % (m.name, self.sql_type(m.sql_type))
+             for m in space._db_measures),
+        )
+        self.execute('CREATE TEMPORARY TABLE %s (_seq SERIAL, %s)' % (
+            staging, ', '.join(cols)))
+
+        copy = 'COPY %s (%s) FROM STDIN' % (staging, ', '.join(fields))
+        rows = iter(keys_vals)
+        while True:
+            buff = StringIO()
+            for key, vals in islice(rows, self.batch_size):
+                buff.write('\t'.join(map(copy_value, chain(key, vals))))
+                buff.write('\n')
+            if not buff.tell():
+                break
+            buff.seek(0)
+            self.cursor.copy_expert(copy, buff)
+
+        # A row can not be upserted twice by the same statement,
+        # duplicate keys are merged first
+        fmt = {
+            'spc': space._table,
+            'staging': staging,
+            'dims': ', '.join(dims),
+            'fields': ', '.join(fields),
+        }
+        if load_type == LoadType.increment:
+            select = 'SELECT %(dims)s, %(aggs)s FROM %(staging)s ' \
+                     'GROUP BY %(dims)s'
+            fmt['aggs'] = ', '.join(
+                m.sql_agg(col) for m, col in zip(space._db_measures, msrs))
+            upsert = self.upsert(space)
+        else:
+            # Row-by-row loading keeps the first value when creating
+            # only, the last one otherwise
+            select = 'SELECT DISTINCT ON (%(dims)s) %(fields)s ' \
+                     'FROM %(staging)s ORDER BY %(dims)s, _seq %(order)s'
+            fmt['order'] = 'ASC' if load_type == LoadType.create_only \
+                           else 'DESC'
+            upsert = 'DO NOTHING'
+            if load_type != LoadType.create_only and msrs:
+                upsert = 'DO UPDATE SET %s WHERE (%s) IS DISTINCT FROM ' \
+                         '(%s)' % (
+                             ', '.join('%s = excluded.%s' % (m, m)
+                                       for m in msrs),
+                             ', '.join('"%s".%s' % (space._table, m)
+                                       for m in msrs),
+                             ', '.join('excluded.%s' % m for m in msrs))
+
+        # xmax is zero on freshly inserted rows
+        stm = 'WITH up AS (' \
+              'INSERT INTO "%(spc)s" (%(fields)s) ' + select + ' ' \
+              'ON CONFLICT (%(dims)s) %(upsert)s ' \
+              'RETURNING (xmax = 0) AS inserted) ' \
+              'SELECT count(*) FILTER (WHERE inserted), ' \
+              'count(*) FILTER (WHERE NOT inserted) FROM up'
+        nb_insert, nb_update = self.execute(
+            stm % dict(fmt, upsert=upsert)).fetchone()
+
+        # Remove rows whose values are all zero
+        nonzero = self.nonzero_cond(space._db_measures)
+        if nonzero:
+            self.execute(
+                'DELETE FROM "%(spc)s" WHERE (%(dims)s) IN ('
+                'SELECT %(dims)s FROM %(staging)s) AND NOT (%(nonzero)s)' % (
+                    dict(fmt, nonzero=nonzero)))
+        self.execute('DROP TABLE %s' % staging)
+        self.nb_tmp -= 1
+        return nb_insert, nb_update
+
+    def create_coordinate(self, dim, name, parent_id=None):
         # Fill dimension table
-        self.cursor.execute(
-            'INSERT into %s (name) VALUES (%%s) RETURNING id' % dim.table,
-            (name,))
-
-        last_id = self.cursor.next()[0]
-
-        # Update closure table
-        self.cursor.execute(
-            'INSERT INTO %s (parent, child, depth) '
-            'SELECT parent, %%s, depth+1 FROM %s '
-            'WHERE child = %%s' % (
-                dim.closure_table, dim.closure_table), (last_id, parent_id))
-
-        # Add new coordinate
-        self.cursor.execute('INSERT INTO %s (parent, child, depth) '
-                            'VALUES (%%s, %%s, %%s)' % dim.closure_table,
-                            (last_id, last_id, 0))
+        last_id, = self.execute(
+            'INSERT INTO "%s" (name) VALUES (?) RETURNING id' % dim.table,
+            (name,)).fetchone()
+
+        # New coordinate share same parents than parent_id but at one
+        # more depth
+        stm = 'INSERT INTO "%(cls)s" (parent, child, depth) '\
+              'SELECT parent, ? as child, depth+1 FROM "%(cls)s" ' \
+              'WHERE child = ?' % {'cls': dim.closure_table}
+        self.execute(stm, (last_id, parent_id))
+
+        # Add self reference
+        stm = 'INSERT INTO "%(cls)s" (parent, child, depth) '\
+              'VALUES (?, ?, ?)' % {'cls': dim.closure_table}
+        self.execute(stm, (last_id, last_id, 0))
         return last_id
 
-    def get_children(self, dim, parent_id):
-        if parent_id is None:
-            stm = "SELECT name, id from %s where name is null" % dim.table
-            args = tuple()
+    def dice(self, space, fields, filters=[], having=None):
+        stm, params = self.dice_query(space, fields, filters, having=having)
+        return self.stream(stm, params)
+
+    def stream(self, stm, params):
+        '''
+        Execute stm in a server-side cursor, rows are fetched by
+        batches of itersize.
+        '''
+        cursor = self.connection.cursor('menger_%s' % next(CURSOR_IDS))
+        cursor.itersize = self.itersize
+        cursor.execute(translate(stm, params), params)
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    def partition_ids(self, space):
+        prefix = space._table + '_p'
+        self.execute(
+            'SELECT tablename FROM pg_tables '
+            'WHERE schemaname = current_schema() AND tablename LIKE ?',
+            (prefix.replace('_', r'\_') + '%',))
+        names = (name for name, in self.cursor.fetchall())
+        return [int(name[len(prefix):]) for name in names
+                if name[len(prefix):].isdigit()]
+
+    def index_names(self, table):
+        self.execute(
+            'SELECT indexname FROM pg_indexes '
+            'WHERE schemaname = current_schema() AND tablename = ?',
+            (table,))
+        return [name for name, in self.cursor.fetchall()]
+
+    def close(self, rollback=False):
+        # Temporary tables are dropped with the session
+        self.nb_tmp = 0
+        if rollback:
+            self.connection.rollback()
         else:
-            stm = 'SELECT d.name, d.id ' \
-                'FROM %s AS c JOIN %s AS d ON (c.child = d.id) '\
-                'WHERE c.depth = 1 AND c.parent = %%s' % (
-                    dim.closure_table, dim.table)
-            args = (parent_id,)
-
-        self.cursor.execute(stm, args)
-        return self.cursor
+            self.connection.commit()
 
-    def get_parents(self, dim):
-        stm = "SELECT id, name, parent FROM %s"\
-            " JOIN %s ON (child = id) WHERE depth = 1"\
-            %(dim.table, dim.closure_table)
-        self.cursor.execute(stm)
-        return self.cursor.fetchall()
-
-    def dice(self, space, cube, msrs):
-        select = []
-        joins = []
-        where = []
-        group_by = []
-        params = {}
-
-        for dim, coord, depth in cube:
-            params[dim.name] = coord
-            joins.append(self.child_join(space, dim))
-            f = '%s.parent'% (dim.closure_table)
-            select.append(f)
-            group_by.append(f)
-            params[dim.name + '_depth'] = depth
-
-        select.extend('sum(%s)' % m.name for m in msrs)
-        stm = 'SELECT %s FROM %s' % (', '.join(select), space._table)
-
-        if joins:
-            stm += ' ' + ' '.join(joins)
-        if where:
-            stm += ' WHERE ' +  ' AND '.join(where)
-        if group_by:
-            stm += ' GROUP BY ' + ', '.join(group_by)
-
-        self.cursor.execute(stm, params)
-        return self.cursor.fetchall()
-
-    def child_join(self, spc, dim):
-        closure = dim.closure_table
-        join = 'JOIN %s ON (%s.child = %s.%s'\
-               ' AND %s.parent IN (SELECT child from %s'\
-               ' WHERE parent = %%(%s)s'\
-               ' AND depth = %%(%s)s))'\
-               % (closure, closure, spc._table, dim.name, closure, closure,
-                  dim.name, dim.name + '_depth')
-        return join
-
-    def close(self):
-        self.connection.commit()
         self.connection.close()
 
     def get_columns_info(self, name):
-        stm = "SELECT constraint_name " \
-            "from information_schema.table_constraints" \
-            " where table_name = '%s' and constraint_type = 'FOREIGN KEY'"
-        self.cursor.execute(stm % name)
-        fk = set(x[0] for x in self.cursor.fetchall())
-
-        stm = 'SELECT column_name, data_type '\
-            "from information_schema.columns where table_name=%s"
-        self.cursor.execute(stm, (name,))
-
-        for col_name, col_type in self.cursor.fetchall():
-            if '%s_%s_fkey' % (name, col_name) in fk:
-                self.cursor.execute(stm % col_name + '_dim')
-                for dim_col, dim_type in self.cursor.fetchall():
-                    if dim_col == 'name':
-                        yield col_name, 'dimension', dim_type
-                        break
-            else:
-                yield col_name, 'measure', col_type
+        name = name + '_spc'
+        stm = 'SELECT kcu.column_name ' \
+              'FROM information_schema.table_constraints AS tc ' \
+              'JOIN information_schema.key_column_usage AS kcu ' \
+              'ON (kcu.constraint_name = tc.constraint_name) ' \
+              "WHERE tc.table_name = ? AND constraint_type = 'FOREIGN KEY'"
+        fk = set(x for x, in self.execute(stm, (name,)).fetchall())
+
+        stm = 'SELECT column_name, data_type ' \
+              'FROM information_schema.columns WHERE table_name = ? ' \
+              'ORDER BY ordinal_position'
+        for col_name, col_type in self.execute(stm, (name,)).fetchall():
+            col_type = GENERIC_TYPES.get(col_type, col_type)
+            if col_name not in fk:
+                yield col_name, 'measure', col_type, None
+                continue
+            depth, = self.execute('SELECT max(depth) FROM "%s"' % (
+                col_name + '_cls')).fetchone()
+            for dim_col, dim_type in self.execute(
+                    stm, (col_name + '_dim',)).fetchall():
+                if dim_col != 'name':
+                    dim_type = GENERIC_TYPES.get(dim_type, dim_type)
+                    yield col_name, 'dimension', dim_type, depth
+                    break
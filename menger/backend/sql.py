@@ -1,10 +1,20 @@
 from collections import defaultdict
+from contextlib import contextmanager
 from enum import Enum
-from itertools import tee
-from operator import add
+from itertools import chain, tee
 
 from .base import BaseBackend
 
+HAVING_OPS = ('=', '!=', '<', '<=', '>', '>=')
+
+def format_query(stm, params):
+    if isinstance(params, dict):
+        for k, v in params.items():
+            stm = stm.replace(':' + k, str(v))
+        return stm
+    return stm.replace('?', '%s') % params
+
+
 class LoadType(Enum):
     default = 0
     increment = 1
@@ -12,9 +22,69 @@ class LoadType(Enum):
 
 class SqlBackend(BaseBackend):
 
+    # Column definition of generated ids and name of the physical row
+    # identifier
+    serial_type = 'INTEGER PRIMARY KEY'
+    row_id = 'rowid'
+    # Read-only connections do not write profile hits
+    readonly = False
+    # Whether indexes covering the measures speed up dice queries
+    covering_indexes = True
+
     def __init__(self):
         self.init_done = set()
         self.stm = defaultdict(dict)
+        # Names of the spaces registered on this connection
+        self.registered = set()
+
+    def execute(self, query, args=None):
+        raise NotImplementedError
+
+    def executemany(self, query, seq):
+        raise NotImplementedError
+
+    def execute_count(self, query, args=None):
+        'Execute query and return the number of affected rows'
+        return self.execute(query, args).rowcount
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def drop_tmp_tables(self):
+        'Drop the temporary tables created by the previous queries'
+        for i in range(self.nb_tmp):
+            self.execute('DROP TABLE IF EXISTS tmp_%s' % i)
+        self.nb_tmp = 0
+
+    def references(self, table):
+        'Return the constraint of a column referencing the ids of table'
+        return 'REFERENCES "%s" (id) ON DELETE CASCADE' % table
+
+    def serial(self, table):
+        'Return the definition of the generated id column of table'
+        return self.serial_type
+
+    def sql_type(self, sql_type):
+        'Translate the generic column types used by dimensions and measures'
+        return sql_type
+
+    def install_functions(self):
+        pass
+
+    def init_dimension(self, dim):
+        'Hook called when the tables of dim are created'
+        pass
+
+    @contextmanager
+    def bulk_load(self, space):
+        '''
+        Context manager wrapping trusted loads of space, backends may
+        relax their integrity checks.
+        '''
+        yield
 
     def load(self, space, keys_vals, load_type=None):
         nb_insert = nb_update = 0
@@ -26,7 +96,8 @@ class SqlBackend(BaseBackend):
             elif load_type == LoadType.create_only:
                 continue
             elif load_type == LoadType.increment:
-                vals = tuple(map(add, db_vals, vals))
+                vals = tuple(m.increment(old, new) for m, old, new in zip(
+                    space._db_measures, db_vals, vals))
                 self.update(space, key, vals)
                 nb_update += 1
             elif db_vals != vals:
@@ -38,19 +109,1170 @@ class SqlBackend(BaseBackend):
         return nb_insert, nb_update
 
     def get(self, space, key):
-        self.cursor.execute(self.stm[space._name]['get'], key)
+        self.execute(self.stm[space._name]['get'], key)
         return self.cursor.fetchone()
 
+    def is_zero(self, space, vals):
+        return all(m.is_zero(v) for m, v in zip(space._db_measures, vals))
+
     def update(self, space, key, vals):
-        if any(vals):
-            self.cursor.execute(self.stm[space._name]['update'], vals + key)
+        if not self.is_zero(space, vals):
+            self.execute(self.stm[space._name]['update'], vals + key)
         else:
             # Delete row of all values are zero
-            self.cursor.execute(self.stm[space._name]['delete'], key)
+            self.execute(self.stm[space._name]['delete'], key)
 
     def insert(self, space, key, vals):
-        if not any(vals):
+        if self.is_zero(space, vals):
             # Skip if all values are zero
             return
-        self.cursor.execute(self.stm[space._name]['insert'], key + vals)
+        self.execute(self.stm[space._name]['insert'], key + vals)
+
+    def init_tables(self, space, ghost=False):
+        if space._name in self.init_done:
+            return
+        self.init_done.add(space._name)
+
+        for dim in space._dimensions:
+            if dim.table is None:
+                continue
+            # Dimension table
+            self.execute(
+                'CREATE TABLE IF NOT EXISTS "%s" ( '
+                'id %s, '
+                'name %s)' % (dim.table, self.serial(dim.table),
+                              self.sql_type(dim.sql_type)))
+
+            # Closure table for the dimension
+            self.execute(
+                'CREATE TABLE IF NOT EXISTS "%s" ('
+                'parent INTEGER %s NOT NULL, '
+                'child INTEGER %s NOT NULL, '
+                'depth INTEGER)' % (dim.closure_table,
+                                    self.references(dim.table),
+                                    self.references(dim.table)))
+
+            # Child lookups filter on the parent, the depth and the child
+            # (selected by name)
+            self.execute(
+                'CREATE INDEX IF NOT EXISTS %s_parent_idx '
+                'ON %s (parent, depth, child)' % (
+                    dim.closure_table, dim.closure_table)
+            )
+            # Superseded by the index above
+            self.execute('DROP INDEX IF EXISTS %s_idx' % dim.closure_table)
+            self.execute(
+                'CREATE INDEX IF NOT EXISTS %s_child_idx '
+                'ON %s (child, depth)' % (dim.closure_table, dim.closure_table)
+            )
+
+            # Index names for glob and search
+            self.execute(
+                'CREATE INDEX IF NOT EXISTS %s_name_idx '
+                'ON %s (name)' % (dim.table, dim.table)
+            )
+            self.init_dimension(dim)
+
+        # Space (main) table, dimensions without table (ranges) store
+        # their values directly
+        cols = ', '.join(chain(
+            ('"%s" INTEGER %s NOT NULL ' % (
+                dim.name, self.references(dim.table)
+            ) if dim.table else '"%s" %s NOT NULL' % (
+                dim.name, self.sql_type(dim.sql_type))
+             for dim in space._dimensions),
+            ('"%s" %s NOT NULL' % (msr.name, self.sql_type(msr.sql_type)) \
+             for msr in space._db_measures)
+        ))
+        query = 'CREATE TABLE IF NOT EXISTS "%s" (%s)' % (
+            space._table, cols)
+        self.execute(query)
+
+        # Create index covering all dimensions
+        self.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS %s_index ON "%s" (%s)' % (
+                space._table,
+                space._table,
+                ', '.join(d.name for d in space._dimensions)
+                )
+            )
+
+        # Index range columns
+        for dim in space._dimensions:
+            if dim.table is not None:
+                continue
+            self.execute(
+                'CREATE INDEX IF NOT EXISTS %s_%s_range ON "%s" (%s)' % (
+                    space._table, dim.name, space._table, dim.name))
+
+        # Index version column to select the latest version
+        vdim = space._versioned
+        if vdim is not None and vdim is not space._dimensions[0] \
+           and space._partition_by != vdim.name:
+            self.execute(
+                'CREATE INDEX IF NOT EXISTS %s_version_idx ON "%s" (%s)' % (
+                    space._table, space._table, vdim.name))
+
+        # Clean old (weak) indexes
+        for d in space._dimensions:
+            self.execute(
+                'DROP INDEX IF EXISTS %s_%s_index' % (
+                    space._table,
+                    d.name,
+                    )
+                )
+
+        if ghost:
+            # No need for profile table
+            return
+
+        # Profile table
+        pfl_cols = [
+            '_id %s' % self.serial(space._pfl_table),
+            '_hits INTEGER',
+            '_size INTEGER',
+        ]
+        pfl_cols.extend('%s INTEGER' % d.name for d in space._dimensions)
+        query = 'CREATE TABLE IF NOT EXISTS "%s" (%s)'% (
+            space._pfl_table,
+            ', '.join(pfl_cols),
+        )
+        self.execute(query)
+
+        # Create index on profile table
+        self.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS %s_index ON "%s" (%s)' % (
+                space._pfl_table,
+                space._pfl_table,
+                ', '.join(d.name for d in space._dimensions)
+                )
+            )
+
+    def register(self, space, init=False, ghost=False):
+        if init:
+            self.init_tables(space, ghost=ghost)
+
+        # If the space is already known, nothing to do
+        if space._name in self.stm:
+            return
+
+        stm_dict = self.stm[space._name]
+        measures = [m.name for m in space._db_measures]
+        dimensions = [d.name for d in space._dimensions]
+
+        # get statement
+        select = ', '.join(measures)
+        dim_where = 'WHERE ' + ' AND '.join('"%s" = ?' % d for d in dimensions)
+        stm_dict['get'] = 'SELECT %s FROM "%s" %s' % (
+            select, space._table, dim_where)
+
+        # update statement
+        set_stm = ', '.join('"%s" = ?' % m for m in measures)
+        clause = ' and '.join('"%s" = ?' % d for d in dimensions)
+        stm_dict['update'] = 'UPDATE "%s" SET %s WHERE %s' % (
+            space._table, set_stm, clause)
+
+        #insert statement
+        fields = tuple(chain(dimensions, measures))
+
+        val_stm = ', '.join('?' for f in fields)
+        field_stm = ', '.join(fields)
+        stm_dict['insert'] = 'INSERT INTO "%s" (%s) VALUES (%s)' % (
+            space._table, field_stm, val_stm)
+
+        #delete statement
+        cond_stm = ' AND '.join('%s = ?' % d for d in dimensions)
+        stm_dict['delete'] = 'DELETE FROM "%s" WHERE %s' % (
+            space._table, cond_stm)
+
+    def delete_coordinate(self, dim, coord_id):
+        self.execute(
+            'DELETE FROM %(dim)s WHERE id IN '
+            '(SELECT CHILD FROM %(cls)s WHERE parent = ?)' % {
+                'dim': dim.table,
+                'cls': dim.closure_table
+            }, (coord_id,))
+
+
+    def reparent(self, dim, child, new_parent):
+        """
+        Move child from his current parent to the new one.
+        """
+        cls = dim.closure_table
+
+        # Detach child
+        self.execute(
+            'DELETE FROM %s '
+            'WHERE child IN (SELECT child FROM %s where parent = ?) '
+            'AND parent NOT IN (SELECT child FROM %s WHERE parent = ?)' % (
+                cls, cls, cls
+            ),
+            (child, child)
+        )
+
+        # Set new parent
+        self.execute(
+            'SELECT supertree.parent, subtree.child, '
+            'supertree.depth + subtree.depth + 1 '
+            'FROM %s AS supertree CROSS JOIN %s AS subtree '
+            'WHERE subtree.parent = ? '
+            'AND supertree.child = ?' % (cls, cls),
+            (child, new_parent)
+        )
+        values = list(self.cursor)
+        self.executemany(
+            'INSERT INTO %s (parent, child, depth) values (?, ?, ?)' % cls,
+            values
+        )
+
+    def merge(self, dim, parent_ids, spaces):
+        '''
+        Merge subtrees: if one name appears more than once under one
+        of the parents, the node with the smallest id is kept and the
+        other ones are merged into it, recursively on their children.
+        All the duplicate pairs are computed in one query and each
+        space is updated with one statement. Returns the number of
+        rows moved in the spaces.
+        '''
+        nb_moved = 0
+        parent_ids = list(parent_ids)
+        # Loop in case merged subtrees contain duplicates between them
+        while parent_ids:
+            pairs = self.merge_pairs(dim, parent_ids)
+            self.execute('SELECT DISTINCT keep_id FROM %s' % pairs)
+            parent_ids = [keep_id for keep_id, in self.cursor]
+            if not parent_ids:
+                break
+
+            # Update spaces to use kept ids
+            for space in spaces:
+                if not hasattr(space, dim.name):
+                    continue
+                parts = [space]
+                if space._partition_by:
+                    parts = space.partitions()
+                for part in parts:
+                    nb_moved += self.merge_space(part, dim, pairs)
+
+            # Attach children of dropped nodes to kept ones and clean
+            # old records
+            self.execute(
+                'UPDATE "%(cls)s" SET parent = ('
+                'SELECT keep_id FROM %(pairs)s WHERE drop_id = parent) '
+                'WHERE parent IN (SELECT drop_id FROM %(pairs)s)' % {
+                    'cls': dim.closure_table,
+                    'pairs': pairs,
+                })
+            self.execute(
+                'DELETE FROM "%(cls)s" WHERE child IN ('
+                'SELECT drop_id FROM %(pairs)s)' % {
+                    'cls': dim.closure_table,
+                    'pairs': pairs,
+                })
+            self.execute(
+                'DELETE FROM "%(dim)s" WHERE id IN ('
+                'SELECT drop_id FROM %(pairs)s)' % {
+                    'dim': dim.table,
+                    'pairs': pairs,
+                })
+
+        # Rows may have to change of partition
+        for space in spaces:
+            if space._partition_by == dim.name:
+                self.repartition(space)
+
+        return nb_moved
+
+    def repartition(self, space):
+        '''
+        Move the rows of a partitioned space whose coordinate changed
+        of first level ancestor to the matching partition, emptied
+        partitions are dropped.
+        '''
+        dim = space.get_dimension(space._partition_by)
+        cols = ['"%s"' % d.name for d in space._dimensions]
+        msrs = ['"%s"' % m.name for m in space._db_measures]
+        fmt = {
+            'cls': dim.closure_table,
+            'col': dim.name,
+            'root': dim.key(tuple()),
+            'cols': ', '.join(cols),
+            'fields': ', '.join(cols + msrs),
+        }
+        for part in space.partitions():
+            fmt.update(src=part._table, part_id=part._partition_id)
+            self.execute(
+                'SELECT DISTINCT top.child FROM "%(src)s" '
+                'JOIN "%(cls)s" AS cls ON (cls.child = "%(src)s"."%(col)s") '
+                'JOIN "%(cls)s" AS top ON ('
+                'top.child = cls.parent AND top.parent = %(root)s '
+                'AND top.depth = 1) '
+                'WHERE top.child != %(part_id)s' % fmt)
+            for top_id, in self.cursor.fetchall():
+                fmt['dst'] = space.partition(top_id)._table
+                fmt['upsert'] = self.upsert(space, fmt['dst'])
+                fmt['cond'] = '"%(col)s" IN (SELECT child FROM "%(cls)s" ' \
+                              'WHERE parent = %(top)s)' % dict(fmt, top=top_id)
+                self.execute(
+                    'INSERT INTO "%(dst)s" (%(fields)s) '
+                    'SELECT %(fields)s FROM "%(src)s" WHERE %(cond)s '
+                    'ON CONFLICT (%(cols)s) %(upsert)s' % fmt)
+                self.execute('DELETE FROM "%(src)s" WHERE %(cond)s' % fmt)
+            if self.size(part) == 0:
+                self.drop(part)
+
+    def merge_pairs(self, dim, parent_ids):
+        '''
+        Create a temporary table containing all the (keep_id, drop_id)
+        pairs to merge in the subtrees of parent_ids. Returns the table
+        name.
+        '''
+        alias = 'tmp_%s' % self.nb_tmp
+        self.nb_tmp += 1
+        self.execute(
+            'CREATE TEMPORARY TABLE %(tmp)s AS '
+            'WITH RECURSIVE pairs(keep_id, drop_id) AS ('
+              # Duplicates under parents
+              'SELECT first.id, other.id FROM ('
+                'SELECT parent, name, min(child) AS id '
+                'FROM "%(cls)s" JOIN "%(dim)s" ON (child = id) '
+                'WHERE depth = 1 AND parent IN (%(parents)s) '
+                'GROUP BY parent, name HAVING count(*) > 1'
+              ') AS first '
+              'JOIN "%(cls)s" AS cls ON ('
+                'cls.parent = first.parent AND cls.depth = 1) '
+              'JOIN "%(dim)s" AS other ON ('
+                'other.id = cls.child AND other.name = first.name '
+                'AND other.id != first.id) '
+              'UNION '
+              # Children of merged nodes sharing the same name
+              'SELECT kd.id, dd.id FROM pairs '
+              'JOIN "%(cls)s" AS kc ON (kc.parent = keep_id AND kc.depth = 1) '
+              'JOIN "%(dim)s" AS kd ON (kd.id = kc.child) '
+              'JOIN "%(cls)s" AS dc ON (dc.parent = drop_id AND dc.depth = 1) '
+              'JOIN "%(dim)s" AS dd ON ('
+                'dd.id = dc.child AND dd.name = kd.name)'
+            ') SELECT keep_id, drop_id FROM pairs' % {
+                'tmp': alias,
+                'cls': dim.closure_table,
+                'dim': dim.table,
+                'parents': ','.join(map(str, parent_ids)),
+            })
+        return alias
+
+    def merge_space(self, space, dim, pairs):
+        '''
+        Move rows of space from dropped ids to kept ids (as listed in
+        the pairs table), values are aggregated with existing rows.
+        '''
+        cols = ['"%s"' % d.name for d in space._dimensions]
+        msrs = ['"%s"' % m.name for m in space._db_measures]
+        group_by = ['%s.keep_id' % pairs if d.name == dim.name
+                    else '"%s"."%s"' % (space._table, d.name)
+                    for d in space._dimensions]
+        # Rows dropped in favor of the same kept id are aggregated
+        # first, a row can not be upserted twice by one statement
+        select = group_by + [
+            m.sql_agg('"%s".%s' % (space._table, col))
+            for m, col in zip(space._db_measures, msrs)]
+        fmt = {
+            'spc': space._table,
+            'col': dim.name,
+            'pairs': pairs,
+            'cols': ', '.join(cols),
+            'fields': ', '.join(cols + msrs),
+        }
+
+        # The WHERE clause lifts the ambiguity between the join
+        # constraint and the upsert clause
+        stm = 'INSERT INTO "%(spc)s" (%(fields)s) ' \
+              'SELECT %(select)s FROM "%(spc)s" ' \
+              'JOIN %(pairs)s ON ("%(spc)s"."%(col)s" = drop_id) ' \
+              'WHERE true GROUP BY %(group_by)s ' \
+              'ON CONFLICT (%(cols)s) %(upsert)s' % dict(
+                  fmt, select=', '.join(select), upsert=self.upsert(space),
+                  group_by=', '.join(group_by))
+        nb_moved = self.execute_count(stm)
+
+        # Delete obsoleted lines
+        self.execute(
+            'DELETE FROM "%(spc)s" WHERE "%(col)s" IN ('
+            'SELECT drop_id FROM %(pairs)s)' % fmt)
+        nonzero = self.nonzero_cond(space._db_measures)
+        if nonzero:
+            # Delete rows whose values cancel each other
+            self.execute(
+                'DELETE FROM "%(spc)s" WHERE "%(col)s" IN ('
+                'SELECT keep_id FROM %(pairs)s) AND NOT (%(nonzero)s)' % dict(
+                    fmt, nonzero=nonzero))
+        return nb_moved
+
+    def upsert(self, space, table=None):
+        '''
+        Return the ON CONFLICT action merging rows of space into table
+        (defaults to the space table).
+        '''
+        table = table or space._table
+        msrs = ['"%s"' % m.name for m in space._db_measures]
+        if not msrs:
+            return 'DO NOTHING'
+        return 'DO UPDATE SET ' + ', '.join(
+            '%s = %s' % (col, m.sql_merge('"%s".%s' % (table, col),
+                                          'excluded.' + col))
+            for m, col in zip(space._db_measures, msrs))
+
+    def nonzero_cond(self, measures):
+        '''
+        Return the SQL condition matching rows where at least one of
+        measures is not zero, an empty string if rows can not be
+        filtered on it.
+        '''
+        conds = [m.nonzero_sql(m.name) for m in measures]
+        if None in conds:
+            return ''
+        return ' OR '.join(conds)
+
+    def restructure(self, dim, moves, spaces):
+        '''
+        Apply a list of (id, new_parent_id, new_name) moves. The
+        closure table is rebuilt once, duplicates are merged and
+        emptied parents are pruned. Returns the number of rows moved
+        in the spaces.
+        '''
+        fmt = {
+            'cls': dim.closure_table,
+            'dim': dim.table,
+            'moves': 'tmp_%s' % self.nb_tmp,
+        }
+        self.nb_tmp += 1
+        self.execute(
+            'CREATE TEMPORARY TABLE %(moves)s ('
+            'id INTEGER PRIMARY KEY, parent INTEGER, name %(type)s)' % dict(
+                fmt, type=dim.sql_type))
+        self.executemany(
+            'INSERT INTO %(moves)s (id, parent, name) VALUES (?, ?, ?)' % fmt,
+            moves)
+
+        # Compute the new parent links
+        fmt['links'] = 'tmp_%s' % self.nb_tmp
+        self.nb_tmp += 1
+        self.execute(
+            'CREATE TEMPORARY TABLE %(links)s AS '
+            'SELECT child AS id, parent FROM "%(cls)s" WHERE depth = 1' % fmt)
+        self.execute(
+            'UPDATE %(links)s SET parent = ('
+            'SELECT parent FROM %(moves)s WHERE %(moves)s.id = %(links)s.id) '
+            'WHERE id IN (SELECT id FROM %(moves)s)' % fmt)
+        self.execute('CREATE UNIQUE INDEX %(links)s_id ON %(links)s (id)'
+                     % fmt)
+
+        # A node can not end up in its own subtree, even through a chain
+        # of moves (Tree.restructure already keeps depths, callers may
+        # not). Any cycle goes through a moved node, and at most depth
+        # unmoved nodes separate two moved nodes on the path to the root
+        self.execute(
+            'WITH RECURSIVE up(start, id, steps) AS ('
+              'SELECT id, parent, 1 FROM %(moves)s '
+              'UNION ALL '
+              'SELECT up.start, %(links)s.parent, up.steps + 1 FROM up '
+              'JOIN %(links)s ON (%(links)s.id = up.id) '
+              'WHERE up.id != up.start AND up.steps <= %(max_steps)s'
+            ') SELECT count(*) FROM up WHERE id = start' % dict(
+                fmt, max_steps=len(moves) * (dim.depth + 1)))
+        cnt, = self.cursor.fetchone()
+        if cnt:
+            raise ValueError('Unable to move a node into its own subtree')
+
+        # Collect parents
+        self.execute(
+            'SELECT DISTINCT "%(cls)s".parent FROM %(moves)s '
+            'JOIN "%(cls)s" ON (child = id AND depth = 1)' % fmt)
+        old_parents = set(pid for pid, in self.cursor)
+        self.execute('SELECT DISTINCT parent FROM %(moves)s' % fmt)
+        new_parents = set(pid for pid, in self.cursor)
+
+        # Rename
+        self.execute(
+            'UPDATE "%(dim)s" SET name = ('
+            'SELECT name FROM %(moves)s WHERE %(moves)s.id = "%(dim)s".id) '
+            'WHERE id IN (SELECT id FROM %(moves)s)' % fmt)
+
+        # Rebuild closure table based on new parent links
+        self.execute('CREATE INDEX %(links)s_idx ON %(links)s (parent)' % fmt)
+        self.execute('DELETE FROM "%(cls)s"' % fmt)
+        self.execute(
+            'INSERT INTO "%(cls)s" (parent, child, depth) '
+            'WITH RECURSIVE tree(parent, child, depth) AS ('
+              'SELECT id, id, 0 FROM "%(dim)s" '
+              'UNION ALL '
+              'SELECT tree.parent, %(links)s.id, tree.depth + 1 FROM tree '
+              'JOIN %(links)s ON (%(links)s.parent = tree.child) '
+              'WHERE tree.depth < %(max_depth)s'
+            ') SELECT parent, child, depth FROM tree' % dict(
+                fmt, max_depth=dim.depth))
+
+        # Merge any resulting duplicate
+        nb_moved = self.merge(dim, new_parents, spaces)
+
+        # Prune old parents left without children (the root is kept)
+        self.execute(
+            'SELECT child FROM "%(cls)s" WHERE depth = 1 '
+            'AND child IN (%(ids)s) '
+            'AND child NOT IN (SELECT parent FROM "%(cls)s" WHERE depth = 1)'
+            % dict(fmt, ids=','.join(map(str, old_parents - new_parents))))
+        empty = ','.join(str(pid) for pid, in self.cursor.fetchall())
+        if empty:
+            self.execute(
+                'DELETE FROM "%s" WHERE child IN (%s)' % (
+                    dim.closure_table, empty))
+            self.execute(
+                'DELETE FROM "%s" WHERE id IN (%s)' % (dim.table, empty))
+
+        return nb_moved
+
+    def prune(self, dim, parent_id):
+        '''
+        Will delete the given node if no children are found
+        '''
+        self.execute(
+            'SELECT count(*) FROM %(cls)s '
+            'WHERE parent = ? and depth = 1' % {'cls': dim.closure_table},
+            (parent_id,)
+        )
+        cnt, = next(self.cursor)
+        if cnt > 0:
+            return
+
+        self.execute('DELETE FROM %s WHERE id = ?' % dim.table,
+                            (parent_id,))
+
+    def rename(self, dim, record_id, new_name):
+        self.execute('UPDATE %s SET name = ? WHERE id = ?' % dim.table,
+                            (new_name, record_id)
+        )
+
+    def get_children(self, dim, parent_id, depth=1):
+        if parent_id is None:
+            stm = 'SELECT name, id from "%s" where name is null' % dim.table
+            args = tuple()
+        else:
+            stm = 'SELECT d.name, d.id ' \
+                'FROM "%s" AS c JOIN %s AS d ON (c.child = d.id) '\
+                'WHERE c.depth = ? AND c.parent = ?' % (
+                    dim.closure_table, dim.table)
+            args = (depth, parent_id)
+        res = list(self.execute(stm, args))
+        return res
+
+    def last_name(self, dim):
+        'Return the greatest name of the dimension'
+        self.execute('SELECT max(name) FROM "%s"' % dim.table)
+        name, = self.cursor.fetchone()
+        return name
+
+    def get_parents(self, dim):
+        stm = 'SELECT id, name, parent FROM "%s"'\
+            ' JOIN %s ON (child = id) WHERE depth = 1'\
+            %(dim.table, dim.closure_table)
+        self.execute(stm)
+        return self.cursor.fetchall()
+
+    def dice_query(self, space, fields, filters=None, having=None, prefix=''):
+        from menger import Coordinate, Level, Measure
+        from menger.dimension import Range
+        from menger.measure import Computed
+
+        # Computed measures may have been created since the connection
+        self.install_functions()
+
+        select = []
+        joins = []
+        tmp_tables = defaultdict(list)
+        group_by = []
+        params = {}
+        nb_default = 0
+        query_dims = set()
+
+        # Add dimensions to select
+        for field in fields:
+            if isinstance(field, Computed):
+                select.append(self.measure_expr(space, field))
+            elif isinstance(field, Measure):
+                select.append(field.sql_agg(field.name))
+            elif isinstance(field, Range):
+                # The dimension itself selects the stored values
+                col = '"%s"."%s"' % (space._table, field.name)
+                select.append(col)
+                group_by.append(col)
+                query_dims.add(field.name)
+            elif isinstance(field, Level) and isinstance(field.dim, Range):
+                # Buckets are computed on the fly
+                col = field.dim.sql('"%s"."%s"' % (space._table,
+                                                   field.dim.name))
+                select.append(col)
+                group_by.append(col)
+                query_dims.add(field.dim.name)
+            elif isinstance(field, Level):
+                alias = 'tmp_%s' % self.nb_tmp
+                self.nb_tmp += 1
+                tmp_tables[field.dim.name].append(alias)
+                joins.append(
+                    self.tmp_join(space, alias, field.dim, field.depth - 1)
+                )
+                col = '%s.parent' % alias
+                select.append(col)
+                group_by.append(col)
+                query_dims.add(field.dim.name)
+            else:
+                if isinstance(field, Coordinate):
+                    field = field.key()
+                col = '%s%s_default' % (prefix, nb_default)
+                nb_default += 1
+                select.append(':' + col)
+                params[col] = field
+
+        filters, where = self.range_filters(space, filters)
+        version_cond, part_filters = self.version_filter(space, query_dims,
+                                                         filters)
+        tmp_tables, joins = self.build_filters(space, filters, tmp_tables,
+                                               joins)
+
+        # Base query
+        stm = 'SELECT %s FROM %s' % (', '.join(select),
+                                     self.from_clause(space, part_filters))
+        if joins:
+            stm += ' ' + ' '.join(joins)
+
+        # Where clause
+        if version_cond:
+            where.append(version_cond)
+        msrs = set()
+        for field in fields:
+            if isinstance(field, Measure):
+                msrs.update(self.stored_measures(space, field))
+        zero_cond = self.nonzero_cond(sorted(msrs, key=lambda m: m.name))
+        if zero_cond:
+            where.append('(%s)' % zero_cond)
+        if where:
+            stm += ' WHERE ' + ' AND '.join(where)
+
+        # Group clause
+        if group_by:
+            stm += ' GROUP BY ' + ', '.join(group_by)
+
+        # Having clause
+        if having:
+            conds = []
+            for pos, (msr, op, value) in enumerate(having):
+                if op not in HAVING_OPS:
+                    raise ValueError('Unexpected operator "%s" in having' % op)
+                col = '%shaving_%s' % (prefix, pos)
+                conds.append('%s %s :%s' % (
+                    self.measure_expr(space, msr), op, col))
+                params[col] = value
+            stm += ' HAVING ' + ' AND '.join(conds)
+
+        # print(format_query(stm, params))
+        return stm, params
+
+    def version_filter(self, space, query_dims, filters):
+        '''
+        Enforce latest version if a version field is present on the
+        space but not in the query (query_dims is a set of dimension
+        names). Returns a condition on the version column (or None)
+        and the filters completed with the latest version (to prune
+        partitions).
+        '''
+        vdim = space._versioned
+        if vdim is None or vdim.name in query_dims:
+            return None, filters
+        if any(dim.name == vdim.name for dim, *_ in filters):
+            return None, filters
+        last_version = vdim.last_coord()
+        if last_version is None:
+            return None, filters
+        # Versions have no children, no need to go through the closure
+        cond = '"%s"."%s" = %s' % (space._table, vdim.name,
+                                   vdim.key(last_version))
+        return cond, filters + [vdim.match(last_version)]
+
+    def range_filters(self, space, filters):
+        '''
+        Split filters on range dimensions from the other ones. Returns
+        the remaining filters and the list of SQL conditions
+        implementing the range filters.
+        '''
+        other_filters = []
+        conds = []
+        for fdim, coords, *depths in filters or []:
+            if fdim.table is None:
+                conds.append(self.range_cond(space, fdim, coords))
+            else:
+                other_filters.append((fdim, coords) + tuple(depths))
+        return other_filters, conds
+
+    def range_cond(self, space, dim, coords):
+        col = '"%s"."%s"' % (space._table, dim.name)
+        conds = []
+        for coord in coords:
+            low, high = dim.bounds(coord.value)
+            cond = []
+            if low is not None:
+                cond.append('%s >= %r' % (col, low))
+            if high is not None:
+                cond.append('%s < %r' % (col, high))
+            conds.append('(%s)' % (' AND '.join(cond) or '1'))
+        return '(%s)' % (' OR '.join(conds) or '0')
+
+    def from_clause(self, space, filters=None):
+        '''
+        Return the table expression to query space. On partitioned
+        spaces, only the partitions that may match filters are
+        scanned, they are aliased as the space table.
+        '''
+        if not space._partition_by:
+            return '"%s"' % space._table
+
+        tables = [p._table for p in space.partitions(filters)]
+        if not tables:
+            # Query the (empty) main table
+            return '"%s"' % space._table
+        if len(tables) == 1:
+            return '"%s" AS "%s"' % (tables[0], space._table)
+        union = ' UNION ALL '.join('SELECT * FROM "%s"' % t for t in tables)
+        return '(%s) AS "%s"' % (union, space._table)
+
+    def drop(self, space):
+        '''
+        Drop the table of space (and forget its registration), returns
+        the number of rows it contained.
+        '''
+        cnt = self.size(space)
+        self.execute('DROP TABLE IF EXISTS "%s"' % space._table)
+        self.init_done.discard(space._name)
+        self.stm.pop(space._name, None)
+        return cnt
+
+    def materialize(self, space, dimensions, filters=None):
+        '''
+        Aggregate the space on the raw values of the given dimensions
+        into a temporary table, returns the name of the table.
+        '''
+        query_dims = set(d.name for d in dimensions)
+        filters, where = self.range_filters(space, filters)
+        version_cond, part_filters = self.version_filter(space, query_dims,
+                                                         filters)
+        tmp_tables, joins = self.build_filters(space, filters)
+
+        cols = ['"%s"."%s"' % (space._table, d.name) for d in dimensions]
+        select = cols + ['%s AS %s' % (m.sql_agg(m.name), m.name)
+                         for m in space._db_measures]
+        alias = 'tmp_%s' % self.nb_tmp
+        self.nb_tmp += 1
+        stm = 'CREATE TEMPORARY TABLE %s AS SELECT %s FROM %s' % (
+            alias, ', '.join(select), self.from_clause(space, part_filters))
+        if joins:
+            stm += ' ' + ' '.join(joins)
+        if version_cond:
+            where.append(version_cond)
+        zero_cond = self.nonzero_cond(space._db_measures)
+        if zero_cond:
+            where.append('(%s)' % zero_cond)
+        if where:
+            stm += ' WHERE ' + ' AND '.join(where)
+        if cols:
+            stm += ' GROUP BY ' + ', '.join(cols)
+        self.execute(stm)
+        return alias
+
+    def dice(self, space, fields, filters=[], having=None):
+        stm, params = self.dice_query(space, fields, filters, having=having)
+        self.execute(stm, params)
+        res = self.cursor.fetchall()
+        return res
+
+    def stream(self, stm, params):
+        '''
+        Execute stm in a dedicated cursor and yield its rows, the main
+        cursor stays available while the rows are consumed.
+        '''
+        cursor = self.connection.cursor()
+        try:
+            yield from cursor.execute(stm, params)
+        finally:
+            cursor.close()
+
+    def dice_join(self, queries, nb_dims, filters=None):
+        '''
+        Execute one dice query per (space, fields) tuple and join them
+        on their first nb_dims columns (the dimension keys).
+        '''
+        stm, params = self.dice_join_query(queries, nb_dims, filters)
+        self.execute(stm, params)
+        return self.cursor.fetchall()
+
+    def dice_join_query(self, queries, nb_dims, filters=None):
+        ctes = []
+        params = {}
+        select = ['q0.c%s' % i for i in range(nb_dims)]
+        joins = []
+        for pos, (space, fields) in enumerate(queries):
+            stm, qparams = self.dice_query(space, fields, filters,
+                                           prefix='q%s_' % pos)
+            params.update(qparams)
+            cols = ', '.join('c%s' % i for i in range(len(fields)))
+            ctes.append('q%s(%s) AS (%s)' % (pos, cols, stm))
+            select.extend('q%s.c%s' % (pos, i)
+                          for i in range(nb_dims, len(fields)))
+            if pos == 0:
+                continue
+            join = 'CROSS JOIN q%s' % pos
+            if nb_dims:
+                join = 'JOIN q%s ON (%s)' % (pos, ' AND '.join(
+                    'q0.c%s = q%s.c%s' % (i, pos, i) for i in range(nb_dims)))
+            joins.append(join)
+
+        stm = 'WITH %s SELECT %s FROM q0' % (
+            ', '.join(ctes), ', '.join(select))
+        if joins:
+            stm += ' ' + ' '.join(joins)
+        return stm, params
+
+    def stored_measures(self, space, msr):
+        'Yield the stored measures msr depends on'
+        from menger.measure import Computed
+
+        if not isinstance(msr, Computed):
+            yield msr
+            return
+        for arg in msr.args:
+            yield from self.stored_measures(space, space.get_measure(arg))
+
+    def measure_expr(self, space, msr):
+        '''
+        Return the aggregate SQL expression of msr, computed measures
+        are expanded recursively based on their arguments.
+        '''
+        from menger.measure import Computed
+
+        if not isinstance(msr, Computed):
+            return msr.sql_final(msr.sql_agg(msr.name))
+
+        args = [self.measure_expr(space, space.get_measure(a))
+                for a in msr.args]
+        expr = msr.sql(*args)
+        if expr is None:
+            expr = self.function_expr(msr, args)
+        if expr is None:
+            raise ValueError('Measure "%s" has no SQL form' % msr.name)
+        return expr
+
+    def function_expr(self, msr, args):
+        '''
+        Return an SQL call to the compute method of msr, None if the
+        backend can not run Python functions.
+        '''
+        return None
+
+    def build_filters(self, space, filters, tmp_tables=None, joins=None):
+        tmp_tables = tmp_tables or defaultdict(list)
+        joins = joins or []
+
+        # Create extra tmp tables for filters if not in selection
+        for fdim, coords, *depths in filters:
+            if fdim.name not in tmp_tables:
+                alias = 'tmp_%s' % self.nb_tmp
+                self.nb_tmp += 1
+                tmp_tables[fdim.name].append(alias)
+                joins.append(self.tmp_join(space, alias, fdim))
+
+        # Filters dimensions
+        for fdim, coords, *depths in filters:
+            for tt in tmp_tables[fdim.name]:
+                cond = 'SELECT child FROM %s WHERE parent in (%s)' %(
+                    fdim.closure_table,
+                    ','.join(str(c.key()) for c in coords)
+                    )
+                if depths:
+                    cond += ' AND depth in (%s)' % ','.join(map(str, depths))
+                qr = 'DELETE FROM %(tmp)s WHERE child NOT IN (%(cond)s)'
+                params = {
+                    'tmp': tt,
+                    'cond': cond
+                }
+                self.execute(qr % params)
+
+        return tmp_tables, joins
+
+    def tmp_join(self, spc, alias, dim, depth=None):
+        # Create tmp table
+        qr = 'CREATE TEMPORARY table %s ('\
+             'parent INTEGER, child INTEGER, depth INTEGER'\
+             ')' % alias
+        self.execute(qr)
+
+        # Fill it
+        if depth is None:
+            qr = 'INSERT INTO %(tmp)s (parent, child, depth) '\
+                 'SELECT parent, child, depth '\
+                 'FROM %(cls)s WHERE parent = 1'
+            params = {
+                'cls': dim.closure_table,
+                'tmp': alias,
+                }
+        else:
+            subselect = 'SELECT child from "%(cls)s" ' \
+                        'WHERE ('\
+                          'parent = 1 ' \
+                          'AND depth = %(depth)s'\
+                        ')' % {
+                            'cls': dim.closure_table,
+                            'depth': depth + 1,
+                        }
+
+            qr = 'INSERT INTO %(tmp)s (parent, child, depth) '\
+                 'SELECT parent, child, depth '\
+                 'FROM %(cls)s WHERE parent IN (%(subselect)s)'
+            params = {
+                'cls': dim.closure_table,
+                'tmp': alias,
+                'subselect': subselect,
+            }
+        self.execute(qr % params)
+
+        # Build join expression
+        join = 'JOIN %(tmp)s ON (%(tmp)s.child = "%(spc)s"."%(dim)s")'
+        params = {
+            'dim': dim.name,
+            'spc': spc._table,
+            'tmp': alias,
+        }
+        return join % params
+
+    def delete(self, space, filters, chunk_size=None):
+        '''
+        Delete rows matching filters. If chunk_size is set, rows are
+        deleted by chunks and each chunk is committed. Returns the
+        number of deleted rows.
+        '''
+        filters, conditions = self.range_filters(space, filters)
+        for fdim, coords, *depths in filters:
+            keys = (c.key() for c in coords)
+            cond = '"%s" IN (SELECT child FROM "%s" WHERE parent IN (%s)' % (
+                fdim.name,
+                fdim.closure_table,
+                ','.join(str(k) for k in keys if k is not None),
+            )
+            if depths:
+                cond += ' AND depth IN (%s)' % ','.join(map(str, depths))
+            conditions.append(cond + ')')
+        where = ''
+        if conditions:
+            where = ' WHERE ' + ' AND '.join(conditions)
+
+        if chunk_size is None:
+            query = 'DELETE FROM "%s"%s' % (space._table, where)
+            return self.execute_count(query)
+
+        query = 'DELETE FROM "%(spc)s" WHERE %(rowid)s IN (' \
+                'SELECT %(rowid)s FROM "%(spc)s"%(where)s ' \
+                'LIMIT %(limit)s)' % {
+                    'spc': space._table,
+                    'rowid': self.row_id,
+                    'where': where,
+                    'limit': int(chunk_size),
+                }
+        nb_delete = 0
+        while True:
+            cnt = self.execute_count(query)
+            self.commit()
+            nb_delete += cnt
+            if cnt < chunk_size:
+                return nb_delete
+
+    def snapshot(self, space, other_space, select, filters, to_delete):
+        if other_space._partition_by:
+            raise ValueError('Unable to snapshot into a partitioned space')
+        # Delete existing data
+        self.delete(other_space, to_delete)
+
+        # Copy into other_space
+        dice_stm , dice_params = self.dice_query(space, select, filters)
+        stm = 'INSERT INTO %s ' % other_space._table
+        stm = stm + dice_stm
+        self.execute(stm, dice_params)
+        return self.size(other_space)
+
+    def index_names(self, table):
+        'Return the names of the indexes of table'
+        self.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' "
+            "AND tbl_name = ?", (table,))
+        return [name for name, in self.cursor.fetchall()]
+
+    def cover_index(self, space, dim):
+        'Return the name of the covering index of dim on space'
+        return '%s_%s_cover' % (space._table, dim.name)
+
+    def create_cover_index(self, space, dim):
+        '''
+        Index the column of dim together with the stored measures, so
+        that dices filtered or grouped on dim do not read the table.
+        Blobs (sketches) are left out.
+        '''
+        cols = ['"%s"' % dim.name] + [
+            '"%s"' % m.name for m in space._db_measures
+            if m.sql_type != 'blob']
+        self.execute('CREATE INDEX IF NOT EXISTS %s ON "%s" (%s)' % (
+            self.cover_index(space, dim), space._table, ', '.join(cols)))
+
+    def size(self, spc):
+        if spc._partition_by:
+            return sum(self.size(p) for p in spc.partitions())
+        qr = 'SELECT count(*) FROM %s' % spc._table
+        cnt, = self.execute(qr).fetchone()
+        return cnt
+
+    def glob(self, dim, parent_id, parent_depth, values, filters=[]):
+        depth = len(values)
+        query_args = {
+            'parent_id': parent_id,
+            'depth': depth,
+        }
+        format_args = {
+            'cls': dim.closure_table,
+            'dim': dim.table,
+        }
+        select = 'SELECT child from %(cls)s WHERE ' \
+                 'parent = :parent_id AND depth = :depth'
+
+        # Add condtions defined by value
+        conditions = []
+        for pos, name in enumerate(values):
+            if name is None:
+                continue
+            query_args['name_%s' % pos] = name
+            query_args['depth_%s' % pos] = depth - pos - 1
+            cond = 'child IN ('\
+                   'SELECT child FROM %(cls)s '\
+                   'JOIN %(dim)s ON (parent=id) '\
+                   'WHERE name = :name_%(pos)s AND depth=:depth_%(pos)s)' % {
+                       'cls': dim.closure_table,
+                       'dim': dim.table,
+                       'pos': pos,
+                   }
+            conditions.append(cond)
+
+        # Add conditions defined by filters
+        total_depth = parent_depth + depth
+        for key_depths in filters:
+            sub_conds = []
+            for key, filter_depth in key_depths:
+                select_field, cond_field = 'child', 'parent'
+                if filter_depth > total_depth:
+                    select_field, cond_field = cond_field, select_field
+
+                cond_field = 'parent' if filter_depth < total_depth else 'child'
+                delta = abs(filter_depth - total_depth)
+                sub_sel = 'SELECT %(select_field)s FROM %(cls)s WHERE '\
+                          '(%(cond_field)s = %(key)s AND depth = %(delta)s)' % {
+                              'select_field': select_field,
+                              'cond_field': cond_field,
+                              'key': key,
+                              'delta': delta,
+                              'cls': dim.closure_table,
+                          }
+                sub_conds.append(sub_sel)
+
+            cond = 'child in (%s)' % ' UNION '.join(sub_conds)
+            conditions.append(cond)
+
+        query = select
+        if conditions:
+            query += ' AND ' + ' AND '.join(conditions)
+
+        self.execute(query % format_args, query_args)
+        return self.cursor.fetchall()
+
+    def search(self, dim, substring, max_depth, limit=None):
+        fmt = {
+            'dim': dim.table,
+            'cls': dim.closure_table,
+        }
+        cond = self.search_cond(dim)
+        if max_depth is None:
+            query = 'SELECT name, null FROM %(dim)s ' \
+                    'WHERE ' + cond + ' ' \
+                    'ORDER BY name'
+            args = ('%' + substring + '%',)
+        else:
+            query = 'SELECT name, depth FROM %(dim)s ' \
+                    'JOIN %(cls)s ON (parent = 1 and child = id) '\
+                    'WHERE ' + cond + ' AND depth <= ? '\
+                    'GROUP BY name, depth '\
+                    'ORDER BY depth, name'
+            args = ('%' + substring + '%', max_depth)
+        if limit is not None:
+            query += ' LIMIT %s' % int(limit)
+
+        return self.execute(query % fmt, args)
+
+    def search_cond(self, dim):
+        'Return the condition matching the names of dim with a LIKE pattern'
+        return 'name LIKE ?'
+
+    def get_profiles(self, spc, sort_on=('size', 'ASC')):
+        names = [d.name for d in spc._dimensions]
+        sort_field, sort_dir = sort_on
+        qr = 'SELECT _id, _size, %s from %s order by _%s %s' % (
+            ', '.join(names),
+            spc._pfl_table,
+            sort_field,
+            sort_dir,
+        )
+
+        for row in self.execute(qr):
+            id_ = row[0]
+            size = row[1]
+            values = dict(zip(names, row[2:]))
+            yield id_, size, values
+
+    def get_hits(self, spc):
+        'Yield the number of hits and the signature of each profile'
+        names = [d.name for d in spc._dimensions]
+        qr = 'SELECT _hits, %s FROM %s' % (', '.join(names), spc._pfl_table)
+        for row in self.execute(qr).fetchall():
+            yield row[0] or 0, dict(zip(names, row[1:]))
+
+    def set_profile(self, spc, id_, size):
+        qr = 'UPDATE %s set _size = ? where _id = ?' % spc._pfl_table
+        self.execute(qr, (size, id_))
+
+    def inc_profile(self, spc, sgn, inc):
+        cond = ['%s = ?' % name for name, _ in sgn]
+        qr = 'SELECT _id, _hits from %s where %s' % (
+            spc._pfl_table,
+            ' AND '.join(cond),
+        )
+        values = tuple(depth for _, depth in sgn)
+        res = self.execute(qr, values).fetchone()
+        if res is not None:
+            # Increment existing counter
+            id_, hits = res
+            qr = 'UPDATE %s SET _hits = ? WHERE _id = ?' % spc._pfl_table
+            self.execute(qr, (hits + inc, id_))
+            return hits + inc
+
+        # Create counter
+        qr = 'INSERT INTO %s (_hits, %s) VALUES (?, %s)' % (
+            spc._pfl_table,
+            ', '.join(name for name, _ in sgn),
+            ', '.join('?' for _ in sgn),
+        )
+        self.execute(qr, (inc,) + values)
+        return inc
 
+    def reset_profile(self, spc, ghost_spc, id_):
+        self.set_profile(spc, id_, size=None)
+        qr = 'DROP TABLE IF EXISTS %s' % ghost_spc._table
+        self.execute(qr)
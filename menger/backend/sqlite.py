@@ -1,171 +1,200 @@
-from collections import defaultdict
-from itertools import chain, repeat
+from contextlib import contextmanager
+import re
 import sqlite3
+from urllib.parse import quote
 
-from .sql import SqlBackend, LoadType
+from .sql import SqlBackend
+from ..event import trigger
+from ..measure import SQL_FUNCTIONS
 
 
-def format_query(stm, params):
-    if isinstance(params, dict):
-        for k, v in params.items():
-            stm = stm.replace(':' + k, str(v))
-        return stm
-    return stm.replace('?', '%s') % params
+PRAGMA_VALUE_RE = re.compile(r'^-?\w+$')
 
 
 class SqliteBackend(SqlBackend):
 
-    def __init__(self, path):
-        # TODO: re-enable ro mode when hit update is not made when we
-        # exit.
-        # if readonly and path != ':memory:':
-        #     path = 'file:%s?mode=ro' % path
-        #     uri = True
-        # else:
-        #     uri=False
-        self.connection = sqlite3.connect(path)
-        self.cursor = self.connection.cursor()
-        self.execute('PRAGMA journal_mode=WAL')
-        self.execute('PRAGMA foreign_keys=1')
+    # Pragmas accepted as connection options, page_size comes first as
+    # it must be set before the creation of the first table
+    pragmas = ('page_size', 'mmap_size', 'cache_size', 'synchronous',
+               'temp_store')
+    # Default pragmas of read-only connections (cache_size is in KiB)
+    read_pragmas = {
+        'mmap_size': 2**30,
+        'cache_size': -2**16,
+        'temp_store': 'MEMORY',
+    }
+
+    def __init__(self, path, readonly=False, **pragmas):
+        for name, value in pragmas.items():
+            if name not in self.pragmas:
+                raise ValueError('Unknown option "%s"' % name)
+            if not PRAGMA_VALUE_RE.match(str(value)):
+                raise ValueError('Unexpected value "%s" for %s' % (
+                    value, name))
+
+        self.readonly = readonly and path != ':memory:'
+        if self.readonly:
+            # The file is expected to stay unchanged while it is opened,
+            # no lock is taken and no -wal or -shm file is needed
+            uri = 'file:%s?mode=ro&immutable=1' % quote(path)
+            self.connection = sqlite3.connect(uri, uri=True)
+            self.cursor = self.connection.cursor()
+            pragmas = dict(self.read_pragmas, **pragmas)
+        else:
+            self.connection = sqlite3.connect(path)
+            self.cursor = self.connection.cursor()
+        for name in self.pragmas:
+            if name in pragmas:
+                self.execute('PRAGMA %s=%s' % (name, pragmas[name]))
+        if not self.readonly:
+            self.execute('PRAGMA journal_mode=WAL')
+            self.execute('PRAGMA foreign_keys=1')
+        self.functions = set()
+        self.fn_error = None
+        self.install_functions()
         self.nb_tmp = 0
+        self.fts_tables = {}
 
         super(SqliteBackend, self).__init__()
 
+    def install_functions(self):
+        '''
+        Install the SQL functions registered by measures that are not
+        yet known by the connection.
+        '''
+        for name in SQL_FUNCTIONS.keys() - self.functions:
+            nb_args, fn, aggregate = SQL_FUNCTIONS[name]
+            if aggregate:
+                self.connection.create_aggregate(name, nb_args, fn)
+            else:
+                self.connection.create_function(name, nb_args,
+                                                self.keep_error(fn),
+                                                deterministic=True)
+            self.functions.add(name)
+
+    def keep_error(self, fn):
+        '''
+        Wrap fn to remember the exception it raises, sqlite only reports
+        that the function failed.
+        '''
+        def call(*args):
+            try:
+                return fn(*args)
+            except Exception as exc:
+                self.fn_error = exc
+                raise
+        return call
+
+    @contextmanager
+    def function_errors(self):
+        'Re-raise the original error of a failed SQL function'
+        self.fn_error = None
+        try:
+            yield
+        except sqlite3.OperationalError:
+            error, self.fn_error = self.fn_error, None
+            if error is None:
+                raise
+            raise error
+
     def execute(self, query, args=None):
         if args is not None:
             return self.cursor.execute(query, args)
         return self.cursor.execute(query)
 
-    def init_tables(self, space, ghost=False):
-        if space._name in self.init_done:
-            return
-        self.init_done.add(space._name)
-
-        for dim in space._dimensions:
-            if dim.table is None:
-                continue
-            # Dimension table
-            self.execute(
-                'CREATE TABLE IF NOT EXISTS "%s" ( '
-                'id INTEGER PRIMARY KEY, '
-                'name %s)' % (dim.table, dim.sql_type))
+    def executemany(self, query, seq):
+        return self.cursor.executemany(query, seq)
 
-            # Closure table for the dimension
-            self.execute(
-                'CREATE TABLE IF NOT EXISTS "%s" ('
-                'parent INTEGER REFERENCES "%s" (id) '
-                  'ON DELETE CASCADE NOT NULL, '
-                'child INTEGER REFERENCES "%s" (id) '
-                  'ON DELETE CASCADE NOT NULL, '
-                'depth INTEGER)' % (dim.closure_table, dim.table,
-                                    dim.table))
+    def init_dimension(self, dim):
+        if dim.search_index:
+            self.init_fts(dim)
 
+    def init_fts(self, dim):
+        '''
+        Create a full-text index (with the trigram tokenizer) on the
+        names of dim, kept up to date by triggers on the dimension
+        table. Does nothing if FTS5 is not available.
+        '''
+        if self.fts_exists(dim):
+            return
+        fmt = {'dim': dim.table, 'fts': dim.fts_table}
+        try:
             self.execute(
-                'CREATE INDEX IF NOT EXISTS %s_idx '
-                'ON %s (parent, depth)' % (dim.closure_table, dim.closure_table)
-            )
-
-        # Space (main) table
-        cols = ', '.join(chain(
-            ('"%s" INTEGER REFERENCES %s (id) ON DELETE CASCADE NOT NULL ' % (
-                dim.name,  dim.table
-            ) for dim in space._dimensions),
-            ('"%s" %s NOT NULL' % (msr.name, msr.sql_type) \
-             for msr in space._db_measures)
-        ))
-        query = 'CREATE TABLE IF NOT EXISTS "%s" (%s)' % (
-            space._table, cols)
-        self.execute(query)
-
-        # Create index covering all dimensions
-        self.execute(
-            'CREATE UNIQUE INDEX IF NOT EXISTS %s_index ON "%s" (%s)' % (
-                space._table,
-                space._table,
-                ', '.join(d.name for d in space._dimensions)
-                )
-            )
-
-        # Clean old (weak) indexes
-        for d in space._dimensions:
-            self.execute(
-                'DROP INDEX IF EXISTS %s_%s_index' % (
-                    space._table,
-                    d.name,
-                    )
-                )
-
-        if ghost:
-            # No need for profile table
+                "CREATE VIRTUAL TABLE %(fts)s USING fts5(name, "
+                "content='%(dim)s', content_rowid='id', "
+                "tokenize='trigram')" % fmt)
+        except sqlite3.OperationalError:
             return
-
-        # Profile table
-        pfl_cols = [
-            '_id INTEGER PRIMARY KEY',
-            '_hits INTEGER',
-            '_size INTERGER',
-        ]
-        pfl_cols.extend('%s INTEGER' % d.name for d in space._dimensions)
-        query = 'CREATE TABLE IF NOT EXISTS "%s" (%s)'% (
-            space._pfl_table,
-            ', '.join(pfl_cols),
-        )
-        self.execute(query)
-
-        # Create index on profile table
         self.execute(
-            'CREATE UNIQUE INDEX IF NOT EXISTS %s_index ON "%s" (%s)' % (
-                space._pfl_table,
-                space._pfl_table,
-                ', '.join(d.name for d in space._dimensions)
-                )
-            )
-
-    def register(self, space, init=False, ghost=False):
-        if init:
-            self.init_tables(space, ghost=ghost)
-
-        # If the space is already known, nothing to do
-        if space._name in self.stm:
-            return
-
-        stm_dict = self.stm[space._name]
-        measures = [m.name for m in space._db_measures]
-        dimensions = [d.name for d in space._dimensions]
-
-        # get statement
-        select = ', '.join(measures)
-        dim_where = 'WHERE ' + ' AND '.join('"%s" = ?' % d for d in dimensions)
-        stm_dict['get'] = 'SELECT %s FROM "%s" %s' % (
-            select, space._table, dim_where)
-
-        # update statement
-        set_stm = ', '.join('"%s" = ?' % m for m in measures)
-        clause = ' and '.join('"%s" = ?' % d for d in dimensions)
-        stm_dict['update'] = 'UPDATE "%s" SET %s WHERE %s' % (
-            space._table, set_stm, clause)
-
-        #insert statement
-        fields = tuple(chain(dimensions, measures))
-
-        val_stm = ', '.join('?' for f in fields)
-        field_stm = ', '.join(fields)
-        stm_dict['insert'] = 'INSERT INTO "%s" (%s) VALUES (%s)' % (
-            space._table, field_stm, val_stm)
-
-        #delete statement
-        cond_stm = ' AND '.join('%s = ?' % d for d in dimensions)
-        stm_dict['delete'] = 'DELETE FROM "%s" WHERE %s' % (
-            space._table, cond_stm)
+            'CREATE TRIGGER %(fts)s_insert AFTER INSERT ON "%(dim)s" BEGIN '
+            'INSERT INTO %(fts)s (rowid, name) VALUES (new.id, new.name); '
+            'END' % fmt)
+        self.execute(
+            'CREATE TRIGGER %(fts)s_delete AFTER DELETE ON "%(dim)s" BEGIN '
+            "INSERT INTO %(fts)s (%(fts)s, rowid, name) "
+            "VALUES ('delete', old.id, old.name); "
+            'END' % fmt)
+        self.execute(
+            'CREATE TRIGGER %(fts)s_update AFTER UPDATE OF name '
+            'ON "%(dim)s" BEGIN '
+            "INSERT INTO %(fts)s (%(fts)s, rowid, name) "
+            "VALUES ('delete', old.id, old.name); "
+            'INSERT INTO %(fts)s (rowid, name) VALUES (new.id, new.name); '
+            'END' % fmt)
+        # Index existing names
+        self.execute("INSERT INTO %(fts)s (%(fts)s) VALUES ('rebuild')" % fmt)
+        self.fts_tables[dim.fts_table] = True
+
+    def fts_exists(self, dim):
+        if dim.fts_table not in self.fts_tables:
+            self.execute(
+                "SELECT count(*) FROM sqlite_master WHERE name = ?",
+                (dim.fts_table,))
+            cnt, = self.cursor.fetchone()
+            self.fts_tables[dim.fts_table] = cnt > 0
+        return self.fts_tables[dim.fts_table]
 
     def load(self, space, keys_vals, load_type=None):
         # TODO check for equivalent in postgresql
         nb_edit = super(SqliteBackend, self).load(
             space, keys_vals, load_type=load_type)
-        self.execute('VACUUM')
         self.execute('ANALYZE')
         return nb_edit
 
+    @contextmanager
+    def bulk_load(self, space):
+        '''
+        Disable foreign keys enforcement while the block is executed.
+        The rows of space (and of its partitions) are checked at the
+        end, the changes are committed if they are all valid and
+        rolled back otherwise.
+        '''
+        # The pragma is a no-op inside a transaction, pending changes
+        # are committed (as documented by Space.load)
+        self.commit()
+        self.execute('PRAGMA foreign_keys=0')
+        try:
+            yield
+            tables = [space._table]
+            if space._partition_by:
+                tables.extend(p._table for p in space.partitions())
+            for table in tables:
+                nb_bad = len(self.execute(
+                    'PRAGMA foreign_key_check("%s")' % table).fetchall())
+                if nb_bad:
+                    raise sqlite3.IntegrityError(
+                        '%s rows of %s reference unknown coordinates' % (
+                            nb_bad, table))
+        except:
+            self.connection.rollback()
+            # Coordinates created by the load are gone
+            trigger('clear_cache')
+            raise
+        else:
+            self.commit()
+        finally:
+            self.execute('PRAGMA foreign_keys=1')
+
     def create_coordinate(self, dim, name, parent_id=None):
         # Fill dimension table
         self.execute(
@@ -185,400 +214,31 @@ class SqliteBackend(SqlBackend):
         self.execute(stm, (last_id, last_id, 0))
         return last_id
 
-    def delete_coordinate(self, dim, coord_id):
+    def partition_ids(self, space):
+        'Return the ids of the existing partitions of space'
+        prefix = space._table + '_p'
         self.execute(
-            'DELETE FROM %(dim)s WHERE id IN '
-            '(SELECT CHILD FROM %(cls)s WHERE parent = ?)' % {
-                'dim': dim.table,
-                'cls': dim.closure_table
-            }, (coord_id,))
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name GLOB ?", (prefix + '[0-9]*',))
+        return [int(name[len(prefix):]) for name, in self.cursor.fetchall()]
 
+    def dice(self, space, fields, filters=[], having=None):
+        with self.function_errors():
+            return super(SqliteBackend, self).dice(space, fields, filters,
+                                                   having=having)
 
-    def reparent(self, dim, child, new_parent):
-        """
-        Move child from his current parent to the new one.
-        """
-        cls = dim.closure_table
+    def stream(self, stm, params):
+        with self.function_errors():
+            yield from super(SqliteBackend, self).stream(stm, params)
 
-        # Detach child
-        self.execute(
-            'DELETE FROM %s '
-            'WHERE child IN (SELECT child FROM %s where parent = ?) '
-            'AND parent NOT IN (SELECT child FROM %s WHERE parent = ?)' % (
-                cls, cls, cls
-            ),
-            (child, child)
-        )
-
-        # Set new parent
-        self.execute(
-            'SELECT supertree.parent, subtree.child, '
-            'supertree.depth + subtree.depth + 1 '
-            'FROM %s AS supertree JOIN %s AS subtree '
-            'WHERE subtree.parent = ? '
-            'AND supertree.child = ?' % (cls, cls),
-            (child, new_parent)
-        )
-        values = list(self.cursor)
-        self.cursor.executemany(
-            'INSERT INTO %s (parent, child, depth) values (?, ?, ?)' % cls,
-            values
-        )
-
-    def merge(self, dim, parent_id, spaces):
-        '''
-        Merge two subtrees. If one name appear twice under the same parent
-        one of them (with the biggest id) will be deleted and replaced
-        by the other. If more than one dupicate is present this method
-        must be re-executed (but it shouldn't be needed if called
-        appropriately)
-        '''
-
-        # Find ids to merge
-        self.execute(
-            'SELECT name, min(child), max(child), count(*) as cnt '
-            'FROM "%(cls)s" '
-            'JOIN "%(dim)s" ON (child = id) '
-            'WHERE depth = 1 AND parent = ? '
-            'GROUP BY name HAVING cnt > 1' % {
-                'cls': dim.closure_table,
-                'dim': dim.table,
-            }, (parent_id,))
-
-        for name, id_min, id_max, cnt in self.cursor:
-            self.execute(
-                'UPDATE "%(cls)s" SET parent = ? WHERE parent = ?' % {
-                'cls': dim.closure_table,
-            }, (id_min, id_max))
-
-            # Update space to use the new id
-            for space in spaces:
-                if not hasattr(space, dim.name):
-                    continue
-
-                # Fetch lines containing id_max (injecting id_min)
-                select_cols = []
-                for spc_dim in space._dimensions:
-                    if spc_dim.name == dim.name:
-                        select_cols.append("?")
-                    else:
-                        select_cols.append(spc_dim.name)
-                select_cols.extend(m.name for m in  space._db_measures)
-                self.execute(
-                    'SELECT %(select_cols)s FROM "%(spc)s" '
-                    'WHERE %(col)s = ?' % {
-                        'spc': space._table,
-                        'col': dim.name,
-                        'select_cols': ','.join(select_cols),
-                    }, (id_min, id_max,))
-
-                # Re-import the data
-                nd = len(space._dimensions)
-                data = ((r[:nd], r[nd:]) for r in self.cursor)
-                self.load(space, data, load_type=LoadType.increment)
-
-                # Delete obsoleted lines
-                self.execute(
-                    'DELETE FROM "%(spc)s" WHERE %(col)s = ?' % {
-                        'spc': space._table,
-                        'col': dim.name,
-                    }, (id_max,))
-
-            # Clean old records
-            self.execute(
-                'DELETE FROM "%(dim)s" WHERE id = ?' % {
-                'dim': dim.table,
-            }, (id_max,))
-
-            # Recurse on childs
-            self.merge(dim, id_min, spaces)
-
-
-    def prune(self, dim, parent_id):
-        '''
-        Will delete the given node if no children are found
-        '''
-        self.execute(
-            'SELECT count(*) FROM %(cls)s '
-            'WHERE parent = ? and depth = 1' % {'cls': dim.closure_table},
-            (parent_id,)
-        )
-        cnt, = next(self.cursor)
-        if cnt > 0:
-            return
-
-        self.execute('DELETE FROM %s WHERE id = ?' % dim.table,
-                            (parent_id,))
-
-    def rename(self, dim, record_id, new_name):
-        self.execute('UPDATE %s SET name = ? WHERE id = ?' % dim.table,
-                            (new_name, record_id)
-        )
-
-    def get_children(self, dim, parent_id, depth=1):
-        if parent_id is None:
-            stm = 'SELECT name, id from "%s" where name is null' % dim.table
-            args = tuple()
-        else:
-            stm = 'SELECT d.name, d.id ' \
-                'FROM "%s" AS c JOIN %s AS d ON (c.child = d.id) '\
-                'WHERE c.depth = ? AND c.parent = ?' % (
-                    dim.closure_table, dim.table)
-            args = (depth, parent_id)
-        res = list(self.execute(stm, args))
-        return res
-
-    def get_parents(self, dim):
-        stm = 'SELECT id, name, parent FROM "%s"'\
-            ' JOIN %s ON (child = id) WHERE depth = 1'\
-            %(dim.table, dim.closure_table)
-        self.execute(stm)
-        return self.cursor.fetchall()
-
-    def dice_query(self, space, fields, filters=None):
-        from menger import Coordinate, Level, Measure
-
-        filters = filters or []
-        select = []
-        joins = []
-        tmp_tables = defaultdict(list)
-        group_by = []
-        params = {}
-        nb_default = 0
-        query_dims = set()
-
-        # Add dimensions to select
-        for field in fields:
-            if isinstance(field, Measure):
-                select.append('sum(%s)' % field.name)
-            elif isinstance(field, Level):
-                alias = 'tmp_%s' % self.nb_tmp
-                self.nb_tmp += 1
-                tmp_tables[field.dim.name].append(alias)
-                joins.append(
-                    self.tmp_join(space, alias, field.dim, field.depth - 1)
-                )
-                col = '%s.parent' % alias
-                select.append(col)
-                group_by.append(col)
-                query_dims.add(field.dim)
-            else:
-                if isinstance(field, Coordinate):
-                    field = field.key()
-                col = '%s_default' % nb_default
-                nb_default += 1
-                select.append(':' + col)
-                params[col] = field
-
-        # Enforce latest version if a version field is present on the
-        # space but not in the query
-        vdim = space._versioned
-        for dim, *_ in filters:
-            query_dims.add(dim)
-        if vdim and vdim not in query_dims:
-            last_version = vdim.last_coord()
-            if last_version is not None:
-                filters.append(vdim.match(last_version))
-        tmp_tables, joins = self.build_filters(space, filters, tmp_tables,
-                                               joins)
-
-        # Base query
-        stm = 'SELECT %s FROM "%s"' % (', '.join(select), space._table)
-        if joins:
-            stm += ' ' + ' '.join(joins)
-
-        # Where clause
-        where = []
-        msrs = (f for f in fields if isinstance(f, Measure))
-        zero_cond = ' OR '.join('%s != 0' % m.name for m in msrs)
-        if zero_cond:
-            where.append(zero_cond)
-            stm += ' WHERE ' + zero_cond
-
-        # Group clause
-        if group_by:
-            stm += ' GROUP BY ' + ', '.join(group_by)
-
-        # print(format_query(stm, params))
-        return stm, params
-
-    def dice(self, space, fields, filters=[]):
-        stm, params = self.dice_query(space, fields, filters)
-        self.execute(stm, params)
-        res = self.cursor.fetchall()
-        return res
-
-    def build_filters(self, space, filters, tmp_tables=None, joins=None):
-        tmp_tables = tmp_tables or defaultdict(list)
-        joins = joins or []
-
-        # Create extra tmp tables for filters if not in selection
-        for fdim, coords, *depths in filters:
-            if fdim.name not in tmp_tables:
-                alias = 'tmp_%s' % self.nb_tmp
-                self.nb_tmp += 1
-                tmp_tables[fdim.name].append(alias)
-                joins.append(self.tmp_join(space, alias, fdim))
-
-        # Filters dimensions
-        for fdim, coords, *depths in filters:
-            for tt in tmp_tables[fdim.name]:
-                cond = 'SELECT child FROM %s WHERE parent in (%s)' %(
-                    fdim.closure_table,
-                    ','.join(str(c.key()) for c in coords)
-                    )
-                if depths:
-                    cond += ' AND depth in (%s)' % ','.join(map(str, depths))
-                qr = 'DELETE FROM %(tmp)s WHERE child NOT IN (%(cond)s)'
-                params = {
-                    'tmp': tt,
-                    'cond': cond
-                }
-                self.execute(qr % params)
-
-        return tmp_tables, joins
-
-    def tmp_join(self, spc, alias, dim, depth=None):
-        # Create tmp table
-        qr = 'CREATE TEMPORARY table %s ('\
-             'parent INTEGER, child INTEGER, depth INTEGER'\
-             ')' % alias
-        self.execute(qr)
-
-        # Fill it
-        if depth is None:
-            qr = 'INSERT INTO %(tmp)s (parent, child, depth) '\
-                 'SELECT parent, child, depth '\
-                 'FROM %(cls)s WHERE parent = 1'
-            params = {
-                'cls': dim.closure_table,
-                'tmp': alias,
-                }
-        else:
-            subselect = 'SELECT child from "%(cls)s" ' \
-                        'WHERE ('\
-                          'parent = 1 ' \
-                          'AND depth = %(depth)s'\
-                        ')' % {
-                            'cls': dim.closure_table,
-                            'depth': depth + 1,
-                        }
-
-            qr = 'INSERT INTO %(tmp)s (parent, child, depth) '\
-                 'SELECT parent, child, depth '\
-                 'FROM %(cls)s WHERE parent IN (%(subselect)s)'
-            params = {
-                'cls': dim.closure_table,
-                'tmp': alias,
-                'subselect': subselect,
-            }
-        self.execute(qr % params)
-
-        # Build join expression
-        join = 'JOIN %(tmp)s ON (%(tmp)s.child = "%(spc)s"."%(dim)s")'
-        params = {
-            'dim': dim.name,
-            'spc': spc._table,
-            'tmp': alias,
-        }
-        return join % params
-
-    def delete(self, space, filters):
-        filters = filters or []
-        query = 'DELETE FROM %s' % space._table
-        tmp_tables, joins = self.build_filters(space, filters)
-        conditions = []
-        for dim, tables in tmp_tables.items():
-            for table in tables:
-                cond = '%s in (SELECT child from %s)' % (dim, table)
-                conditions.append(cond)
-        if conditions:
-            query +=  ' WHERE ' + ' AND '.join(conditions)
-        self.execute(query)
-
-    def snapshot(self, space, other_space, select, filters, to_delete):
-        # Delete existing data
-        self.delete(other_space, to_delete)
-
-        # Copy into other_space
-        dice_stm , dice_params = self.dice_query(space, select, filters)
-        stm = 'INSERT INTO %s ' % other_space._table
-        stm = stm + dice_stm
-        self.execute(stm, dice_params)
-        return self.size(other_space)
-
-    def size(self, spc):
-        qr = 'SELECT count(*) FROM %s' % spc._table
-        cnt, = self.execute(qr).fetchone()
-        return cnt
-
-    def glob(self, dim, parent_id, parent_depth, values, filters=[]):
-        depth = len(values)
-        query_args = {
-            'parent_id': parent_id,
-            'depth': depth,
-        }
-        format_args = {
-            'cls': dim.closure_table,
-            'dim': dim.table,
-        }
-        select = 'SELECT child from %(cls)s WHERE ' \
-                 'parent = :parent_id AND depth = :depth'
-
-        # Add condtions defined by value
-        conditions = []
-        for pos, name in enumerate(values):
-            if name is None:
-                continue
-            query_args['name_%s' % pos] = name
-            query_args['depth_%s' % pos] = depth - pos - 1
-            cond = 'child IN ('\
-                   'SELECT child FROM %(cls)s '\
-                   'JOIN %(dim)s ON (parent=id) '\
-                   'WHERE name = :name_%(pos)s AND depth=:depth_%(pos)s)' % {
-                       'cls': dim.closure_table,
-                       'dim': dim.table,
-                       'pos': pos,
-                   }
-            conditions.append(cond)
-
-        # Add conditions defined by filters
-        total_depth = parent_depth + depth
-        for key_depths in filters:
-            sub_conds = []
-            for key, filter_depth in key_depths:
-                select_field, cond_field = 'child', 'parent'
-                if filter_depth > total_depth:
-                    select_field, cond_field = cond_field, select_field
-
-                cond_field = 'parent' if filter_depth < total_depth else 'child'
-                delta = abs(filter_depth - total_depth)
-                sub_sel = 'SELECT %(select_field)s FROM %(cls)s WHERE '\
-                          '(%(cond_field)s = %(key)s AND depth = %(delta)s)' % {
-                              'select_field': select_field,
-                              'cond_field': cond_field,
-                              'key': key,
-                              'delta': delta,
-                              'cls': dim.closure_table,
-                          }
-                sub_conds.append(sub_sel)
-
-            cond = 'child in (%s)' % ' UNION '.join(sub_conds)
-            conditions.append(cond)
-
-        query = select
-        if conditions:
-            query += ' AND ' + ' AND '.join(conditions)
-
-        self.execute(query % format_args, query_args)
-        return self.cursor.fetchall()
+    def dice_join(self, queries, nb_dims, filters=None):
+        with self.function_errors():
+            return super(SqliteBackend, self).dice_join(queries, nb_dims,
+                                                        filters)
 
     def close(self, rollback=False):
         # Remove previous tmp tables if any
-        for i in range(self.nb_tmp): # FIXME will fail with multi-threads
-            table = 'tmp_%s' % i
-            self.execute('DROP TABLE %s' % table)
-        self.nb_tmp = 0
+        self.drop_tmp_tables() # FIXME will fail with multi-threads
 
         if rollback:
             self.connection.rollback()
@@ -612,71 +272,13 @@ class SqliteBackend(SqlBackend):
             else:
                 yield col_name, 'measure', col_type, None
 
-    def search(self, dim, substring, max_depth):
-        if max_depth is None:
-            query = 'SELECT name, null FROM %(dim)s ' \
-                    'WHERE name like ? '\
-                    'ORDER BY name'
-            args = ('%' + substring + '%',)
-        else:
-            query = 'SELECT name, depth FROM %(dim)s ' \
-                    'JOIN %(cls)s ON (parent = 1 and child = id) '\
-                    'WHERE name like ? AND depth <= ?'\
-                    'GROUP BY name, depth '\
-                    'ORDER BY depth, name '\
-                    % {
-                        'dim': dim.table,
-                        'cls': dim.closure_table,
-                    }
-            args = ('%' + substring + '%', max_depth)
-
-        return self.execute(query, args)
-
-    def get_profiles(self, spc, sort_on=('size', 'ASC')):
-        names = [d.name for d in spc._dimensions]
-        sort_field, sort_dir = sort_on
-        qr = 'SELECT _id, _size, %s from %s order by _%s %s' % (
-            ', '.join(names),
-            spc._pfl_table,
-            sort_field,
-            sort_dir,
-        )
-
-        for row in self.execute(qr):
-            id_ = row[0]
-            size = row[1]
-            values = dict(zip(names, row[2:]))
-            yield id_, size, values
-
-    def set_profile(self, spc, id_, size):
-        qr = 'UPDATE %s set _size = ? where _id = ?' % spc._pfl_table
-        self.execute(qr, (size, id_))
-
-    def inc_profile(self, spc, sgn, inc):
-        cond = ['%s = ?' % name for name, _ in sgn]
-        qr = 'SELECT _id, _hits from %s where %s' % (
-            spc._pfl_table,
-            ' AND '.join(cond),
-        )
-        values = tuple(depth for _, depth in sgn)
-        res = self.execute(qr, values).fetchone()
-        if res is not None:
-            # Increment existing counter
-            id_, hits = res
-            qr = 'UPDATE %s SET _hits = ? WHERE _id = ?' % spc._pfl_table
-            self.execute(qr, (hits + inc, id_))
-            return hits + inc
-
-        # Create counter
-        qr = 'INSERT INTO %s (_hits, %s) VALUES (?, %s)' % (
-            spc._pfl_table,
-            ', '.join(name for name, _ in sgn),
-            ', '.join('?' for _ in sgn),
-        )
-        self.execute(qr, (inc,) + values)
-        return inc
-
-    def reset_profile(self, spc, ghost_spc, id_):
-        self.set_profile(spc, id_, size=None)
-        qr = 'DROP TABLE IF EXISTS %s' % ghost_spc._table
-        self.execute(qr)
+    def search_cond(self, dim):
+        if dim.search_index and self.fts_exists(dim):
+            # The trigram index also supports LIKE patterns
+            return 'id IN (SELECT rowid FROM %s WHERE name LIKE ?)' % (
+                dim.fts_table)
+        return super(SqliteBackend, self).search_cond(dim)
+
+    def function_expr(self, msr, args):
+        # Computed measures register compute as an SQL function
+        return '%s(%s)' % (msr.sql_name, ', '.join(args))
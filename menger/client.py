@@ -0,0 +1,42 @@
+'''
+Thin client of the query server started with Cli.serve (the --serve
+option of Cli.run), queries use the syntax of the command line helper:
+
+    python -m menger.client /tmp/menger.sock dice date total
+'''
+import argparse
+import json
+import socket
+import sys
+
+
+def request(path, query, space=None, fmt=None):
+    '''
+    Send query (a list of arguments) to the server listening on the
+    unix socket path and return its response, a dict with either an
+    output or an error key.
+    '''
+    msg = {'query': list(query), 'space': space, 'format': fmt}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(msg).encode() + b'\n')
+        with sock.makefile('rb') as fh:
+            return json.loads(fh.readline().decode())
+
+
+def main(path, query, space=None, fmt=None):
+    'Print the output of query, exit on errors'
+    response = request(path, query, space=space, fmt=fmt)
+    if 'error' in response:
+        exit('Error: %s' % response['error'])
+    sys.stdout.write(response['output'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Menger client.')
+    parser.add_argument('socket')
+    parser.add_argument('query', nargs='+')
+    parser.add_argument('--space', '-s')
+    parser.add_argument('--format', '-f', default='col')
+    args = parser.parse_args()
+    main(args.socket, args.query, space=args.space, fmt=args.format)
@@ -10,12 +10,16 @@ head = lambda x: tuple(takewhile(not_none, x))
 KEY_CACHE = {}
 NAME_CACHE = {}
 TUPLE_CACHE = {}
+LAST_CACHE = {}
+CHILDREN_CACHE = {}
 
 def clear_dimension_cache():
-    global KEY_CACHE, NAME_CACHE, TUPLE_CACHE
+    global KEY_CACHE, NAME_CACHE, TUPLE_CACHE, LAST_CACHE, CHILDREN_CACHE
     KEY_CACHE = {}
     NAME_CACHE = {}
     TUPLE_CACHE = {}
+    LAST_CACHE = {}
+    CHILDREN_CACHE = {}
 register('clear_cache', clear_dimension_cache)
 
 
@@ -26,13 +30,16 @@ def iindex(iterable, position):
 
 class Dimension(object):
 
-    def __init__(self, label, type=str, alias=None, fmt='leaf'):
+    def __init__(self, label, type=str, alias=None, fmt='leaf',
+                 search_index=False):
         self.label = label
         self.type = type
         self.name = None
         self.alias = alias
         self.table = None
         self.fmt = fmt
+        # Maintain a full-text (trigram) index on names for search
+        self.search_index = search_index
 
         if self.type == str:
             self.sql_type = 'varchar'
@@ -50,6 +57,7 @@ class Dimension(object):
         table = (self.alias or self.name).lower()
         self.table = table + '_dim'
         self.closure_table = table + '_cls'
+        self.fts_table = table + '_fts'
 
     def expand(self, values):
         return values
@@ -96,6 +104,27 @@ class Dimension(object):
 
         raise ValueError("Unexpected value %s" % value)
 
+    def format_key(self, coord_id, fmt=None):
+        '''
+        Format coordinate id according to fmt: None (name tuple),
+        'full' (formatted string), 'leaf' (last name) or 'auto' (use
+        dimension fmt). 'key' returns the id itself and 'lazy' a
+        LazyCoordinate.
+        '''
+        if fmt == 'auto':
+            fmt = self.fmt
+        if fmt is None:
+            return self.name_tuple(coord_id)
+        elif fmt == 'full':
+            return self.format(self.name_tuple(coord_id))
+        elif fmt == 'leaf':
+            return self.get_name(coord_id)
+        elif fmt == 'key':
+            return coord_id
+        elif fmt == 'lazy':
+            return LazyCoordinate(self, coord_id)
+        raise ValueError('Unexpected format "%s"' % fmt)
+
     def contains(self, coord):
         return self.key(coord) is not None
 
@@ -117,6 +146,8 @@ class Dimension(object):
 
 class Level:
 
+    __slots__ = ('name', 'label', 'depth', 'dim')
+
     def __init__(self, name, label, depth, dim):
         self.name = name
         self.label = label
@@ -135,8 +166,10 @@ class Tree(Dimension):
 
     '''
 
-    def __init__(self, label, levels=None, type=str, alias=None, fmt='leaf'):
-        super(Tree, self).__init__(label, type=type, alias=alias, fmt=fmt)
+    def __init__(self, label, levels=None, type=str, alias=None, fmt='leaf',
+                 search_index=False):
+        super(Tree, self).__init__(label, type=type, alias=alias, fmt=fmt,
+                                   search_index=search_index)
         if not levels:
             levels = [(label, label)]
         elif not isinstance(levels[0], tuple):
@@ -158,6 +191,17 @@ class Tree(Dimension):
     def tuple_cache(self):
         return TUPLE_CACHE.setdefault(self.name, {})
 
+    @property
+    def children_cache(self):
+        # Map each id to the list of (name, id) of its children, built
+        # from name_cache
+        if self.name not in CHILDREN_CACHE:
+            children = {}
+            for cid, (name, parent) in self.name_cache.items():
+                children.setdefault(parent, []).append((name, cid))
+            CHILDREN_CACHE[self.name] = children
+        return CHILDREN_CACHE[self.name]
+
     def delete(self, coord):
         coord_id = self.key(coord)
         if not coord_id:
@@ -183,7 +227,23 @@ class Tree(Dimension):
         return self.key_cache.get(coord)
 
     def get_name(self, coord_id):
-        return self.name_cache[coord_id][0]
+        # The root is not in name_cache, and has no name
+        return self.name_cache.get(coord_id, (None,))[0]
+
+    def ancestor(self, coord_id, steps=1):
+        'Return the id of the ancestor located steps levels higher'
+        for _ in range(steps):
+            coord_id = self.name_cache[coord_id][1]
+        return coord_id
+
+    def top(self, coord_id):
+        'Return the id of the first level ancestor of coord_id'
+        root_id = self.key(tuple())
+        parent = self.name_cache[coord_id][1]
+        while parent != root_id:
+            coord_id = parent
+            parent = self.name_cache[coord_id][1]
+        return coord_id
 
     def name_tuple(self, coord_id):
         res = self.tuple_cache.get(coord_id)
@@ -212,6 +272,7 @@ class Tree(Dimension):
         new_id = ctx.db.create_coordinate(self, name, parent)
         self.key_cache[coord] = new_id
         self.name_cache[new_id] = (name, parent)
+        CHILDREN_CACHE.pop(self.name, None)
         return new_id
 
     def drill(self, values=tuple()):
@@ -223,18 +284,54 @@ class Tree(Dimension):
             yield name
 
     def glob(self, value, filters=[]):
-        key_depths = []
-        for vals in filters:
-            key_depths.append([(self.key(v), len(v)) for v in vals])
-
         h = head(value)
         tail = value[len(h):]
         key_depths = []
         for values in filters:
             key_depths.append([(self.key(v), len(v)) for v in values])
 
-        res = ctx.db.glob(self, self.key(h), len(h), tail, key_depths)
-        return [self.name_tuple(child_id) for child_id, in res]
+        parent_id = self.key(h)
+        if self.name in NAME_CACHE:
+            # Dimension already loaded, no need to query the db
+            res = self.walk(parent_id, len(h), tail, key_depths)
+        else:
+            res = (child_id for child_id, in ctx.db.glob(
+                self, parent_id, len(h), tail, key_depths))
+        return sorted(self.name_tuple(child_id) for child_id in res)
+
+    def walk(self, parent_id, parent_depth, values, key_depths):
+        '''
+        In-memory equivalent of the backend glob: yield the ids of the
+        descendants of parent_id matching values (None being a
+        wildcard) and key_depths.
+        '''
+        if parent_id is None:
+            return
+        nodes = [parent_id]
+        for name in values:
+            nodes = [
+                cid for nid in nodes
+                for cname, cid in self.children_cache.get(nid, [])
+                if name is None or cname == name
+            ]
+
+        depth = parent_depth + len(values)
+        for node in nodes:
+            for keys in key_depths:
+                if not any(self.related(node, depth, key, key_depth)
+                           for key, key_depth in keys):
+                    break
+            else:
+                yield node
+
+    def related(self, coord_id, depth, other_id, other_depth):
+        # Returns True if one coordinate is an ancestor of (or equal
+        # to) the other one
+        if other_id is None:
+            return False
+        if other_depth <= depth:
+            return self.ancestor(coord_id, depth - other_depth) == other_id
+        return self.ancestor(other_id, other_depth - depth) == coord_id
 
     def explode(self, coord):
         if coord is None:
@@ -271,13 +368,14 @@ class Tree(Dimension):
         ctx.db.reparent(self, record_id, new_parent_id)
 
         # Merge any resulting duplicate
-        ctx.db.merge(self, new_parent_id, iter_spaces())
+        nb_moved = ctx.db.merge(self, [new_parent_id], iter_spaces())
 
         # Prune old parent
         ctx.db.prune(self, self.key(curr_parent))
 
         # Reset cache
         trigger('clear_cache')
+        return nb_moved
 
     def rename(self, coord, new_name):
         # Late import to avoid loop
@@ -288,19 +386,60 @@ class Tree(Dimension):
 
         # Merge any resulting duplicate
         parent_id = self.key(coord[:-1])
-        ctx.db.merge(self, parent_id, iter_spaces())
+        nb_moved = ctx.db.merge(self, [parent_id], iter_spaces())
+
+        # Reset cache
+        trigger('clear_cache')
+        return nb_moved
+
+    def restructure(self, mapping):
+        '''
+        Move and rename several nodes at once. mapping associates old
+        coordinates to new ones, e.g.: {('EU', 'BE'): ('EU', 'NL')}.
+        Nodes keep their depth. All coordinates are resolved and checked
+        against the tree before any change. Returns the number of rows
+        moved in the spaces.
+        '''
+        # Late import to avoid loop
+        from .space import iter_spaces
+
+        checked = []
+        for old, new in mapping.items():
+            old, new = self.coord(old), self.coord(new)
+            if old == new:
+                continue
+            if len(old) != len(new):
+                raise ValueError('Unable to move %s to %s, nodes must keep '
+                                 'their depth' % (old, new))
+            record_id = self.key(old)
+            if record_id is None:
+                self.unknow_coord(old)
+            checked.append((record_id, new))
+
+        if not checked:
+            return 0
+        # New parents are only created once all the moves are valid
+        moves = [(record_id, self.key(new[:-1], create=True), new[-1])
+                 for record_id, new in checked]
+        nb_moved = ctx.db.restructure(self, moves, iter_spaces())
 
         # Reset cache
         trigger('clear_cache')
+        return nb_moved
 
-    def search(self, prefix, max_depth=None):
+    def search(self, prefix, max_depth=None, limit=None):
+        '''
+        Search coordinates whose name contains prefix, returns (name,
+        depth) tuples, shallowest first.
+        '''
         if max_depth is None:
             max_depth = self.depth
-        return ctx.db.search(self, prefix, max_depth)
+        return ctx.db.search(self, prefix, max_depth, limit=limit)
 
     def clone(self, depth):
         levels = [l.name for l in self.levels.values()][:depth]
-        return Tree(self.name, levels, type=self.type, alias=self.alias)
+        return Tree(self.name, levels, type=self.type, alias=self.alias,
+                    search_index=self.search_index)
 
 
 class Date(Tree):
@@ -324,13 +463,28 @@ class Version(Tree):
             raise ValueError('Version dimension support only on level')
 
     def last_coord(self):
-        items = list(self.drill(tuple()))
-        if not items:
-            return None
-        return (max(items),)
+        # The cache is cleared when the dimension is modified (see
+        # Space.load and Tree.delete)
+        if self.name not in LAST_CACHE:
+            name = ctx.db.last_name(self)
+            LAST_CACHE[self.name] = None if name is None else (name,)
+        return LAST_CACHE[self.name]
+
+    def create_id(self, coord):
+        new_id = super(Version, self).create_id(coord)
+        last = LAST_CACHE.get(self.name)
+        if last is not None and coord > last:
+            LAST_CACHE[self.name] = coord
+        return new_id
+
+    def clone(self, depth):
+        return Version(self.label, type=self.type, alias=self.alias,
+                       fmt=self.fmt)
 
 class Coordinate:
 
+    __slots__ = ('dim', 'value')
+
     def __init__(self, dim, value):
         self.dim = dim
         self.value = value
@@ -342,37 +496,126 @@ class Coordinate:
         return '<Coordinate %s %s>' % (self.dim.name, self.value)
 
 
+class LazyCoordinate(Coordinate):
+
+    '''
+    Coordinate built from a key, its names are only resolved when value
+    (or its string form) is accessed. It can be used in filters.
+    '''
+
+    __slots__ = ('_key', '_value')
+
+    def __init__(self, dim, key):
+        self.dim = dim
+        self._key = key
+        self._value = None
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = self.dim.name_tuple(self._key)
+        return self._value
+
+    def key(self):
+        return self._key
+
+    def __eq__(self, other):
+        if isinstance(other, LazyCoordinate):
+            return (self.dim.name, self._key) == (other.dim.name, other._key)
+        return self.value == other
+
+    def __hash__(self):
+        return hash((self.dim.name, self._key))
+
+    def __str__(self):
+        return self.dim.format(self.value)
+
+
 class Range(Dimension):
 
     '''
-    A Range dimension contains float or int that will be partitioned
-    into custom ranges.
+    A Range dimension contains float or int values, they are stored
+    as is in the space table and grouped at query time into buckets
+    of width step, aligned on start (values outside of range_def get
+    their own buckets). A coordinate is either the lower bound of a
+    bucket or a (low, high) tuple, where low or high can be None.
     '''
 
     def __init__(self, label, range_def, type=float, alias=None, fmt='leaf'):
         super(Range, self).__init__(label, type=type, alias=alias, fmt=fmt)
-        start, stop, step = range_def
-        self.ranges = [(i , i + step) for i in range(start, stop, step)]
-        self.levels = {label: Level(label, label, 0, self)}
+        self.start, self.stop, self.step = map(type, range_def)
+        self.levels = {label: Level(label, label, 1, self)}
         self.depth = 1
 
+    def set_name(self, name):
+        # No dimension table, values are stored in the space table
+        self.name = name
+
     def __getitem__(self, level_id):
         return self.levels[self.label]
 
-    def _get_key(self, coord):
+    def key(self, coord, create=False):
         return coord
 
+    def coord(self, value=None):
+        if value is None:
+            return None
+        if isinstance(value, (tuple, list)):
+            return tuple(None if v is None else self.type(v) for v in value)
+        return self.type(value)
+
+    def bounds(self, coord):
+        'Return the (low, high) bounds of coord, high is excluded'
+        coord = self.coord(coord)
+        if isinstance(coord, tuple):
+            return coord
+        return coord, coord + self.step
+
+    def aligned(self, coord):
+        'True if the bounds of coord are on bucket edges'
+        return all(v is None or (v - self.start) % self.step == 0
+                   for v in self.bounds(coord))
+
+    def sql(self, col):
+        'Return the SQL expression computing the bucket of column col'
+        pos = '((%s - %r) * 1.0 / %r)' % (col, self.start, self.step)
+        # Casts truncate (or round) towards zero, shift negative values
+        floor = '(CAST(%s AS INTEGER) - ' \
+                'CAST((CAST(%s AS INTEGER) > %s) AS INTEGER))' % (
+                    pos, pos, pos)
+        return '(%r + %r * %s)' % (self.start, self.step, floor)
+
+    def ancestor(self, coord_id, steps=1):
+        # All buckets are children of the root
+        return None
+
     def get_name(self, coord_id):
-        return '%s - %' % coord_id
+        if coord_id is None:
+            return None
+        return self.format(self.name_tuple(coord_id))
 
     def name_tuple(self, coord_id):
-        return '%s - %' % coord_id
+        if coord_id is None:
+            return tuple()
+        return self.bounds(coord_id)
 
     def drill(self, values=tuple()):
-        return self.ranges
+        # Yield the buckets of range_def
+        pos = 0
+        low = self.start
+        while low < self.stop:
+            yield low
+            pos += 1
+            low = self.start + pos * self.step
 
     def glob(self, value, filters=[]):
-        return [self.name_tuple(r) for r in self.ranges]
+        return [self.name_tuple(low) for low in self.drill()]
 
     def format(self, value, fmt_type=None, offset=None):
-        return '/'.join(str(i) for i in islice(value, offset, None))
+        if not value:
+            return ''
+        return '%s - %s' % tuple(value)
+
+    def clone(self, depth):
+        return Range(self.label, (self.start, self.stop, self.step),
+                     type=self.type, alias=self.alias, fmt=self.fmt)
@@ -1,15 +1,28 @@
 from collections import defaultdict
-from itertools import product, chain
+from functools import reduce
+from itertools import chain
+from operator import mul
 import locale
 import re
 
-from pandas import DataFrame
+from pandas import DataFrame, Index, MultiIndex
 
-from . import get_space
-from . import dimension
+from . import get_space, UserError
+from .space import dice_join, dice_join_arrow
+from . import dimension, measure
 
 LEVEL_RE = re.compile('^(.+)\[(.+)\]$')
 
+# Maximum number of cells generated when zero lines are not skipped
+MAX_CELLS = 10**7
+# How to total the columns of each measure type, other measures are
+# not additive (averages, distinct counts, quantiles)
+TOTALS = ((measure.Min, 'min'), (measure.Max, 'max'), (measure.Sum, 'sum'))
+
+
+class LimitException(UserError):
+    pass
+
 
 def get_label(item):
     if isinstance(item, dimension.Level):
@@ -29,6 +42,96 @@ def dice_by_spc(space, select, filters=None, dim_fmt='leaf'):
     return df
 
 
+def share_dimensions(space, dims):
+    'True if space uses the same dimension tables than dims'
+    for attr in dims:
+        dim = getattr(attr, 'dim', attr)
+        if not hasattr(space, dim.name):
+            return False
+        if dim.table is None:
+            # Range buckets may differ between spaces
+            return False
+        if space.get_dimension(dim.name).table != dim.table:
+            return False
+    return True
+
+
+def dice_by_key(dims, idx, spaces, filters):
+    columns = list(idx)
+    labels = [get_label(m) for _, msrs in spaces for m in msrs]
+    for space, msrs in spaces:
+        for msr in msrs:
+            label = get_label(msr)
+            if labels.count(label) > 1:
+                label = '%s - %s' % (label, space._label)
+            columns.append(label)
+
+    table = dice_join_arrow(dims, spaces, filters=filters)
+    if table is not None:
+        data = table.to_pandas()
+        data.columns = columns
+        return data
+    res = dice_join(dims, spaces, filters=filters)
+    return DataFrame.from_records(res, columns=columns)
+
+
+def format_keys(keys, dims, idx, name, dim_fmt):
+    '''
+    Return the labels of the dimension keys contained in the column
+    name, keys of other columns are returned as is.
+    '''
+    if name not in idx:
+        return list(keys)
+    attr = dims[idx.index(name)]
+    dim = getattr(attr, 'dim', attr)
+    memo = {}
+    labels = []
+    for key in keys:
+        if key not in memo:
+            memo[key] = dim.format_key(key, dim_fmt)
+        labels.append(memo[key])
+    return labels
+
+
+def column_total(msr, values):
+    '''
+    Return the formatted total of values (a column of msr where
+    missing cells are NaN), an empty string if msr is not additive.
+    '''
+    for cls, method in TOTALS:
+        if isinstance(msr, cls):
+            total = getattr(values, method)()
+            if total != total:
+                # Only NaN's
+                return ''
+            return msr.format(total)
+    return ''
+
+
+def expand(data, idx, max_cells=MAX_CELLS):
+    '''
+    Reindex data on the cartesian product of the distinct values of
+    the idx columns, missing combinations are filled with NaN.
+    '''
+    # tupleize_cols=False keeps tuple values (when dim_fmt is None)
+    # from being interpreted as multi-level labels
+    levels = [Index(data[i].drop_duplicates(), tupleize_cols=False)
+              for i in idx]
+    nb_cells = reduce(mul, map(len, levels), 1)
+    if nb_cells > max_cells:
+        raise LimitException(
+            'Result too large: %s combinations (maximum is %s), use '
+            'filters or skip_zero' % (nb_cells, max_cells))
+
+    if len(idx) == 1:
+        full_idx = DataFrame({idx[0]: levels[0]})
+    else:
+        full_idx = MultiIndex.from_product(levels, names=idx).to_frame(
+            index=False)
+    # Unlike a reindex, the merge accepts labels repeated across rows
+    return full_idx.merge(data, on=idx, how='left')
+
+
 def dice(query):
     fltrs = query.get('filters', [])
     msr_group = defaultdict(list)
@@ -87,26 +190,31 @@ def dice(query):
         cond = dim.match(*(tuple(v) for v in vals))
         filters.append(cond)
 
-    data = None
     dim_fmt = query.get('dim_fmt', 'auto')
-    for spc, msrs in msr_group.items():
-        space = get_space(spc)
-        select = dims + msrs
-        spc_data = dice_by_spc(space, select, filters=filters, dim_fmt=dim_fmt)
-        if data is None:
-            data = spc_data
-        else:
-            suffixes = [' - %s' % s._label for s in (space, prev_space)]
-            data = data.merge(spc_data, on=idx, suffixes=suffixes)
-        prev_space = space
+    spaces = [(get_space(spc), msrs) for spc, msrs in msr_group.items()]
+    keyed = all(share_dimensions(space, dims) for space, _ in spaces)
+    if keyed:
+        # Join on dimension keys in the db, labels are computed at the
+        # end on the final result. Rows are grouped on keys: coordinates
+        # sharing a label (e.g. the months of different years with the
+        # leaf format) stay on distinct rows
+        data = dice_by_key(dims, idx, spaces, filters)
+    else:
+        data = None
+        for space, msrs in spaces:
+            select = dims + msrs
+            spc_data = dice_by_spc(space, select, filters=filters,
+                                   dim_fmt=dim_fmt)
+            if data is None:
+                data = spc_data
+            else:
+                suffixes = [' - %s' % s._label for s in (space, prev_space)]
+                data = data.merge(spc_data, on=idx, suffixes=suffixes)
+            prev_space = space
 
     # Generate all combination of selected dimensions
     if not query.get('skip_zero') and idx:
-        full_idx = DataFrame(
-            list(product(*(data[i].drop_duplicates() for i in idx))),
-            columns=idx
-        )
-        data = full_idx.merge(data, on=idx, how='left')
+        data = expand(data, idx, query.get('max_cells', MAX_CELLS))
 
     # Pivot dataframe
     pivot = query.get('pivot_on')
@@ -119,16 +227,39 @@ def dice(query):
                 # Interpret pivot as select item
                 pivot[pos] = to_label.get(name, name)
         data = data.set_index(idx).unstack(level=pivot)
+        if keyed:
+            columns = MultiIndex.from_arrays([
+                format_keys(data.columns.get_level_values(pos), dims, idx,
+                            name, dim_fmt)
+                for pos, name in enumerate(data.columns.names)
+            ], names=data.columns.names)
+            # Keys were unstacked in id order, sort on labels (measures
+            # keep their order)
+            msr_pos = {}
+            for column in columns:
+                msr_pos.setdefault(column[0], len(msr_pos))
+            order = sorted(range(len(columns)), key=lambda pos: (
+                msr_pos[columns[pos][0]], columns[pos][1:]))
+            data = data.iloc[:, order]
+            data.columns = columns[order]
         data.reset_index(inplace=True)
         headers = list(zip(*list(data.columns.values)))
 
     else:
         headers = [list(data.columns.values)]
+
+    if keyed:
+        for column in data.columns.values:
+            name = column[0] if isinstance(column, tuple) else column
+            if name in idx:
+                data[column] = format_keys(data[column], dims, idx, name,
+                                           dim_fmt)
     # Hide empty lines
     if query.get('skip_zero'):
         data.dropna(how='all', inplace=True)
 
-    # Replace NaN's with zero
+    # Replace NaN's with zero (they are kept out of totals)
+    missing = data.isna()
     data.fillna(0, inplace=True)
 
     # Apply limit & sort
@@ -148,17 +279,19 @@ def dice(query):
     totals = [''] * len(data.columns)
     all_msrs = list(chain(*msr_group.values()))
     by_labels = {get_label(f): f for f in all_msrs}
+    values = lambda pos: data.iloc[:, pos].mask(
+        missing.iloc[:, pos].loc[data.index])
     if pivot is not None:
         for pos, column in enumerate(data.columns.values):
             field = by_labels.get(column[0])
             if field is None:
                 continue
-            totals[pos] = field.format(data.iloc[:, pos].sum())
+            totals[pos] = column_total(field, values(pos))
 
     else:
         for mpos, m in enumerate(all_msrs):
             pos = mpos + len(dims)
-            totals[pos] = m.format(data.iloc[:, pos].sum())
+            totals[pos] = column_total(m, values(pos))
 
     # We did pass measure formating to space.dice to make above sort
     # works, so we do it now
@@ -173,7 +306,7 @@ def dice(query):
         else:
             for mpos, m in enumerate(all_msrs):
                 pos = mpos + len(dims)
-                data.iloc[:, pos] = data.iloc[:, pos].apply(m.format)
+                data.isetitem(pos, data.iloc[:, pos].apply(m.format))
 
     return {
         'data': data,
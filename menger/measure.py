@@ -1,13 +1,40 @@
 import locale
 
+from . import sketch
+from .sketch import (DDSketch, HyperLogLog, dds_quantile, hll_estimate,
+                     merge_bytes)
+
+# SQL functions installed on each connection: name -> (number of
+# arguments, implementation, is aggregate)
+SQL_FUNCTIONS = {}
+# SQL names of the compute methods: (function, number of arguments) ->
+# name
+_computed_names = {}
+
+def sql_function(name, nb_args, fn, aggregate=False):
+    'Register fn to be installed as name on database connections'
+    SQL_FUNCTIONS[name] = (nb_args, fn, aggregate)
+
+for name, (nb_args, fn) in sketch.AGGREGATES.items():
+    sql_function(name, nb_args, fn, aggregate=True)
+for name, (nb_args, fn) in sketch.FUNCTIONS.items():
+    sql_function(name, nb_args, fn)
+
+
 class Measure(object):
 
+    __slots__ = ('label', 'name', 'type', 'format_fn')
+
     def __init__(self, label, type=float):
         self.label = label
         self.name = None
         self.type = type
+        # Custom format function defined on the space
+        self.format_fn = None
 
     def format(self, value, fmt_type=None):
+        if self.format_fn is not None:
+            return self.format_fn(value)
         if self.type == float:
             return locale.format('%.2f', value)
         return self.type(value)
@@ -31,10 +58,18 @@ class Measure(object):
         return '<Measure %s>' % self.name
 
 
-class Sum(Measure):
+class Stored(Measure):
+
+    '''
+    Base class of the measures stored in the space table. Each
+    measure defines how values are aggregated (in Python and in SQL)
+    and how two rows are merged.
+    '''
+
+    __slots__ = ('sql_type',)
 
     def __init__(self, label, type=float):
-        super(Sum, self).__init__(label, type=type)
+        super(Stored, self).__init__(label, type=type)
         if self.type == int:
             self.sql_type = 'integer'
         elif self.type == float:
@@ -44,30 +79,229 @@ class Sum(Measure):
                 type, label
             ))
 
+    def from_point(self, point):
+        'Return the value to store for point'
+        return point[self.name]
+
+    def increment(self, old_value, new_value):
+        raise NotImplementedError
+
+    def sql_agg(self, col):
+        'Return the SQL aggregate of column col'
+        raise NotImplementedError
+
+    def sql_merge(self, old, new):
+        'Return the SQL expression merging two stored values'
+        raise NotImplementedError
+
+    def sql_final(self, expr):
+        'Return the SQL expression of the final value of an aggregate'
+        return expr
+
+    def finalize(self, value):
+        'Return the final value of an aggregate'
+        return value
+
+    def nonzero_sql(self, col):
+        '''
+        Return the SQL condition matching non-empty values, None if
+        all values are meaningful.
+        '''
+        return None
+
+    def is_zero(self, value):
+        return False
+
+    def clone(self):
+        return self.__class__(self.label, self.type)
+
+
+class Sum(Stored):
+
+    __slots__ = ()
+
     def increment(self, old_value, new_value):
         return old_value + new_value
 
+    def sql_agg(self, col):
+        return 'sum(%s)' % col
+
+    def sql_merge(self, old, new):
+        return '%s + %s' % (old, new)
+
+    def nonzero_sql(self, col):
+        return '%s != 0' % col
+
+    def is_zero(self, value):
+        return value == 0
+
+
+class Count(Sum):
+
+    '''
+    Count loaded points, the space needs no input value for it.
+    '''
+
+    __slots__ = ()
+
+    def __init__(self, label):
+        super(Count, self).__init__(label, type=int)
+
+    def from_point(self, point):
+        return 1
+
     def clone(self):
-        return Sum(self.label, self.type)
+        return Count(self.label)
+
+
+class Min(Stored):
+
+    __slots__ = ()
+
+    def increment(self, old_value, new_value):
+        return min(old_value, new_value)
+
+    def sql_agg(self, col):
+        return 'min(%s)' % col
+
+    def sql_merge(self, old, new):
+        return 'CASE WHEN %s < %s THEN %s ELSE %s END' % (old, new, old, new)
+
+
+class Max(Stored):
+
+    __slots__ = ()
+
+    def increment(self, old_value, new_value):
+        return max(old_value, new_value)
+
+    def sql_agg(self, col):
+        return 'max(%s)' % col
+
+    def sql_merge(self, old, new):
+        return 'CASE WHEN %s > %s THEN %s ELSE %s END' % (old, new, old, new)
+
+
+class CountDistinct(Stored):
+
+    '''
+    Approximate count of distinct values, based on a HyperLogLog
+    sketch of 2**precision bytes stored in each row.
+    '''
+
+    __slots__ = ('precision',)
+
+    def __init__(self, label, precision=10):
+        super(CountDistinct, self).__init__(label, type=int)
+        self.sql_type = 'blob'
+        self.precision = precision
+
+    def from_point(self, point):
+        return HyperLogLog.from_value(
+            point[self.name], self.precision).to_bytes()
+
+    def increment(self, old_value, new_value):
+        return merge_bytes(HyperLogLog, old_value, new_value)
+
+    def sql_agg(self, col):
+        return 'hll_agg(%s)' % col
+
+    def sql_merge(self, old, new):
+        return 'hll_merge(%s, %s)' % (old, new)
+
+    def sql_final(self, expr):
+        return 'hll_estimate(%s)' % expr
+
+    def finalize(self, value):
+        return hll_estimate(value)
+
+    def clone(self):
+        return CountDistinct(self.label, self.precision)
+
+
+class Quantile(Stored):
+
+    '''
+    Approximate quantile q of the loaded values, based on a DDSketch
+    with a relative accuracy of alpha.
+    '''
+
+    __slots__ = ('q', 'alpha')
+
+    def __init__(self, label, q=0.5, alpha=0.01):
+        super(Quantile, self).__init__(label, type=float)
+        self.sql_type = 'blob'
+        self.q = q
+        self.alpha = alpha
+
+    def from_point(self, point):
+        return DDSketch.from_value(point[self.name], self.alpha).to_bytes()
+
+    def increment(self, old_value, new_value):
+        return merge_bytes(DDSketch, old_value, new_value)
+
+    def sql_agg(self, col):
+        return 'dds_agg(%s)' % col
+
+    def sql_merge(self, old, new):
+        return 'dds_merge(%s, %s)' % (old, new)
+
+    def sql_final(self, expr):
+        return 'dds_quantile(%s, %r)' % (expr, self.q)
+
+    def finalize(self, value):
+        return dds_quantile(value, self.q)
+
+    def clone(self):
+        return Quantile(self.label, self.q, self.alpha)
 
 
 class Computed(Measure):
 
+    __slots__ = ('args', 'sql_name')
+
     def __init__(self, label,  *args):
         self.args = args
         super(Computed, self).__init__(label)
+        # Make compute available as an SQL function, shared by all the
+        # instances (and clones) of the class: compute must only depend
+        # on its arguments
+        key = (type(self).compute, len(args))
+        self.sql_name = _computed_names.get(key)
+        if self.sql_name is None:
+            self.sql_name = 'computed_%s' % len(_computed_names)
+            _computed_names[key] = self.sql_name
+            sql_function(self.sql_name, len(args), self.compute)
 
     def compute(self, *args):
         raise NotImplementedError
 
+    def clone(self):
+        return self.__class__(self.label, *self.args)
+
+    def sql(self, *args):
+        '''
+        Return the SQL expression equivalent to compute, args are the
+        SQL expressions of the measure arguments. None means that the
+        backend has to call compute itself (as an SQL function if it
+        supports it).
+        '''
+        return None
+
 
 class Average(Computed):
 
+    __slots__ = ()
+
     def compute(self, total, count):
         if count == 0:
             return 0
         return total / count
 
+    def sql(self, total, count):
+        return 'CASE WHEN %s = 0 THEN 0 ELSE 1.0 * %s / %s END' % (
+            count, total, count)
+
     def aggregator(self):
         cnt = 0
         total = 0
@@ -85,8 +319,13 @@ class Average(Computed):
 
 class Difference(Computed):
 
+    __slots__ = ()
+
     def compute(self, first_msr, second_msr):
         return first_msr - second_msr
 
+    def sql(self, first_msr, second_msr):
+        return '(%s - %s)' % (first_msr, second_msr)
+
     def clone(self):
         return Difference(self.label, *self.args)
@@ -0,0 +1,206 @@
+'''
+Mergeable sketches used by approximate measures. Sketches are
+serialized to bytes to be stored in the space tables, the functions at
+the end of the module allow to aggregate them in SQL.
+'''
+from hashlib import blake2b
+from json import dumps, loads
+from math import ceil, log
+
+
+class HyperLogLog:
+
+    '''
+    HyperLogLog distinct counter, with 2**precision registers (the
+    standard error is around 1.04 / sqrt(2**precision)).
+    '''
+
+    def __init__(self, precision=10, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            registers = bytearray(self.size)
+        self.registers = registers
+
+    @classmethod
+    def from_value(cls, value, precision=10):
+        hll = cls(precision)
+        hll.add(value)
+        return hll
+
+    def add(self, value):
+        digest = blake2b(str(value).encode(), digest_size=8).digest()
+        hashed = int.from_bytes(digest, 'big')
+        pos = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[pos]:
+            self.registers[pos] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Unable to merge sketches of different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def estimate(self):
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        total = sum(2.0 ** -r for r in self.registers)
+        res = alpha * self.size ** 2 / total
+        zeros = self.registers.count(0)
+        if res <= 2.5 * self.size and zeros:
+            # Small range correction
+            res = self.size * log(self.size / zeros)
+        return int(round(res))
+
+    def to_bytes(self):
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data[0], bytearray(data[1:]))
+
+
+class DDSketch:
+
+    '''
+    Quantile sketch with a relative accuracy of alpha: values are
+    counted in logarithmic buckets, so merging two sketches is adding
+    their counters.
+    '''
+
+    def __init__(self, alpha=0.01, positive=None, negative=None, zero=0):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.positive = positive or {}
+        self.negative = negative or {}
+        self.zero = zero
+
+    @classmethod
+    def from_value(cls, value, alpha=0.01):
+        sketch = cls(alpha)
+        sketch.add(value)
+        return sketch
+
+    def index(self, value):
+        return ceil(log(value, self.gamma))
+
+    def add(self, value):
+        if value > 0:
+            idx = self.index(value)
+            self.positive[idx] = self.positive.get(idx, 0) + 1
+        elif value < 0:
+            idx = self.index(-value)
+            self.negative[idx] = self.negative.get(idx, 0) + 1
+        else:
+            self.zero += 1
+
+    def merge(self, other):
+        if other.alpha != self.alpha:
+            raise ValueError('Unable to merge sketches of different accuracy')
+        for mine, theirs in ((self.positive, other.positive),
+                             (self.negative, other.negative)):
+            for idx, cnt in theirs.items():
+                mine[idx] = mine.get(idx, 0) + cnt
+        self.zero += other.zero
+        return self
+
+    def count(self):
+        return sum(self.positive.values()) + sum(self.negative.values()) \
+            + self.zero
+
+    def value(self, idx):
+        return 2 * self.gamma ** idx / (self.gamma + 1)
+
+    def quantile(self, q):
+        total = self.count()
+        if total == 0:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        # Iterate on buckets from the smallest value to the largest
+        for idx in sorted(self.negative, reverse=True):
+            seen += self.negative[idx]
+            if seen > rank:
+                return -self.value(idx)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for idx in sorted(self.positive):
+            seen += self.positive[idx]
+            if seen > rank:
+                return self.value(idx)
+        return self.value(max(self.positive))
+
+    def to_bytes(self):
+        return dumps([self.alpha, self.zero, list(self.positive.items()),
+                      list(self.negative.items())]).encode()
+
+    @classmethod
+    def from_bytes(cls, data):
+        alpha, zero, positive, negative = loads(data.decode())
+        return cls(alpha, dict(positive), dict(negative), zero)
+
+
+def merge_bytes(sketch_cls, first, second):
+    if first is None:
+        return second
+    if second is None:
+        return first
+    sketch = sketch_cls.from_bytes(first)
+    return sketch.merge(sketch_cls.from_bytes(second)).to_bytes()
+
+
+class SketchAggregate:
+
+    sketch_cls = None
+
+    def __init__(self):
+        self.sketch = None
+
+    def step(self, value):
+        if value is None:
+            return
+        other = self.sketch_cls.from_bytes(value)
+        if self.sketch is None:
+            self.sketch = other
+        else:
+            self.sketch.merge(other)
+
+    def finalize(self):
+        if self.sketch is None:
+            return None
+        return self.sketch.to_bytes()
+
+
+class HLLAggregate(SketchAggregate):
+    sketch_cls = HyperLogLog
+
+
+class DDSAggregate(SketchAggregate):
+    sketch_cls = DDSketch
+
+
+def hll_estimate(data):
+    if data is None:
+        return 0
+    return HyperLogLog.from_bytes(data).estimate()
+
+
+def dds_quantile(data, q):
+    if data is None:
+        return None
+    return DDSketch.from_bytes(data).quantile(q)
+
+
+# SQL functions: name -> (number of arguments, implementation)
+AGGREGATES = {
+    'hll_agg': (1, HLLAggregate),
+    'dds_agg': (1, DDSAggregate),
+}
+FUNCTIONS = {
+    'hll_merge': (2, lambda a, b: merge_bytes(HyperLogLog, a, b)),
+    'hll_estimate': (1, hll_estimate),
+    'dds_merge': (2, lambda a, b: merge_bytes(DDSketch, a, b)),
+    'dds_quantile': (2, dds_quantile),
+}
@@ -1,18 +1,26 @@
 from collections import OrderedDict, defaultdict
 from copy import copy
 from hashlib import md5
-from itertools import chain
-from json import dumps
+from itertools import chain, islice, takewhile
+from json import dumps, loads
 from time import time
 
 from . import backend
-from .dimension import Coordinate, Dimension, Level, Tree, Version
-from .measure import Measure, Sum, Computed
+from .dimension import Coordinate, Dimension, Level, Range, Tree, Version
+from .measure import Measure, Stored, Sum, Computed
 from .event import trigger
 from . import ctx
 
 SPACES = {}
 SPACE_LIST = []
+PARTITIONS = {}
+# Arrow types of the columns written by export_parquet
+ARROW_TYPES = {
+    'blob': 'binary',
+    'float': 'float64',
+    'integer': 'int64',
+    'varchar': 'string',
+}
 
 class MetaSpace(type):
 
@@ -84,14 +92,21 @@ class MetaSpace(type):
 
             # Plug custom format functions
             format_fn = attrs.get('format_' + k)
-            if format_fn:
+            if format_fn and isinstance(v, Measure):
+                v.format_fn = format_fn
+            elif format_fn:
                 v.format = format_fn
 
+        partition_by = attrs.get('_partition_by')
+        if partition_by and partition_by not in (d.name for d in dimensions):
+            raise Exception(
+                'Partition dimension "%s" not found' % partition_by)
+
         attrs['_dimensions'] = dimensions
         attrs['_versioned'] = versioned
         attrs['_measures'] = measures
         attrs['_db_measures'] = [
-            m for m in measures if isinstance(m, Sum)
+            m for m in measures if isinstance(m, Stored)
         ]
 
         spc = super(MetaSpace, cls).__new__(cls, name, bases, attrs)
@@ -104,21 +119,72 @@ class MetaSpace(type):
 
 class Space(metaclass=MetaSpace):
 
-    _registered = False
     _cache_ratio = 0.1
+    _partition_by = None
 
     @classmethod
     def register(cls, init=False):
-        if cls._registered and not init:
+        '''
+        Prepare the space for the current connection and load its
+        profiles. Called by the methods using the space, it does
+        nothing if the space is already registered. Ghost spaces are
+        registered by their owner.
+        '''
+        if cls._name in ctx.db.registered and not init:
             return
-        cls._registered = True
+        if getattr(cls, '__ghost__', False):
+            return
+        ctx.db.registered.add(cls._name)
         ctx.db.register(cls, init=init)
         Profile.register(cls)
 
     @classmethod
     def refresh_cache(cls):
+        cls.register()
         Profile.register(cls, snapshot=True)
 
+    @classmethod
+    def advise_indexes(cls, min_hits=1, create=False):
+        '''
+        Use the hits of the profiles to advise covering indexes (see
+        SqlBackend.create_cover_index) on the dimensions that are not
+        leading the unique index of the space. Returns two lists of
+        (dimension name, hits) tuples: the indexes to create (created
+        on the space and its partitions if create is true) and the
+        existing ones used less than min_hits times.
+        '''
+        if not ctx.db.covering_indexes:
+            return [], []
+        if not ctx.db.readonly:
+            Profile.sync()
+
+        hits = defaultdict(int)
+        for nb_hits, sgn in ctx.db.get_hits(cls):
+            for name, depth in sgn.items():
+                if depth:
+                    hits[name] += nb_hits
+        existing = set(ctx.db.index_names(cls._table))
+
+        proposed = []
+        unused = []
+        for dim in cls._dimensions[1:]:
+            nb_hits = hits[dim.name]
+            exists = ctx.db.cover_index(cls, dim) in existing
+            if nb_hits >= min_hits and not exists:
+                proposed.append((dim.name, nb_hits))
+            elif nb_hits < min_hits and exists:
+                unused.append((dim.name, nb_hits))
+        proposed.sort(key=lambda x: -x[1])
+
+        if create and proposed:
+            spaces = [cls]
+            if cls._partition_by:
+                spaces.extend(cls.partitions())
+            for name, _ in proposed:
+                for spc in spaces:
+                    ctx.db.create_cover_index(spc, spc.get_dimension(name))
+        return proposed, unused
+
     @classmethod
     def key(cls, point, create=False):
         key = tuple(
@@ -131,12 +197,104 @@ class Space(metaclass=MetaSpace):
         return key
 
     @classmethod
-    def load(cls, points, filters=None, load_type=None):
-        nb_edit = ctx.db.load(cls, cls.convert(points, filters=filters),
-                               load_type=load_type)
+    def load(cls, points, filters=None, load_type=None, trusted=False):
+        '''
+        Load points in the space. If trusted is true, the backend may
+        skip integrity checks during the load (see bulk_load). On
+        SQLite, a trusted load first commits the pending changes of
+        the connection, they are not rolled back on close anymore.
+        '''
+        keys_vals = cls.convert(points, filters=filters)
+        if trusted:
+            with ctx.db.bulk_load(cls):
+                nb_edit = cls.load_keys(keys_vals, load_type=load_type)
+        else:
+            nb_edit = cls.load_keys(keys_vals, load_type=load_type)
         trigger('clear_cache')
         return nb_edit
 
+    @classmethod
+    def load_keys(cls, keys_vals, load_type=None):
+        '''
+        Load (keys, values) tuples (as yielded by convert), rows are
+        routed to their partitions if needed.
+        '''
+        cls.register()
+        if not cls._partition_by:
+            return ctx.db.load(cls, keys_vals, load_type=load_type)
+
+        from . import UserError
+
+        # Route rows to their partitions
+        dim = cls.get_dimension(cls._partition_by)
+        pos = cls._dimensions.index(dim)
+        root_id = dim.key(tuple())
+        by_part = defaultdict(list)
+        for key, vals in keys_vals:
+            if key[pos] == root_id:
+                raise UserError('Points of "%s" need a value on "%s" (the '
+                                'partition dimension)' % (cls._name, dim.name))
+            by_part[dim.top(key[pos])].append((key, vals))
+
+        nb_insert = nb_update = 0
+        for part_id, rows in by_part.items():
+            ins, upd = ctx.db.load(cls.partition(part_id), rows,
+                                   load_type=load_type)
+            nb_insert += ins
+            nb_update += upd
+        return nb_insert, nb_update
+
+    @classmethod
+    def partition(cls, part_id):
+        '''
+        Return the space storing the partition part_id (the id of a
+        first level coordinate of the partition dimension), its table
+        is created if needed.
+        '''
+        table = '%s_p%s' % (cls._table, part_id)
+        part = PARTITIONS.get(table)
+        if part is None:
+            values = dict((d.name, d.depth) for d in cls._dimensions)
+            part = cls.clone('p%s' % part_id, values, ghost=True,
+                             table=table)
+            part._partition_id = part_id
+            PARTITIONS[table] = part
+        ctx.db.register(part, init=True, ghost=True)
+        return part
+
+    @classmethod
+    def partitions(cls, filters=None):
+        '''
+        Return the existing partitions that may contain rows matching
+        filters.
+        '''
+        dim = cls.get_dimension(cls._partition_by)
+        part_ids = set(ctx.db.partition_ids(cls))
+        for fdim, coords, *depths in filters or []:
+            if fdim.name != dim.name:
+                continue
+            if any(not c.value for c in coords):
+                # The root matches all the partitions
+                continue
+            part_ids &= set(dim.key(tuple(c.value)[:1]) for c in coords)
+        return [cls.partition(part_id) for part_id in sorted(part_ids)]
+
+    @classmethod
+    def replace_partition(cls, value, points, load_type=None):
+        '''
+        Replace the content of the partition containing value (a
+        coordinate of the partition dimension) by points. The old
+        partition is dropped instead of deleted row by row. Points
+        outside of the partition are ignored.
+        '''
+        dim = cls.get_dimension(cls._partition_by)
+        coord = dim.coord(value)[:1]
+        if not coord:
+            raise ValueError('Unable to replace the root partition')
+        cls.delete([dim.match(coord)])
+        return cls.load(points, filters=[(dim.name, [coord])],
+                        load_type=load_type)
+
     @classmethod
     def convert(cls, points, filters=None):
         """
@@ -145,7 +303,7 @@ class Space(metaclass=MetaSpace):
         for point in points:
             if filters and not cls.match(point, filters):
                 continue
-            values = tuple(point[m.name] for m in cls._db_measures)
+            values = tuple(m.from_point(point) for m in cls._db_measures)
             coords = tuple(
                 d.key(d.coord((point[d.name])), create=True) \
                 for d in cls._dimensions
@@ -171,10 +329,107 @@ class Space(metaclass=MetaSpace):
         return True
 
     @classmethod
-    def dice(cls, select=[], filters=[], dim_fmt=None, msr_fmt=None):
+    def dice(cls, select=[], filters=[], dim_fmt=None, msr_fmt=None,
+             having=None, rollup=False):
+        '''
+        Aggregate measures along the selected levels. having is a list
+        of (measure, operator, value) conditions applied on aggregated
+        values, e.g.: [(Post.words, '>', 100)]. If rollup is true,
+        subtotal rows are appended (see Space.rollup), it can not be
+        combined with having. dim_fmt is passed to
+        Dimension.format_key, 'key' yields the raw ids and 'lazy'
+        coordinates resolved on access.
+        '''
+        cls.register()
+        plan = cls.plan(select, in_db=not rollup)
+
+        # Get best matching profile
+        spc = cls
+        profile = Profile.best(cls, plan[0], filters=filters)
+        if profile:
+            spc = profile.ghost_spc
+
+        rows = ctx.db.dice(spc, plan[0], filters,
+                           having=cls.resolve_having(having, rollup))
+        if rollup:
+            rows = cls.rollup(rows, plan[0])
+        yield from cls.compute(rows, plan, dim_fmt=dim_fmt)
+
+    @classmethod
+    def dice_many(cls, queries):
+        '''
+        Execute several dice queries (each query is a dict of dice
+        arguments). Queries sharing the same filters are answered from
+        one scan of the space, aggregated in a temporary table. Returns
+        one list of rows per query.
+        '''
+        cls.register()
+        groups = OrderedDict()
+        for pos, query in enumerate(queries):
+            key = tuple(
+                (f[0].name, tuple(tuple(c.value) for c in f[1]),
+                 tuple(f[2:]))
+                for f in query.get('filters') or [])
+            groups.setdefault(key, []).append(pos)
+
+        results = [None] * len(queries)
+        for positions in groups.values():
+            if len(positions) == 1:
+                pos, = positions
+                results[pos] = list(cls.dice(**queries[pos]))
+                continue
+
+            # Collect the deepest level of each dimension
+            plans = {}
+            depths = {}
+            for pos in positions:
+                plans[pos] = cls.plan(queries[pos].get('select', []),
+                                      in_db=not queries[pos].get('rollup'))
+                Profile.hit(cls, plans[pos][0])
+                for field in plans[pos][0]:
+                    if isinstance(field, Level):
+                        depths[field.dim.name] = max(
+                            field.depth, depths.get(field.dim.name, 0))
+            dims = [d for d in cls._dimensions if d.name in depths]
+
+            # Aggregate on the raw keys of those dimensions
+            spc = cls
+            filters = queries[positions[0]].get('filters')
+            profile = Profile.best(
+                cls, [d[depths[d.name] - 1] for d in dims], hit=False,
+                filters=filters)
+            if profile:
+                spc = profile.ghost_spc
+            table = ctx.db.materialize(spc, dims, filters)
+            values = dict((d.name, d.depth if d in dims else 0)
+                          for d in cls._dimensions)
+            batch_spc = cls.clone(table, values, ghost=True, table=table)
+
+            # Answer each query based on the aggregated table
+            for pos in positions:
+                query = queries[pos]
+                having = cls.resolve_having(query.get('having'),
+                                            query.get('rollup'))
+                rows = ctx.db.dice(batch_spc, plans[pos][0], having=having)
+                if query.get('rollup'):
+                    rows = cls.rollup(rows, plans[pos][0])
+                results[pos] = list(cls.compute(
+                    rows, plans[pos], dim_fmt=query.get('dim_fmt')))
+
+        return results
+
+    @classmethod
+    def plan(cls, select, in_db=True):
+        '''
+        Expand the select list of a dice query. Returns a tuple
+        containing the fields to query and how to evaluate computed
+        measures. If in_db is true, computed measures that have an SQL
+        form are evaluated by the database.
+        '''
         fn_msr = defaultdict(list)
         msr_idx = {}
         xtr_msr = []
+        fn_loop = []
 
         if not select:
             select = cls.all_fields()
@@ -184,6 +439,8 @@ class Space(metaclass=MetaSpace):
         # Collect computed measure from the query
         for pos, field in enumerate(select):
             if isinstance(field, Computed):
+                if in_db and cls.sql_ready(field):
+                    continue
                 select[pos] = None
                 fn_msr[field].append(pos)
             elif isinstance(field, Dimension):
@@ -233,89 +490,174 @@ class Space(metaclass=MetaSpace):
                 key=lambda x: fn_idx[x[1]],
             )
 
-        # Get best matching profile
-        spc = cls
-        profile = Profile.best(cls, select)
-        if profile:
-            spc = profile.ghost_spc
+        return select, fn_loop, msr_idx, len(xtr_msr)
 
-        rows = ctx.db.dice(spc, select, filters)
-        nb_xtr = len(xtr_msr)
+    @classmethod
+    def sql_ready(cls, msr):
+        'True if measure msr can be evaluated by the database'
+        try:
+            ctx.db.measure_expr(cls, msr)
+        except ValueError:
+            return False
+        return True
 
-        # Returns rows
-        for row in rows:
-            row = tuple(cls.format(row, select, dim_fmt=dim_fmt))
-            if not fn_msr:
-                yield row
-                continue
+    @classmethod
+    def compute(cls, rows, plan, dim_fmt=None):
+        '''
+        Format rows returned by the backend and evaluate computed
+        measures.
+        '''
+        select, fn_loop, msr_idx, nb_xtr = plan
+        fmt_cols = cls.formatters(select, dim_fmt=dim_fmt)
+        if not fn_loop:
+            if not fmt_cols:
+                yield from rows
+                return
+            for row in rows:
+                row = list(row)
+                for pos, fn in fmt_cols:
+                    row[pos] = fn(row[pos])
+                yield tuple(row)
+            return
 
-            fn_vals = []
-            fn_vals_by_name = {}
-            for pos, m in fn_loop:
-                # Build arguments and launch computation
-                args = []
-                for name in m.args:
-                    if name in msr_idx:
-                        val = row[msr_idx[name]]
-                    else:
-                        val = fn_vals_by_name[name]
-                    args.append(val)
-                val = m.compute(*args)
-                fn_vals_by_name[m.name] = val
-                # Add result to fn_vals only if it wasn't a dependency
-                if pos >= 0:
-                    fn_vals.append((pos, val))
-
-            if nb_xtr:
-                # Remove extra measures
-                row = row[:-nb_xtr]
-
-            row = tuple(cls.merge_computed_measures(row, fn_vals))
-            yield row
+        # Locate the arguments of each computed measure: a position in
+        # the row or the name of a measure computed before
+        fn_args = []
+        for _, m in fn_loop:
+            if all(m is not other for other, _ in fn_args):
+                fn_args.append((m, [(msr_idx.get(name), name)
+                                    for name in m.args]))
+        # Where to insert the results (dependencies have a negative
+        # position)
+        inserts = sorted((pos, m.name) for pos, m in fn_loop if pos >= 0)
+        width = len(select) - nb_xtr
+        for row in rows:
+            row = list(row)
+            for pos, fn in fmt_cols:
+                row[pos] = fn(row[pos])
+
+            fn_vals = {}
+            for m, args in fn_args:
+                fn_vals[m.name] = m.compute(*[
+                    fn_vals[name] if idx is None else row[idx]
+                    for idx, name in args])
+
+            # Remove extra measures and insert computed ones
+            del row[width:]
+            for pos, name in inserts:
+                row.insert(pos, fn_vals[name])
+            yield tuple(row)
 
     @classmethod
-    def format(cls, row, select, dim_fmt=None, msr_fmt=None):
-        for val, field in zip(row, select):
+    def formatters(cls, select, dim_fmt=None):
+        '''
+        Return the (position, function) tuples formatting the columns
+        of the rows of select: dimension keys (each distinct key is
+        formatted once) and stored measures with a final value.
+        '''
+        fmt_cols = []
+        for pos, field in enumerate(select):
             if isinstance(field, (Level, Coordinate)):
-                fmt = field.dim.fmt if dim_fmt == 'auto' else dim_fmt
-                if fmt is None:
-                    yield field.dim.name_tuple(val)
-                elif fmt == 'full':
-                    yield field.dim.format(field.dim.name_tuple(val))
-                elif fmt == 'leaf':
-                    yield field.dim.get_name(val)
-            else:
-                if msr_fmt is None:
-                    yield val
-                else:
-                    yield field.format(val) # TODO pass msr_fmt as argument
+                if dim_fmt != 'key':
+                    fmt_cols.append((pos, key_formatter(field.dim, dim_fmt)))
+            elif isinstance(field, Stored) and \
+                 type(field).finalize is not Stored.finalize:
+                fmt_cols.append((pos, field.finalize))
+        return fmt_cols
 
     @staticmethod
-    def merge_computed_measures(values, fn_vals):
+    def rollup(rows, select):
         '''
-        Equivalent to:
-            for pos, v in fn_val:
-                values.insert(pos, v)
-            return values
+        Yield rows followed by subtotal rows. Levels are rolled up from
+        the last one to the first one, one depth at a time: selecting
+        year and province gives subtotals on (year, region), (year)
+        and the grand total. Each subtotal is aggregated from the
+        previous one, the coordinate of a rolled up dimension being
+        its root.
         '''
-        fn_vals = iter(fn_vals)
-        fpos, fval = next(fn_vals, (None, None))
-        for pos, val in enumerate(values):
-            if fpos is not None and pos == fpos:
-                yield fval
-                fpos, fval = next(fn_vals, (None, None))
-            yield val
+        levels = [(pos, f) for pos, f in enumerate(select)
+                  if isinstance(f, Level)]
+        msrs = [(pos, f) for pos, f in enumerate(select)
+                if isinstance(f, Measure)]
+
+        current = []
+        for row in rows:
+            current.append(row)
+            yield row
+
+        for pos, level in reversed(levels):
+            dim = level.dim
+            for _ in range(level.depth):
+                totals = OrderedDict()
+                for row in current:
+                    row = list(row)
+                    row[pos] = dim.ancestor(row[pos])
+                    key = tuple(row[p] for p, _ in levels)
+                    prev = totals.get(key)
+                    if prev is None:
+                        totals[key] = row
+                        continue
+                    for mpos, msr in msrs:
+                        prev[mpos] = msr.increment(prev[mpos], row[mpos])
+                current = [tuple(row) for row in totals.values()]
+                yield from current
+
+    @classmethod
+    def resolve_having(cls, having, rollup=False):
+        if not having:
+            return None
+        if rollup:
+            # Subtotals would silently leave out the filtered groups
+            raise ValueError('having can not be combined with rollup')
+        return [(cls.get_measure(m) if isinstance(m, str) else m, op, val)
+                for m, op, val in having]
 
-        while fpos is not None:
-            yield fval
-            fpos, fval = next(fn_vals, (None, None))
+    @classmethod
+    def delete(cls, filters=None, chunk_size=None):
+        '''
+        Delete rows matching filters, returns the number of deleted
+        rows. If chunk_size is given, rows are deleted (and committed)
+        by chunks of chunk_size rows to keep transactions small, the
+        deletion is not atomic anymore.
+        '''
+        cls.register()
+        if not cls._partition_by:
+            nb_delete = ctx.db.delete(cls, filters, chunk_size=chunk_size)
+            Profile.delete(cls, filters)
+            return nb_delete
+
+        # Drop partitions fully covered by filters and delete rows in
+        # the other ones
+        nb_delete = 0
+        for part in cls.partitions(filters):
+            if cls.covers_partition(part._partition_id, filters):
+                nb_delete += ctx.db.drop(part)
+            else:
+                nb_delete += ctx.db.delete(part, filters,
+                                           chunk_size=chunk_size)
+        Profile.delete(cls, filters)
+        return nb_delete
 
     @classmethod
-    def delete(cls, filters=None):
-        ctx.db.delete(cls, filters)
+    def covers_partition(cls, part_id, filters):
+        # Returns True if all the rows of the partition match filters
+        dim = cls.get_dimension(cls._partition_by)
+        for fdim, coords, *depths in filters or []:
+            if fdim.name != dim.name or depths:
+                return False
+            for c in coords:
+                value = tuple(c.value)
+                if len(value) <= 1 and (
+                        not value or dim.key(value) == part_id):
+                    break
+            else:
+                return False
+        return True
 
     @classmethod
     def snapshot(cls, other_space, select=None, filters=None):
+        cls.register()
+        other_space.register()
         filters = filters or []
         to_delete = filters[:]
 
@@ -340,6 +682,166 @@ class Space(metaclass=MetaSpace):
         return ctx.db.snapshot(cls, other_space, select, filters=filters,
                                to_delete=to_delete)
 
+    @classmethod
+    def export_parquet(cls, path, select=None, filters=None,
+                       batch_size=100000):
+        '''
+        Write the rows matching filters in the parquet file path, by
+        batches of batch_size rows. select is a list of levels or
+        dimensions (exported at full depth), all the dimensions by
+        default. Each level is a dictionary-encoded column of names,
+        measures are written as stored. Returns the number of rows.
+        '''
+        import pyarrow
+        import pyarrow.parquet as parquet
+
+        levels = []
+        for field in select or cls._dimensions:
+            if isinstance(field, Dimension):
+                field = field[-1]
+            if not isinstance(field, Level):
+                raise ValueError('Unexpected field "%s" in export' % field)
+            levels.append(field)
+
+        fields = []
+        dim_cols = []
+        for level in levels:
+            dim = level.dim
+            typ = pyarrow.type_for_alias(ARROW_TYPES[dim.sql_type])
+            if isinstance(dim, Range):
+                names = [dim.name]
+                fields.append(pyarrow.field(dim.name, typ))
+            else:
+                names = ['%s.%s' % (dim.name, lvl.name)
+                         for lvl in list(dim.levels.values())[:level.depth]]
+                fields.extend(
+                    pyarrow.field(name, pyarrow.dictionary(pyarrow.int32(),
+                                                           typ))
+                    for name in names)
+            dim_cols.append((dim.name, names))
+        msrs = cls._db_measures
+        fields.extend(
+            pyarrow.field(m.name, pyarrow.type_for_alias(
+                ARROW_TYPES[m.sql_type]))
+            for m in msrs)
+        meta = {
+            'space': cls._name,
+            'dimensions': dim_cols,
+            'measures': [m.name for m in msrs],
+        }
+        schema = pyarrow.schema(fields, metadata={'menger': dumps(meta)})
+
+        # Ranges are exported as stored, not by buckets
+        cols = [lvl.dim if isinstance(lvl.dim, Range) else lvl
+                for lvl in levels]
+        rows = ctx.db.stream(*ctx.db.dice_query(cls, cols + msrs,
+                                                filters or []))
+        nb_rows = 0
+        with parquet.ParquetWriter(path, schema) as writer:
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                columns = list(zip(*batch))
+                values = []
+                for level, keys in zip(levels, columns):
+                    if isinstance(level.dim, Range):
+                        values.append(keys)
+                        continue
+                    tuples = [level.dim.name_tuple(k) for k in keys]
+                    values.extend(
+                        [t[depth] if depth < len(t) else None
+                         for t in tuples]
+                        for depth in range(level.depth))
+                values.extend(columns[len(levels):])
+                arrays = []
+                for field, vals in zip(schema, values):
+                    if pyarrow.types.is_dictionary(field.type):
+                        arrays.append(pyarrow.array(
+                            vals, field.type.value_type).dictionary_encode())
+                    else:
+                        arrays.append(pyarrow.array(vals, field.type))
+                writer.write_batch(
+                    pyarrow.record_batch(arrays, schema=schema))
+                nb_rows += len(batch)
+        return nb_rows
+
+    @classmethod
+    def import_parquet(cls, path, load_type=None, batch_size=100000):
+        '''
+        Load a parquet file written by export_parquet. Coordinates are
+        resolved (and created) once per distinct path of each batch.
+        Dimensions missing from the file are set to their root.
+        Returns the number of inserted and updated rows.
+        '''
+        import pyarrow.parquet as parquet
+
+        pfile = parquet.ParquetFile(path)
+        meta = loads(pfile.schema_arrow.metadata[b'menger'])
+        dim_cols = dict(meta['dimensions'])
+        for m in cls._db_measures:
+            if m.name not in meta['measures']:
+                raise ValueError('Measure "%s" is missing from %s' % (
+                    m.name, path))
+
+        nb_insert = nb_update = 0
+        for batch in pfile.iter_batches(batch_size=batch_size):
+            columns = []
+            for dim in cls._dimensions:
+                names = dim_cols.get(dim.name)
+                if names is None:
+                    key = dim.key(dim.coord(), create=True)
+                    columns.append([key] * batch.num_rows)
+                else:
+                    columns.append(cls.resolve_keys(
+                        dim, [batch.column(name) for name in names]))
+            for m in cls._db_measures:
+                columns.append(batch.column(m.name).to_pylist())
+
+            nb_dims = len(cls._dimensions)
+            keys_vals = ((row[:nb_dims], row[nb_dims:])
+                         for row in zip(*columns))
+            ins, upd = cls.load_keys(keys_vals, load_type=load_type)
+            nb_insert += ins
+            nb_update += upd
+        trigger('clear_cache')
+        return nb_insert, nb_update
+
+    @staticmethod
+    def resolve_keys(dim, arrays):
+        '''
+        Return the keys of dim for the paths stored in arrays (one
+        array of names per level). Each distinct combination of
+        dictionary indices is resolved once.
+        '''
+        import pyarrow
+
+        if isinstance(dim, Range):
+            return [dim.key(dim.coord(v)) for v in arrays[0].to_pylist()]
+
+        codes = []
+        values = []
+        for arr in arrays:
+            if pyarrow.types.is_dictionary(arr.type):
+                codes.append(arr.indices.to_pylist())
+                values.append(arr.dictionary.to_pylist())
+            else:
+                codes.append(arr.to_pylist())
+                values.append(None)
+
+        memo = {}
+        keys = []
+        for code in zip(*codes):
+            key = memo.get(code)
+            if key is None:
+                names = (c if vals is None or c is None else vals[c]
+                         for c, vals in zip(code, values))
+                coord = dim.coord(
+                    list(takewhile(lambda n: n is not None, names)))
+                key = memo[code] = dim.key(coord, create=True)
+            keys.append(key)
+        return keys
+
     @classmethod
     def all_fields(cls):
         '''
@@ -386,7 +888,7 @@ class Space(metaclass=MetaSpace):
         return msr
 
     @classmethod
-    def clone(cls, _id, values, ghost=False):
+    def clone(cls, _id, values, ghost=False, table=None):
         attributes = OrderedDict()
         for d in cls._dimensions:
             if values[d.name] == 0:
@@ -397,9 +899,76 @@ class Space(metaclass=MetaSpace):
 
         # Allows metaclass mechanism to threat ghost spaces as such
         attributes['__ghost__'] = ghost
+        if table is not None:
+            attributes['_table'] = table
         name = cls._name + '_cache_%s' % _id
         return type(name, (Space,), attributes)
 
+def key_formatter(dim, fmt):
+    'Return a function formatting the keys of dim, with a memo'
+    memo = {}
+
+    def format_key(key):
+        try:
+            return memo[key]
+        except KeyError:
+            res = memo[key] = dim.format_key(key, fmt)
+            return res
+    return format_key
+
+
+def dice_join(levels, space_msrs, filters=None):
+    '''
+    Dice several spaces along the same levels and join the results on
+    the dimension keys (inner join). space_msrs is a list of (space,
+    measures) tuples, levels must be backed by the same dimension
+    tables on all spaces. Yield rows made of the level keys followed
+    by the measures of each space.
+    '''
+    nb_lvl = len(levels)
+    queries, plans = join_queries(levels, space_msrs, filters)
+    for row in ctx.db.dice_join(queries, nb_lvl, filters):
+        keys = row[:nb_lvl]
+        res = list(keys)
+        offset = nb_lvl
+        for space, plan in plans:
+            width = len(plan[0]) - nb_lvl
+            sub_row = keys + row[offset:offset + width]
+            offset += width
+            sub_row, = space.compute([sub_row], plan, dim_fmt='key')
+            res.extend(sub_row[nb_lvl:])
+        yield tuple(res)
+
+
+def dice_join_arrow(levels, space_msrs, filters=None):
+    '''
+    Like dice_join but return the result as an Arrow table. Returns
+    None if the backend can not produce one or if some measures must
+    be computed in Python.
+    '''
+    if not hasattr(ctx.db, 'dice_join_arrow'):
+        return None
+    queries, plans = join_queries(levels, space_msrs, filters)
+    if any(plan[1] for _, plan in plans):
+        return None
+    return ctx.db.dice_join_arrow(queries, len(levels), filters)
+
+
+def join_queries(levels, space_msrs, filters=None):
+    'Return the (space, fields) queries and the plans of dice_join'
+    queries = []
+    plans = []
+    for space, msrs in space_msrs:
+        space.register()
+        plan = space.plan(list(levels) + list(msrs))
+        spc = space
+        profile = Profile.best(space, plan[0], filters=filters)
+        if profile:
+            spc = profile.ghost_spc
+        queries.append((spc, plan[0]))
+        plans.append((space, plan))
+    return queries, plans
+
 def get_space(name):
     return SPACES.get(name)
 
@@ -448,21 +1017,32 @@ class Profile:
         self.ghost_spc = spc.clone(id_, self.sgn_dict, ghost=True)
 
     @classmethod
-    def best(cls, spc, select):
+    def best(cls, spc, select, hit=True, filters=None):
+        if hit:
+            sgn = cls.hit(spc, select)
+        else:
+            sgn = cls.signature(spc, select)
+
+        # Find the best matching profile
+        key = lambda p: p.size
+        profiles = (p for p in cls._all_profiles[spc].values()
+                    if p.size is not None)
+        for pfl in sorted(profiles, key=key):
+            if pfl.match(sgn) and pfl.applies(filters):
+                return pfl
+
+    @classmethod
+    def hit(cls, spc, select):
         # Build signature
         sgn = cls.signature(spc, select)
         # Increment signature counter
         cls._hits[spc._name][sgn] += 1
         now = time()
-        if cls._last_sync < now - 1:
+        # Read-only connections keep their hits in memory
+        if cls._last_sync < now - 1 and not ctx.db.readonly:
             cls.sync()
             cls._last_sync = now
-
-        # Find the best matching profile
-        key = lambda p: p.size
-        for pfl in sorted(cls._all_profiles[spc].values(), key=key):
-            if pfl.match(sgn):
-                return pfl
+        return sgn
 
     @classmethod
     def sync(cls):
@@ -513,8 +1093,52 @@ class Profile:
                 # Remove old data
                 pfl.reset()
 
+    @classmethod
+    def delete(cls, space, filters):
+        '''
+        Propagate a delete on the profiles of space. Profiles deep
+        enough to apply filters are updated, others are reset.
+        '''
+        for id_, pfl in list(cls._all_profiles[space].items()):
+            if pfl.size is None:
+                continue
+            if pfl.covers(filters):
+                ctx.db.delete(pfl.ghost_spc, filters)
+                pfl.size = ctx.db.size(pfl.ghost_spc)
+                ctx.db.set_profile(space, id_, pfl.size)
+            else:
+                pfl.reset()
+
+    def covers(self, filters):
+        # Returns True if the profile is deep enough to apply filters
+        for fdim, coords, *depths in filters or []:
+            if depths or fdim.table is None:
+                return False
+            depth = self.sgn_dict.get(fdim.name, 0)
+            if depth == 0:
+                return False
+            if any(len(c.value) > depth for c in coords):
+                return False
+        return True
+
+    def applies(self, filters):
+        # Returns True if filters give the same rows on the profile,
+        # ranges are stored as the lower bound of their buckets
+        for fdim, coords, *depths in filters or []:
+            depth = self.sgn_dict.get(fdim.name, 0)
+            if depths or depth == 0:
+                return False
+            if fdim.table is None:
+                if not all(fdim.aligned(c.value) for c in coords):
+                    return False
+            elif any(len(c.value) > depth for c in coords):
+                return False
+        return True
+
     def reset(self): # XXX trigger this method for event clear_cache
-        ctx.db.reset_profile(self.spc, self.ghost_spc, self.id_)
+        if not ctx.db.readonly:
+            ctx.db.reset_profile(self.spc, self.ghost_spc, self.id_)
+        self.size = None
 
     def snapshot(self):
         self.reset()
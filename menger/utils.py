@@ -1,9 +1,15 @@
+from collections import OrderedDict
+from io import StringIO
 from itertools import takewhile
 import argparse
 import json
+import os
 import re
+import socketserver
 
+from . import ctx
 from .dimension import Dimension
+from .event import register, trigger
 from .measure import Measure
 from .space import iter_spaces
 
@@ -69,17 +75,21 @@ class Cli(object):
         fmt(content, headers)
 
     def format_rows(self, rows):
+        # Formatting functions are picked once, based on the first row
+        fmts = None
         for vals in rows:
-            yield list(map(self.format_cell, vals))
+            if fmts is None:
+                fmts = [self.cell_formatter(v) for v in vals]
+            yield [fmt(v) for fmt, v in zip(fmts, vals)]
 
-    def format_cell(self, value):
+    def cell_formatter(self, value):
         if isinstance(value, tuple):
-            return '/'.join(str(v) for v in value)
-        return str(value)
+            return lambda v: '/'.join(map(str, v))
+        return str
 
     def fmt_json(self, rows, headers):
         data = [dict(zip(headers, row)) for row in rows]
-        print(json.dumps(data, indent=4))
+        print(json.dumps(data, indent=4), file=self.fd)
 
     def fmt_col(self, rows, headers):
         sep = ' '
@@ -124,7 +134,7 @@ class Cli(object):
                 name = 'help'
 
         method = getattr(self, 'do_' + name)
-        print(method.__doc__ % {'prog': self.prog})
+        print(method.__doc__ % {'prog': self.prog}, file=self.fd)
 
     def do_info(self):
         '''
@@ -197,6 +207,101 @@ class Cli(object):
                 self.space._name, name))
         return getattr(self.space, name)
 
+    @classmethod
+    def find_space(cls, name=None):
+        'Return the space called name (the first one by default)'
+        if not name:
+            return next(iter(iter_spaces()))
+        for space in iter_spaces():
+            if name.lower() == space._name.lower():
+                return space
+        return None
+
+    @classmethod
+    def answer(cls, request, default_space=None, prog=None):
+        '''
+        Execute request (a dict with the query, space and format keys)
+        and return the response sent to the client: the output of the
+        command or an error message.
+        '''
+        query = request.get('query') or []
+        if not query or query[0] not in cls.actions():
+            return {'error': 'Unknown action, use one of: %s' % (
+                ', '.join(cls.actions()))}
+        name = request.get('space') or default_space
+        spc = cls.find_space(name)
+        if spc is None:
+            return {'error': 'Space "%s" not found' % name}
+
+        fd = StringIO()
+        try:
+            cls(spc, query, request.get('format'), prog=prog, fd=fd)
+        except SystemExit as e:
+            return {'error': str(e.code)}
+        except Exception as e:
+            # Keep serving, changes made by the request are dropped
+            # and the cached ids may not exist anymore
+            ctx.db.rollback()
+            trigger('clear_cache')
+            return {'error': '%s: %s' % (type(e).__name__, e)}
+        return {'output': fd.getvalue()}
+
+    @classmethod
+    def serve(cls, path, default_space=None, prog=None, cache_size=256):
+        '''
+        Answer the requests of menger.client on the unix socket path.
+        The connection, the dimension caches and the profiles stay
+        warm between requests and the last responses are cached until
+        the next load.
+        '''
+        cache = OrderedDict()
+        register('clear_cache', cache.clear)
+        read_only = ('dice', 'drill', 'help', 'info')
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line.decode())
+                    except ValueError as e:
+                        request = None
+                        error = 'Malformed request: %s' % e
+                    else:
+                        error = 'Malformed request: not an object'
+                    if not isinstance(request, dict):
+                        self.reply({'error': error})
+                        continue
+                    key = json.dumps(request, sort_keys=True)
+                    response = cache.get(key)
+                    if response is None:
+                        response = cls.answer(request, default_space, prog)
+                        ctx.db.drop_tmp_tables()
+                        # Loads and profile hits are saved, other
+                        # connections can write to the database
+                        ctx.db.commit()
+                        action = (request.get('query') or [None])[0]
+                        if action in read_only and 'output' in response:
+                            cache[key] = response
+                            if len(cache) > cache_size:
+                                cache.popitem(last=False)
+                    self.reply(response)
+
+            def reply(self, response):
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+                self.wfile.flush()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socketserver.UnixStreamServer(path, Handler)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(path)
+
     @classmethod
     def actions(cls):
         return tuple(m[3:] for m in dir(cls) if m.startswith('do_'))
@@ -210,26 +315,33 @@ class Cli(object):
         parser = argparse.ArgumentParser(description='Cli reports.')
 
         actions = ' | '.join(Cli.actions())
-        parser.add_argument('query', nargs='+', help=actions)
+        parser.add_argument('query', nargs='*', help=actions)
         spaces = ' | '.join(s._name for s in iter_spaces())
         parser.add_argument('--space', '-s', default=default_space, help=spaces)
         formats =' | '.join(Cli.formats())
         parser.add_argument('--format', '-f', default='col', help=formats)
+        parser.add_argument('--serve', metavar='SOCKET',
+                            help='Answer queries sent on a unix socket')
+        parser.add_argument('--connect', metavar='SOCKET',
+                            help='Send the query to a server')
         args = parser.parse_args()
 
-        if args.query[0] not in Cli.actions():
+        if args.serve:
+            cls.serve(args.serve, default_space=default_space,
+                      prog=parser.prog)
+            return
+
+        if not args.query or args.query[0] not in Cli.actions():
             parser.print_help()
             exit()
 
-        spc = None
-        if not args.space:
-            spc = next(iter(iter_spaces()))
-        else:
-            for space in iter_spaces():
-                if args.space.lower() == space._name.lower():
-                    spc = space
-                    break
+        if args.connect:
+            from .client import main
+            main(args.connect, args.query, space=args.space,
+                 fmt=args.format)
+            return
 
+        spc = cls.find_space(args.space)
         if spc is None:
             print('Space "%s" not found' % args.space)
             exit()
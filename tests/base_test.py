@@ -1,7 +1,7 @@
 import os
 
 import pytest
-from menger import dimension, Space, measure, connect
+from menger import dimension, Space, measure, connect, ctx
 
 URI = '/tmp/test.db'
 
@@ -210,6 +210,46 @@ def test_glob_filter(session):
     assert res == [(2014, 1, 1)]
 
 
+def test_glob_cached(session):
+    # Load dimension in memory, glob walks the tree without the db
+    Cube.date.name_cache
+    Cube.place.name_cache
+    test_glob(session)
+    test_glob_filter(session)
+    res = Cube.place.glob(('EU', None, None))
+    assert res == [('EU', 'BE', 'BRU'), ('EU', 'BE', 'CRL'),
+                   ('EU', 'FR', 'ORY')]
+
+
+def test_search(session, monkeypatch):
+    res = list(Cube.place.search('R'))
+    assert res == [('FR', 2), ('BRU', 3), ('CRL', 3), ('ORY', 3)]
+    res = list(Cube.place.search('R', limit=1))
+    assert res == [('FR', 2)]
+
+    # Same results with the full-text index, kept up to date
+    monkeypatch.setattr(Cube.place, 'search_index', True)
+    ctx.db.init_fts(Cube.place)
+    res = list(Cube.place.search('R'))
+    assert res == [('FR', 2), ('BRU', 3), ('CRL', 3), ('ORY', 3)]
+    Cube.place.rename(('EU', 'FR', 'ORY'), 'CDG')
+    Cube.load([{'date': [2014, 1, 1], 'place': ['EU', 'BE', 'LGG'],
+                'total': 1, 'count': 1}])
+    res = list(Cube.place.search('G'))
+    assert res == [('CDG', 3), ('LGG', 3)]
+
+    # Patterns of at least 3 characters are served by the trigram index
+    res = list(Cube.place.search('RU'))
+    assert res == [('BRU', 3)]
+    res = list(Cube.place.search('BRU'))
+    assert res == [('BRU', 3)]
+    qr = 'EXPLAIN QUERY PLAN SELECT name FROM %s WHERE %s' % (
+        Cube.place.table, ctx.db.search_cond(Cube.place))
+    plan = [row[-1] for row in ctx.db.execute(qr, ('%BRU%',))]
+    assert any(Cube.place.fts_table in line and 'VIRTUAL TABLE INDEX' in line
+               for line in plan)
+
+
 def test_load_filter(session):
     # Filter match
     data = [
@@ -291,3 +331,97 @@ def test_default(session):
          ]},
     ]
     dice_check(checks)
+
+
+def test_having(session):
+    checks = [
+        {'select': [Cube.place['City'], Cube.total],
+         'having': [(Cube.total, '>', 4)],
+         'values' : [
+             (('EU', 'FR', 'ORY'), 8.0),
+             (('USA', 'NYC', 'JFK'), 16.0),
+         ]},
+        {'select': [Cube.place['Region'], Cube.total],
+         'having': [(Cube.total, '>=', 14), (Cube.count, '<', 3)],
+         'values' : [(('USA',), 16.0)]},
+        # Computed measure
+        {'select': [Cube.place['Region'], Cube.average],
+         'having': [('average', '<', 10)],
+         'values' : [(('EU',), 14 / 3)]},
+    ]
+    for check in checks:
+        res = sorted(Cube.dice(check['select'], having=check['having']))
+        assert res == check['values']
+
+    with pytest.raises(ValueError):
+        list(Cube.dice([Cube.total], having=[(Cube.total, 'LIKE', 1)]))
+
+
+def test_dice_many(session):
+    filters = [Cube.date.match((2014, 1))]
+    queries = [
+        {'select': [Cube.date['Day'], Cube.total], 'filters': filters},
+        {'select': [Cube.place['Country'], Cube.average],
+         'filters': filters},
+        {'select': [Cube.place, Cube.total],
+         'filters': filters,
+         'having': [(Cube.total, '>', 15)]},
+        {'select': [Cube.date['Day'], Cube.place['City'], Cube.count]},
+    ]
+    res = Cube.dice_many(queries)
+    assert len(res) == len(queries)
+    for query, rows in zip(queries, res):
+        assert sorted(rows) == sorted(Cube.dice(**query))
+
+
+def test_rollup(session):
+    select = [Cube.date['Year'], Cube.place['Country'], Cube.total,
+              Cube.average]
+    res = list(Cube.dice(select, rollup=True))
+    assert sorted(res[:3]) == [
+        ((2014,), ('EU', 'BE'), 6.0, 3.0),
+        ((2014,), ('EU', 'FR'), 8.0, 8.0),
+        ((2014,), ('USA', 'NYC'), 16.0, 16.0),
+    ]
+    assert sorted(res[3:5]) == [
+        ((2014,), ('EU',), 14.0, 14 / 3),
+        ((2014,), ('USA',), 16.0, 16.0),
+    ]
+    assert res[5:] == [
+        ((2014,), (), 30.0, 7.5),
+        ((), (), 30.0, 7.5),
+    ]
+
+    res = list(Cube.dice([Cube.place['Region'], Cube.count], rollup=True,
+                         dim_fmt='leaf'))
+    assert sorted(res[:2]) == [('EU', 3.0), ('USA', 1.0)]
+    assert res[2:] == [(None, 4.0)]
+
+    # Subtotals can not skip the groups filtered out by having
+    with pytest.raises(ValueError):
+        list(Cube.dice(select, rollup=True, having=[(Cube.total, '>', 6)]))
+
+
+def test_dice_lazy(session):
+    select = [Cube.place['Country'], Cube.total]
+    keys = list(Cube.dice(select, dim_fmt='key'))
+    assert all(isinstance(key, int) for key, _ in keys)
+
+    res = list(Cube.dice(select, dim_fmt='lazy'))
+    by_value = dict((coord.value, total) for coord, total in res)
+    assert by_value == {('EU', 'BE'): 6.0, ('EU', 'FR'): 8.0,
+                        ('USA', 'NYC'): 16.0}
+    coord = next(c for c, _ in res if c == ('EU', 'BE'))
+    assert str(coord) == 'EU/BE'
+
+    # Lazy coordinates can be used as filters
+    res = list(Cube.dice([Cube.total], filters=[(Cube.place, [coord])]))
+    assert res == [(6.0,)]
+
+
+def test_lazy_register(session):
+    ctx.db.commit()
+    with connect(URI) as db:
+        assert db.registered == set()
+        test_dice(session)
+        assert db.registered == {'cube'}
@@ -0,0 +1,94 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from menger import Cli, ctx
+from menger.client import request
+from .base_test import Cube, DATA, session
+
+
+def test_answer(session):
+    res = Cli.answer({'query': ['dice', 'place', 'total']})
+    assert res == {'output': 'Place Total\nEU    14.0\nUSA   16.0\n'}
+
+    res = Cli.answer({'query': ['dice', 'place=EU/*', 'total'],
+                      'format': 'json'})
+    assert json.loads(res['output']) == [
+        {'Place': 'EU/BE', 'Total': '6.0'},
+        {'Place': 'EU/FR', 'Total': '8.0'},
+    ]
+
+    res = Cli.answer({'query': ['drill', 'place'], 'space': 'cube'})
+    assert res == {'output': 'EU\nUSA\n'}
+
+    assert 'error' in Cli.answer({'query': ['dice', 'nope']})
+    assert 'error' in Cli.answer({'query': ['bogus']})
+    assert 'error' in Cli.answer({'query': ['info'], 'space': 'nope'})
+
+
+def test_failed_load(session, tmp_path):
+    ctx.db.commit()
+    path = tmp_path / 'points.jsonl'
+    point = {'date': [2014, 1, 1], 'place': ['XX'], 'total': 1, 'count': 1}
+    path.write_text(json.dumps(point) + '\nnot json\n')
+    res = Cli.answer({'query': ['load', str(path)]})
+    assert res['error'].startswith('JSONDecodeError')
+
+    # The coordinates created by the load are forgotten
+    assert Cli.answer({'query': ['drill', 'place']}) == {
+        'output': 'EU\nUSA\n'}
+    Cube.load([point])
+    assert Cli.answer({'query': ['drill', 'place']}) == {
+        'output': 'EU\nUSA\nXX\n'}
+
+
+SERVER = '''
+import sys
+from base_test import URI
+from menger import connect, Cli
+with connect(URI):
+    Cli.serve(sys.argv[1])
+'''
+
+
+def test_serve(session, tmp_path):
+    ctx.db.commit()
+    sock_path = str(tmp_path / 'menger.sock')
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(here))
+    server = subprocess.Popen([sys.executable, '-c', SERVER, sock_path],
+                              cwd=here, env=env)
+    try:
+        for _ in range(100):
+            if os.path.exists(sock_path):
+                break
+            time.sleep(0.05)
+        query = ['dice', 'place', 'total']
+        expected = {'output': 'Place Total\nEU    14.0\nUSA   16.0\n'}
+        assert request(sock_path, query) == expected
+
+        # Responses are cached until the next load
+        Cube.load([dict(DATA[0], total=11)])
+        ctx.db.commit()
+        assert request(sock_path, query) == expected
+        path = tmp_path / 'points.jsonl'
+        path.write_text(json.dumps(dict(DATA[0], total=12)) + '\n')
+        assert request(sock_path, ['load', str(path)]) == {'output': ''}
+        assert request(sock_path, query) == {
+            'output': 'Place Total\nEU    24.0\nUSA   16.0\n'}
+
+        # Malformed lines get an error
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(sock_path)
+            sock.sendall(b'not json\n[]\n')
+            with sock.makefile('rb') as fh:
+                for _ in range(2):
+                    assert 'error' in json.loads(fh.readline().decode())
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait(10)
+    assert not os.path.exists(sock_path)
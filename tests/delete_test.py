@@ -1,3 +1,4 @@
+from menger.space import Profile
 from .base_test import Cube, test_dice, dice_check, session, drill_check
 
 def test_delete_leaf(session):
@@ -95,3 +96,45 @@ def test_mixed_levels(session):
      },
     ]
     dice_check(checks)
+
+
+def test_delete_count(session):
+    nb_delete = Cube.delete([Cube.place.match(('EU',))], chunk_size=2)
+    assert nb_delete == 3
+    assert Cube.delete([Cube.place.match(('EU',))]) == 0
+    dice_check([
+        {'select': [Cube.total, Cube.count],
+         'values' : [(16.0, 1.0)]
+     },
+    ])
+
+
+def test_delete_profile(session, monkeypatch):
+    monkeypatch.setattr(Cube, '_cache_ratio', 1)
+    # Forget hits of previous tests
+    Profile._hits.clear()
+    select = [Cube.place['Region'], Cube.total]
+    list(Cube.dice(select))
+    Profile.sync()
+    Cube.refresh_cache()
+    profile = Profile.best(Cube, select)
+    assert profile.size == 2
+
+    # Profile is deep enough, it is updated
+    Cube.delete([Cube.place.match(('USA',))])
+    assert profile.size == 1
+    assert Profile.best(Cube, select) is profile
+    dice_check([
+        {'select': select,
+         'values' : [(('EU',), 14.0)]
+     },
+    ])
+
+    # Profile is too shallow, it is dropped
+    Cube.delete([Cube.place.match(('EU', 'BE'))])
+    assert Profile.best(Cube, select) is None
+    dice_check([
+        {'select': select,
+         'values' : [(('EU',), 8.0)]
+     },
+    ])
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from menger import connect, ctx, gasket, LoadType
+from . import base_test
+from .base_test import Cube, DATA
+
+pytest.importorskip('duckdb')
+pytest.importorskip('pyarrow')
+
+PATH = '/tmp/test.duckdb'
+DUCKDB_URI = 'duckdb:///' + PATH
+
+
+@pytest.yield_fixture(scope='function')
+def session():
+    for path in (PATH, PATH + '.wal'):
+        if os.path.exists(path):
+            os.unlink(path)
+
+    with connect(DUCKDB_URI, init=True):
+        Cube.load(DATA)
+        yield 'session'
+
+
+def test_dice(session):
+    base_test.test_dice(session)
+    base_test.test_having(session)
+    base_test.test_rollup(session)
+
+
+def test_load(session):
+    assert Cube.load(DATA) == (0, 0)
+    points = [dict(DATA[0], total=1), dict(DATA[0], total=3)]
+    assert Cube.load(points, load_type=LoadType.increment) == (0, 1)
+    res = list(Cube.dice([Cube.total]))
+    assert res == [(34.0,)]
+
+    # The last point wins
+    Cube.load(points)
+    res = list(Cube.dice([Cube.total]))
+    assert res == [(31.0,)]
+
+    # Rows cancelling out are removed
+    Cube.load([dict(DATA[0], total=0, count=0)])
+    res = list(Cube.dice([Cube.count]))
+    assert res == [(3.0,)]
+
+
+def test_delete(session):
+    Cube.place.delete(('EU',))
+    res = list(Cube.dice([Cube.place['Region'], Cube.total]))
+    assert res == [(('USA',), 16.0)]
+    assert list(Cube.place.drill()) == ['USA']
+
+
+def test_arrow(session):
+    table = ctx.db.dice_join_arrow(
+        [(Cube, [Cube.date['Month'], Cube.total, Cube.count])], 1)
+    assert table.num_rows == 1
+    assert table.column(2).to_pylist() == [4]
+
+    res = gasket.dice({
+        'select': ['date[Month]', 'cube.total', 'cube.count'],
+    })
+    assert [tuple(row) for row in res['data'].values] == [(1, 30.0, 4.0)]
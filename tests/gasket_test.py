@@ -2,6 +2,7 @@ import pytest
 
 from menger import Space, dimension, measure, gasket
 from .base_test import Cube, session
+from .range_test import AgeCube, DATA as RANGE_DATA
 
 
 DATA = [
@@ -101,6 +102,13 @@ def test_pivot(session):
     res = gasket.dice(query)
     assert list(res['data']['Count']['EU']) == [2.0, 1.0]
 
+    # Pivoted columns are sorted on labels, not on ids
+    Cube.load([{'date': [2014, 1, 1], 'place': ['AA', 'X', 'Y'],
+                'total': 1, 'count': 1}])
+    query['pivot_on'] = ['place']
+    res = gasket.dice(query)
+    assert res['headers'][1] == ('', 'AA', 'EU', 'USA')
+
 def test_limit(session):
     # Test only measures
     query = {
@@ -127,3 +135,54 @@ def test_filter(session):
 
     check_data = gasket.dice(query)['data']
     assert all(check_data['Place: City'].values == ['BRU', 'CRL'])
+
+
+def test_full_index(session):
+    query = {
+        'select': ['date[Day]', 'place[Country]', 'cube.count'],
+        'dim_fmt': 'leaf',
+    }
+    data = gasket.dice(query)['data']
+    # 2 days x 3 countries, missing combinations are filled with zero
+    assert len(data) == 6
+    assert data['Count'].sum() == 4
+    assert (data['Count'] == 0).sum() == 2
+
+    query['skip_zero'] = True
+    assert len(gasket.dice(query)['data']) == 4
+
+    query['skip_zero'] = False
+    query['max_cells'] = 5
+    with pytest.raises(gasket.LimitException):
+        gasket.dice(query)
+
+
+def test_multi_keys(session):
+    AnotherCube.load(DATA)
+    query = {
+        'select': ['date[Month]', 'cube.total', 'anothercube.other_total',
+                   'cube.average', 'anothercube.other_average'],
+        'dim_fmt': 'full',
+    }
+    res = gasket.dice(query)
+    check_data = [tuple(row) for row in res['data'].values]
+    # Average labels are made unique with the space label
+    assert list(res['data'].columns) == [
+        'Date: Month', 'Total', 'Average - Cube', 'Other Total',
+        'Average - AnotherCube']
+    # Inner join on the dimension keys
+    assert check_data == [('2014/1', 30.0, 7.5, 26.0, 26 / 3)]
+
+
+def test_duplicate_labels(session):
+    # Two cities named ORY, ranges are not joined on keys
+    AgeCube.load(RANGE_DATA + [
+        {'age': 17, 'place': ['USA', 'NYC', 'ORY'], 'total': 64}])
+    query = {
+        'select': ['place[City]', 'age', 'agecube.total'],
+        'dim_fmt': 'leaf',
+    }
+    data = gasket.dice(query)['data']
+    # 3 distinct labels x 5 buckets, both ORY of 10 - 20 are kept
+    assert len(data) == 16
+    assert data['Total'].sum() == 127
@@ -0,0 +1,34 @@
+from menger import ctx
+from menger.space import Profile
+from .base_test import Cube, session
+
+
+def test_advise_indexes(session):
+    # Forget the hits of previous tests
+    Profile._hits.clear()
+    assert Cube.advise_indexes() == ([], [])
+
+    list(Cube.dice([Cube.place['Country'], Cube.total]))
+    list(Cube.dice([Cube.date, Cube.place, Cube.total]))
+    assert Cube.advise_indexes() == ([('place', 2)], [])
+    assert Cube.advise_indexes(create=True) == ([('place', 2)], [])
+    assert 'cube_spc_place_cover' in ctx.db.index_names('cube_spc')
+    assert Cube.advise_indexes() == ([], [])
+    assert Cube.advise_indexes(min_hits=3) == ([], [('place', 2)])
+
+    # Filters on place are answered from the index
+    stm, params = ctx.db.dice_query(
+        Cube, [Cube.date['Month'], Cube.total],
+        [Cube.place.match(('EU', 'BE'))])
+    plan = ctx.db.execute('EXPLAIN QUERY PLAN ' + stm, params).fetchall()
+    assert not any(row[-1] == 'SCAN cube_spc' for row in plan)
+
+
+def test_closure_index(session):
+    # Child lookups by name do not scan the siblings
+    plan = ctx.db.execute(
+        'EXPLAIN QUERY PLAN SELECT child FROM place_cls '
+        'WHERE parent = 1 AND depth = 2 AND child IN (3, 4)').fetchall()
+    assert 'place_cls_parent_idx (parent=? AND depth=? AND child=?)' in (
+        plan[0][-1])
+    assert 'place_cls_idx' not in ctx.db.index_names('place_cls')
@@ -0,0 +1,141 @@
+import os
+
+import pytest
+
+from menger import dimension, Space, measure, connect, ctx, gasket, LoadType
+from menger.sketch import DDSketch, HyperLogLog
+from .base_test import URI
+
+DATA = [
+    {'date': [2014, 1, 1], 'user': 'ann', 'amount': 5.0},
+    {'date': [2014, 1, 1], 'user': 'bob', 'amount': 1.0},
+    {'date': [2014, 1, 2], 'user': 'ann', 'amount': 7.0},
+    {'date': [2014, 2, 1], 'user': 'cid', 'amount': 3.0},
+]
+
+class Spread(measure.Computed):
+
+    def compute(self, high, low):
+        return high - low
+
+
+class Skew(measure.Computed):
+
+    def compute(self, high, low):
+        return high / (high - low)
+
+
+class Event(Space):
+    date = dimension.Tree('Date', ['Year', 'Month', 'Day'], int)
+    count = measure.Count('Count')
+    low = measure.Min('Low')
+    high = measure.Max('High')
+    users = measure.CountDistinct('Users')
+    median = measure.Quantile('Median', q=0.5)
+    spread = Spread('Spread', 'high', 'low')
+    skew = Skew('Skew', 'high', 'low')
+
+
+def load_events(events):
+    points = [dict(e, low=e['amount'], high=e['amount'],
+                   users=e['user'], median=e['amount'])
+              for e in events]
+    return Event.load(points, load_type=LoadType.increment)
+
+
+@pytest.yield_fixture(scope='function')
+def session():
+    # Remove previous db
+    if URI != ':memory:' and os.path.exists(URI):
+        os.unlink(URI)
+
+    with connect(URI, init=True):
+        load_events(DATA)
+        yield 'session'
+
+
+def test_measures(session):
+    res = list(Event.dice([Event.count, Event.low, Event.high, Event.users]))
+    assert res == [(4, 1.0, 7.0, 3)]
+
+    res = sorted(Event.dice([Event.date['Month'], Event.count, Event.users,
+                             Event.median]))
+    assert res[0][:3] == ((2014, 1), 3, 2)
+    assert res[0][3] == pytest.approx(5.0, rel=0.02)
+    assert res[1][:3] == ((2014, 2), 1, 1)
+
+    # Rollup merges sketches
+    res = list(Event.dice([Event.date['Month'], Event.users], rollup=True))
+    assert res[-1] == ((), 3)
+
+    res = list(Event.dice([Event.date['Month'], Event.count],
+                          having=[(Event.users, '>', 1)]))
+    assert res == [((2014, 1), 3)]
+
+
+def test_increment(session):
+    load_events([
+        {'date': [2014, 1, 1], 'user': 'dan', 'amount': 0.5},
+        {'date': [2014, 1, 1], 'user': 'bob', 'amount': 9.0},
+    ])
+    res = list(Event.dice([Event.count, Event.low, Event.high, Event.users],
+                          filters=[Event.date.match((2014, 1, 1))]))
+    assert res == [(4, 0.5, 9.0, 3)]
+
+    # Merging coordinates merges states
+    Event.date.rename((2014, 2), 1)
+    res = list(Event.dice([Event.date['Month'], Event.count, Event.users]))
+    assert res == [((2014, 1), 6, 4)]
+
+
+def test_computed_in_db(session):
+    select = [Event.date['Month'], Event.spread]
+    res = sorted(Event.dice(select))
+    assert res == [((2014, 1), 6.0), ((2014, 2), 0.0)]
+
+    # Compute is called by the database
+    plan = Event.plan(select)
+    assert plan[0] == select and not plan[1]
+    stm, _ = ctx.db.dice_query(Event, plan[0])
+    assert Event.spread.sql_name in stm
+
+    # Rollup needs the stored measures
+    res = list(Event.dice(select, rollup=True))
+    assert res[-1] == ((), 6.0)
+
+    # Instances of a class share the SQL function
+    nb_functions = len(measure.SQL_FUNCTIONS)
+    assert Spread('Other', 'high', 'low').sql_name == Event.spread.sql_name
+    Event.dice_many([{'select': select}, {'select': [Event.spread]}])
+    assert len(measure.SQL_FUNCTIONS) == nb_functions
+
+    # Errors raised by compute are not hidden by sqlite
+    with pytest.raises(ZeroDivisionError):
+        list(Event.dice([Event.date['Month'], Event.skew]))
+
+
+def test_gasket_totals(session):
+    res = gasket.dice({
+        'select': ['date[Month]', 'event.count', 'event.low', 'event.high',
+                   'event.users', 'event.median'],
+    })
+    # Distinct counts and quantiles can not be totalled
+    assert res['totals'][1:] == [4, '1.00', '7.00', '', '']
+
+
+def test_sketches():
+    hll = HyperLogLog()
+    for i in range(10000):
+        hll.add(i)
+    other = HyperLogLog()
+    for i in range(5000, 15000):
+        other.add(i)
+    hll = HyperLogLog.from_bytes(hll.merge(other).to_bytes())
+    assert hll.estimate() == pytest.approx(15000, rel=0.1)
+
+    dds = DDSketch()
+    for i in range(1, 1001):
+        dds.add(i)
+    dds = DDSketch.from_bytes(dds.to_bytes())
+    assert dds.quantile(0.5) == pytest.approx(500, rel=0.02)
+    assert dds.quantile(0.9) == pytest.approx(900, rel=0.02)
@@ -0,0 +1,51 @@
+import pytest
+
+from .base_test import Cube, test_dice, session
+from .range_test import AgeCube, DATA as RANGE_DATA
+from .snapshot_test import OtherCube
+
+parquet = pytest.importorskip('pyarrow.parquet')
+PATH = '/tmp/test.parquet'
+
+
+def test_roundtrip(session):
+    assert Cube.export_parquet(PATH, batch_size=3) == 4
+    table = parquet.read_table(PATH)
+    assert table.column_names == [
+        'date.Year', 'date.Month', 'date.Day', 'place.Region',
+        'place.Country', 'place.City', 'total', 'count']
+
+    Cube.delete()
+    assert Cube.import_parquet(PATH, batch_size=3) == (4, 0)
+    test_dice(session)
+
+
+def test_select(session):
+    filters = [Cube.place.match(('EU',))]
+    Cube.export_parquet(PATH, select=[Cube.place['Country']],
+                        filters=filters)
+    assert parquet.read_table(PATH).to_pylist() == [
+        {'place.Region': 'EU', 'place.Country': 'BE',
+         'total': 6.0, 'count': 2.0},
+        {'place.Region': 'EU', 'place.Country': 'FR',
+         'total': 8.0, 'count': 1.0},
+    ]
+
+    # Missing dimensions are set to the root
+    assert OtherCube.import_parquet(PATH) == (2, 0)
+    res = OtherCube.dice([OtherCube.place['Country'], OtherCube.total])
+    assert sorted(res) == [(('EU', 'BE'), 6.0), (('EU', 'FR'), 8.0)]
+
+
+def test_range_roundtrip(session):
+    AgeCube.load(RANGE_DATA)
+    assert AgeCube.export_parquet(PATH) == 6
+    table = parquet.read_table(PATH)
+    assert sorted(table.column('age').to_pylist()) == [
+        -3, 5, 15, 17, 42, 105]
+
+    AgeCube.delete()
+    assert AgeCube.import_parquet(PATH) == (6, 0)
+    res = AgeCube.dice([AgeCube.age, AgeCube.total],
+                       filters=[AgeCube.age.match((15, 17))])
+    assert list(res) == [((10, 20), 2.0)]
@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+from menger import dimension, Space, measure, connect, ctx, UserError
+from .base_test import URI
+
+DATA = [
+    {'date': [2014, 1, 1],
+     'place': ['EU', 'BE', 'BRU'],
+     'total': 2},
+    {'date': [2014, 1, 2],
+     'place': ['EU', 'BE', 'CRL'],
+     'total': 4},
+    {'date': [2015, 1, 1],
+     'place': ['EU', 'FR', 'ORY'],
+     'total': 8},
+    {'date': [2015, 2, 1],
+     'place': ['USA', 'NYC', 'JFK'],
+     'total': 16},
+]
+
+class PartCube(Space):
+    _partition_by = 'date'
+
+    date = dimension.Tree('Date', ['Year', 'Month', 'Day'], int)
+    place = dimension.Tree('Place', ['Region', 'Country', 'City'], str)
+    total = measure.Sum('Total')
+
+
+@pytest.yield_fixture(scope='function')
+def session():
+    # Remove previous db
+    if URI != ':memory:' and os.path.exists(URI):
+        os.unlink(URI)
+
+    with connect(URI, init=True):
+        PartCube.load(DATA)
+        yield 'session'
+
+
+def years():
+    return sorted(PartCube.date.name_tuple(p._partition_id)
+                  for p in PartCube.partitions())
+
+
+def test_partition_dice(session):
+    assert years() == [(2014,), (2015,)]
+    assert ctx.db.size(PartCube) == 4
+
+    res = sorted(PartCube.dice([PartCube.date['Year'], PartCube.total]))
+    assert res == [((2014,), 6.0), ((2015,), 24.0)]
+
+    filters = [PartCube.date.match((2015, 2))]
+    assert len(PartCube.partitions(filters)) == 1
+    res = sorted(PartCube.dice([PartCube.place['Region'], PartCube.total],
+                               filters))
+    assert res == [(('USA',), 16.0)]
+
+
+def test_partition_root(session):
+    with pytest.raises(UserError):
+        PartCube.load([{'date': [], 'place': ['EU'], 'total': 1}])
+    assert ctx.db.size(PartCube) == 4
+
+
+def test_partition_delete(session):
+    # Whole partition
+    assert PartCube.delete([PartCube.date.match((2014,))]) == 2
+    assert years() == [(2015,)]
+
+    # Rows inside a partition
+    assert PartCube.delete([PartCube.date.match((2015, 2))]) == 1
+    res = list(PartCube.dice([PartCube.total]))
+    assert res == [(8.0,)]
+
+
+def test_replace_partition(session):
+    points = [
+        {'date': [2014, 3, 1], 'place': ['EU', 'BE', 'BRU'], 'total': 1},
+        {'date': [2015, 3, 1], 'place': ['EU', 'BE', 'BRU'], 'total': 100},
+    ]
+    PartCube.replace_partition((2014,), points)
+    res = sorted(PartCube.dice([PartCube.date['Month'], PartCube.total]))
+    assert res == [
+        ((2014, 3), 1.0),
+        ((2015, 1), 8.0),
+        ((2015, 2), 16.0),
+    ]
+
+
+def test_partition_merge(session):
+    PartCube.date.rename((2015,), 2014)
+    assert years() == [(2014,)]
+    res = sorted(PartCube.dice([PartCube.date['Year'], PartCube.total]))
+    assert res == [((2014,), 30.0)]
+
+    PartCube.date.reparent((2014, 2), (2016,))
+    assert years() == [(2014,), (2016,)]
+    res = sorted(PartCube.dice([PartCube.date['Month'], PartCube.total],
+                               [PartCube.date.match((2016,))]))
+    assert res == [((2016, 2), 16.0)]
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from menger import connect, ctx, LoadType
+from menger.backend import get_backend
+from . import base_test
+from .base_test import Cube, DATA
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+# Points to a throwaway database, its public schema is dropped
+PG_URI = os.environ.get('MENGER_PG_URI')
+pytestmark = pytest.mark.skipif(PG_URI is None,
+                                reason='MENGER_PG_URI is not set')
+
+
+@pytest.yield_fixture(scope='function')
+def session():
+    db = get_backend(PG_URI)
+    db.execute('DROP SCHEMA public CASCADE')
+    db.execute('CREATE SCHEMA public')
+    db.close()
+
+    with connect(PG_URI, init=True):
+        Cube.load(DATA)
+        yield 'session'
+
+
+def test_dice(session):
+    base_test.test_dice(session)
+    base_test.test_having(session)
+    base_test.test_rollup(session)
+
+
+def test_load(session):
+    assert Cube.load(DATA) == (0, 0)
+    points = [dict(DATA[0], total=1), dict(DATA[0], total=3)]
+    assert Cube.load(points, load_type=LoadType.increment) == (0, 1)
+    res = list(Cube.dice([Cube.total]))
+    assert res == [(34.0,)]
+
+    # Rows cancelling out are removed
+    Cube.load([dict(DATA[0], total=0, count=0)])
+    res = list(Cube.dice([Cube.count]))
+    assert res == [(3.0,)]
+
+
+def test_stream(session, monkeypatch):
+    monkeypatch.setattr(ctx.db, 'itersize', 1)
+    rows = ctx.db.dice(Cube, [Cube.date['Day'], Cube.total])
+    assert sorted(rows) == sorted(ctx.db.dice_join(
+        [(Cube, [Cube.date['Day'], Cube.total])], 1))
+
+
+def test_reparent(session):
+    Cube.place.rename(('EU', 'FR'), 'BE')
+    res = list(Cube.dice([Cube.place['Country'], Cube.total]))
+    assert sorted(res) == [(('EU', 'BE'), 14.0), (('USA', 'NYC'), 16.0)]
+
+
+def test_load_batches(session, monkeypatch):
+    monkeypatch.setattr(ctx.db, 'batch_size', 1)
+    points = [dict(DATA[0], total=1), dict(DATA[1], date=[2015, 1, 1])]
+    assert Cube.load(points) == (1, 1)
+    res = list(Cube.dice([Cube.date['Year'], Cube.total]))
+    assert sorted(res) == [((2014,), 29.0), ((2015,), 4.0)]
@@ -0,0 +1,48 @@
+import sqlite3
+
+import pytest
+
+from menger import connect, ctx
+from .base_test import Cube, DATA, URI, session
+
+
+def test_options(session):
+    with connect(URI, mmap_size=2**20, synchronous='NORMAL') as db:
+        assert db.execute('PRAGMA mmap_size').fetchone() == (2**20,)
+        assert db.execute('PRAGMA synchronous').fetchone() == (1,)
+
+    with pytest.raises(ValueError):
+        connect(URI, journal_mode='OFF').__enter__()
+    with pytest.raises(ValueError):
+        connect(URI, synchronous='OFF; DROP TABLE cube_spc').__enter__()
+
+
+def test_trusted_load(session):
+    points = [dict(DATA[0], total=1), dict(DATA[1], date=[2015])]
+    assert Cube.load(points, trusted=True) == (1, 1)
+    assert ctx.db.execute('PRAGMA foreign_keys').fetchone() == (1,)
+    res = list(Cube.dice([Cube.date['Year'], Cube.total]))
+    assert sorted(res) == [((2014,), 29.0), ((2015,), 4.0)]
+
+    # Dangling keys are detected and the load is rolled back
+    keys_vals = [((1, 999), (1, 1))]
+    with pytest.raises(sqlite3.IntegrityError):
+        with ctx.db.bulk_load(Cube):
+            ctx.db.load(Cube, keys_vals)
+    assert ctx.db.execute('PRAGMA foreign_keys').fetchone() == (1,)
+    assert list(Cube.dice([Cube.total])) == [(33.0,)]
+
+    # Cached coordinates of a failed load are dropped
+    point = dict(DATA[0], place=['XX'])
+    with pytest.raises(KeyError):
+        Cube.load([point, {'total': 1}], trusted=True)
+    assert list(Cube.place.drill()) == ['EU', 'USA']
+    Cube.load([point], trusted=True)
+    assert list(Cube.place.drill()) == ['EU', 'USA', 'XX']
+
+
+def test_trusted_load_commit(session):
+    # Pending changes are committed by a trusted load
+    Cube.load([dict(DATA[0], total=1)], trusted=True)
+    ctx.db.rollback()
+    assert list(Cube.dice([Cube.total])) == [(29.0,)]
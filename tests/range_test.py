@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+from menger import dimension, Space, measure, connect
+from menger.space import Profile
+from .base_test import URI
+
+DATA = [
+    {'age': 5, 'place': ['EU', 'BE', 'BRU'], 'total': 1},
+    {'age': 15, 'place': ['EU', 'BE', 'BRU'], 'total': 2},
+    {'age': 17, 'place': ['EU', 'FR', 'ORY'], 'total': 4},
+    {'age': 42, 'place': ['USA', 'NYC', 'JFK'], 'total': 8},
+    {'age': 105, 'place': ['EU', 'FR', 'ORY'], 'total': 16},
+    {'age': -3, 'place': ['USA', 'NYC', 'JFK'], 'total': 32},
+]
+
+class AgeCube(Space):
+    age = dimension.Range('Age', (0, 100, 10), type=int)
+    place = dimension.Tree('Place', ['Region', 'Country', 'City'], str)
+    total = measure.Sum('Total')
+
+
+@pytest.yield_fixture(scope='function')
+def session():
+    # Remove previous db
+    if URI != ':memory:' and os.path.exists(URI):
+        os.unlink(URI)
+
+    with connect(URI, init=True):
+        AgeCube.load(DATA)
+        yield 'session'
+
+
+def test_range_dice(session):
+    res = sorted(AgeCube.dice([AgeCube.age, AgeCube.total]))
+    assert res == [
+        ((-10, 0), 32.0),
+        ((0, 10), 1.0),
+        ((10, 20), 6.0),
+        ((40, 50), 8.0),
+        ((100, 110), 16.0),
+    ]
+
+    res = sorted(AgeCube.dice([AgeCube.age, AgeCube.total], dim_fmt='leaf'))
+    assert res[0] == ('-10 - 0', 32.0)
+
+    res = sorted(AgeCube.dice(
+        [AgeCube.place['Region'], AgeCube.age, AgeCube.total],
+        filters=[AgeCube.place.match(('EU',))]))
+    assert res == [
+        (('EU',), (0, 10), 1.0),
+        (('EU',), (10, 20), 6.0),
+        (('EU',), (100, 110), 16.0),
+    ]
+
+
+def test_range_filter(session):
+    # A bucket
+    res = list(AgeCube.dice([AgeCube.total],
+                            filters=[AgeCube.age.match(10)]))
+    assert res == [(6.0,)]
+
+    # Custom bounds, OR-ed
+    res = list(AgeCube.dice([AgeCube.total], filters=[
+        AgeCube.age.match((16, 50), (None, 0))]))
+    assert res == [(44.0,)]
+
+    assert AgeCube.delete([AgeCube.age.match((100, None))]) == 1
+    res = list(AgeCube.dice([AgeCube.total]))
+    assert res == [(47.0,)]
+
+
+def test_range_drill(session):
+    assert list(AgeCube.age.drill())[:3] == [0, 10, 20]
+
+
+def test_range_profile(session, monkeypatch):
+    monkeypatch.setattr(AgeCube, '_cache_ratio', 10)
+    Profile._hits.clear()
+    select = [AgeCube.age, AgeCube.total]
+    list(AgeCube.dice(select))
+    Profile.sync()
+    AgeCube.refresh_cache()
+    assert Profile.best(AgeCube, select) is not None
+
+    # Profiles only know the buckets
+    filters = [AgeCube.age.match((15, 17))]
+    assert Profile.best(AgeCube, select, filters=filters) is None
+    assert list(AgeCube.dice([AgeCube.total], filters=filters)) == [(2.0,)]
+
+    filters = [AgeCube.age.match((10, 50))]
+    assert Profile.best(AgeCube, select, filters=filters) is not None
+    assert list(AgeCube.dice([AgeCube.total], filters=filters)) == [(14.0,)]
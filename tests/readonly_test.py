@@ -0,0 +1,41 @@
+import os
+import sqlite3
+
+import pytest
+
+from menger import connect, ctx
+from menger.event import trigger
+from menger.space import Profile
+from .base_test import Cube, DATA, URI, test_dice
+
+
+@pytest.yield_fixture(scope='function')
+def session():
+    if os.path.exists(URI):
+        os.unlink(URI)
+    with connect(URI, init=True):
+        Cube.load(DATA)
+
+    with connect(URI, readonly=True) as db:
+        yield db
+    # The next session recreates the database
+    trigger('clear_cache')
+
+
+def test_readonly(session):
+    assert not os.path.exists(URI + '-wal')
+    test_dice(session)
+    with pytest.raises(sqlite3.OperationalError):
+        session.execute('DELETE FROM cube_spc')
+
+    # Hits are kept in memory
+    Profile._last_sync = 0
+    list(Cube.dice([Cube.date['Month'], Cube.total]))
+    assert Profile._hits['cube'][(('date', 2), ('place', 0))] > 0
+    assert list(ctx.db.get_profiles(Cube)) == []
+
+
+def test_init():
+    with pytest.raises(ValueError):
+        with connect(URI, init=True, readonly=True):
+            pass
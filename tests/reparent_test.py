@@ -1,3 +1,5 @@
+import pytest
+
 from .base_test import Cube, test_dice, dice_check, session, drill_check
 
 def test_reparent_leaf(session):
@@ -85,15 +87,16 @@ def test_merge_reparent(session):
 
     Cube.place.reparent(('EU', 'BE'), ('USA',))
 
+    # Both BRU points are summed
     reparent_dice_checks = [
         {'select': [Cube.total, Cube.count],
-         'values' : [(30.0, 4.0)]
+         'values' : [(32.0, 5.0)]
         },
         {'select': [Cube.date['Day'], Cube.place['Country'], Cube.total],
          'filters': [Cube.date.match((2014, 1))],
          'values' : [
              ((2014, 1, 1), ('EU', 'FR'), 8.0),
-             ((2014, 1, 1), ('USA', 'BE'), 2.0),
+             ((2014, 1, 1), ('USA', 'BE'), 4.0),
              ((2014, 1, 2), ('USA', 'BE'), 4.0),
              ((2014, 1, 2), ('USA', 'NYC'), 16.0)]
      },
@@ -190,3 +193,110 @@ def test_delete(session):
             'dimension': 'place',
         },
     ])
+
+
+def test_merge_count(session):
+    Cube.load([
+        {'date': [2014, 1, 1],
+         'place': ['USA', 'BE', 'BRU'],
+         'total': 2,
+         'count': 1},
+        {'date': [2014, 1, 1],
+         'place': ['USA', 'BE', 'ANR'],
+         'total': 1,
+         'count': 1},
+    ])
+
+    # Only the line on the duplicated BRU is moved
+    nb_moved = Cube.place.reparent(('EU', 'BE'), ('USA',))
+    assert nb_moved == 1
+
+    dice_check([
+        {'select': [Cube.place['City'], Cube.total],
+         'filters': [Cube.place.match(('USA', 'BE'))],
+         'values' :[
+             (('USA', 'BE', 'ANR'), 1.0),
+             (('USA', 'BE', 'BRU'), 4.0),
+             (('USA', 'BE', 'CRL'), 4.0),
+         ]
+     },
+    ])
+    drill_check([
+        {
+            'coordinate' : ('USA', 'BE'),
+            'result': ['ANR', 'BRU', 'CRL'],
+            'dimension': 'place',
+        },
+    ])
+
+
+def test_restructure(session):
+    nb_moved = Cube.place.restructure({
+        ('EU', 'BE', 'CRL'): ('EU', 'FR', 'CRL'),
+        ('EU', 'BE', 'BRU'): ('EU', 'FR', 'ORY'),
+        ('USA', 'NYC'): ('USA', 'NY'),
+    })
+    # BRU is merged with ORY
+    assert nb_moved == 1
+
+    dice_check([
+        {'select': [Cube.place['City'], Cube.total],
+         'values' :[
+             (('EU', 'FR', 'CRL'), 4.0),
+             (('EU', 'FR', 'ORY'), 10.0),
+             (('USA', 'NY', 'JFK'), 16.0),
+         ]
+     },
+        {'select': [Cube.date['Day'], Cube.place['City'], Cube.count],
+         'filters': [Cube.place.match(('EU',))],
+         'values' :[
+             ((2014, 1, 1), ('EU', 'FR', 'ORY'), 2.0),
+             ((2014, 1, 2), ('EU', 'FR', 'CRL'), 1.0),
+         ]
+     },
+    ])
+
+    # BE is pruned
+    drill_check([
+        {
+            'coordinate' : ('EU',),
+            'result': ['FR'],
+            'dimension': 'place',
+        },
+        {
+            'coordinate' : ('EU', 'FR'),
+            'result': ['CRL', 'ORY'],
+            'dimension': 'place',
+        },
+    ])
+
+    # Nodes keep their depth and the tree is left unchanged
+    for mapping in [
+            {('EU',): ('EU', 'FR', 'EU')},
+            {('EU', 'FR'): ('USA', 'NY', 'JFK', 'FR')},
+            {('EU', 'FR'): ('ZZ', 'FR'),
+             ('USA', 'NY'): ('USA', 'NY', 'ZZ', 'NY')},
+    ]:
+        with pytest.raises(ValueError):
+            Cube.place.restructure(mapping)
+    drill_check([
+        {
+            'coordinate' : tuple(),
+            'result': ['EU', 'USA'],
+            'dimension': 'place',
+        },
+        {
+            'coordinate' : ('USA', 'NY'),
+            'result': ['JFK'],
+            'dimension': 'place',
+        },
+    ])
+    dice_check([
+        {'select': [Cube.place['City'], Cube.total],
+         'values' :[
+             (('EU', 'FR', 'CRL'), 4.0),
+             (('EU', 'FR', 'ORY'), 10.0),
+             (('USA', 'NY', 'JFK'), 16.0),
+         ]
+     },
+    ])
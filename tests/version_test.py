@@ -2,7 +2,7 @@ import os
 
 import pytest
 
-from menger import dimension, Space, measure, connect
+from menger import dimension, Space, measure, connect, ctx
 from .base_test import URI
 
 DATA = [
@@ -71,3 +71,33 @@ def test_version(session):
         [VersionCube.version.match(('2015-01',))],
     ))
     assert res == [(('2015-01',), 30.0)]
+
+
+def test_version_dice_many(session):
+    queries = [
+        {'select': [VersionCube.place, VersionCube.total]},
+        {'select': [VersionCube.version, VersionCube.total]},
+        {'select': [VersionCube.total]},
+    ]
+    res = VersionCube.dice_many(queries)
+    assert sorted(res[0]) == [(('EU',), 140.0), (('USA',), 160.0)]
+    assert sorted(res[1]) == [(('2015-01',), 30.0), (('2015-02',), 300.0)]
+    assert res[2] == [(300.0,)]
+
+
+def test_last_version(session):
+    assert VersionCube.version.last_coord() == ('2015-02',)
+    stm, _ = ctx.db.dice_query(VersionCube, [VersionCube.total])
+    assert 'tmp_' not in stm
+
+    VersionCube.load([{
+        'version': ['2015-03'],
+        'place': ['EU', 'BE', 'BRU'],
+        'total': 1,
+    }])
+    assert VersionCube.version.last_coord() == ('2015-03',)
+    assert list(VersionCube.dice([VersionCube.total])) == [(1.0,)]
+
+    VersionCube.version.delete(('2015-03',))
+    assert VersionCube.version.last_coord() == ('2015-02',)
+    assert list(VersionCube.dice([VersionCube.total])) == [(300.0,)]